@@ -6,7 +6,12 @@ import nrbdaq.instr.avo as avo
 from nrbdaq.instr.thermo import Thermo49i
 from nrbdaq.instr.aurora3000 import Aurora3000
 from nrbdaq.instr.fidas import FIDAS
+from nrbdaq.utils.runtime import AsyncRuntime
 from nrbdaq.utils.sftp import SFTPClient
+from nrbdaq.utils.storage import DatasetWriter
+from nrbdaq.utils.supervisor import WORKERS, Supervisor
+from nrbdaq.utils.transfer import TransferService
+from nrbdaq.utils.watcher import StagingWatcher
 from nrbdaq.utils.utils import load_config, setup_logging, seconds_to_next_n_minutes
 
 
@@ -22,55 +27,80 @@ def main():
     # setup sftp client
     sftp = SFTPClient(config=config)
     logger.debug(f"sftp.remote_path: {sftp.remote_path}")
+    schedule.every(1).minutes.do(sftp.evict_idle)
 
-    # setup FIDAS
-    fidas = FIDAS(config=config)
-    fidas.connect_udp()
-    fidas.setup_schedules()
-    remote_path = os.path.join(sftp.remote_path, fidas.remote_path)
-    sftp.setup_transfer_schedules(local_path=fidas.staging_path,
-                                  remote_path=remote_path,
-                                  interval=fidas.reporting_interval)
-
-    # setup AE31 data acquisition and data transfer
-    ae31 = AE31(config=config)
-    ae31.setup_schedules()
-    remote_path = os.path.join(sftp.remote_path, ae31.remote_path)
-    sftp.setup_transfer_schedules(local_path=ae31.staging_path,
-                                  remote_path=remote_path,
-                                  interval=ae31.reporting_interval)
-
-    # setup Nairobi AVO data download, staging and transfer
-    data_path = os.path.join(os.path.expanduser(config['root']), config['data'], config['AVO']['data_path'])
-    staging_path = os.path.join(os.path.expanduser(config['root']), config['staging'], config['AVO']['staging_path'])
-    remote_path = os.path.join(sftp.remote_path, config['AVO']['remote_path'])
-    download_interval = config['AVO']['download_interval']
-    hours = [f"{download_interval*n:02}:00" for n in range(23) if download_interval*n <= 23]
-    for hr in hours:
-        schedule.every(1).day.at(hr).do(avo.download_multiple,
-                                       urls={'url_nairobi': config['AVO']['urls']['url_nairobi']},
-                                       file_path=data_path,
-                                       staging=staging_path)
-    sftp.setup_transfer_schedules(local_path=staging_path,
-                                  remote_path=remote_path,
-                                  interval=download_interval)
-
-    # setup Thermo 49i data acquisition and data transfer
-    thermo49i = Thermo49i(config=config)
-    thermo49i.setup_schedules()
-    remote_path = os.path.join(sftp.remote_path, thermo49i.remote_path)
-    sftp.setup_transfer_schedules(local_path=thermo49i.staging_path,
-                                  remote_path=remote_path,
-                                  interval=thermo49i.reporting_interval)
-
-    # setup Aurora3000
-    neph = Aurora3000(config=config)
-    neph.setup_schedules()
-    logger.info(f"get_instrument_id: {neph.get_instrument_id()}")
-    remote_path = os.path.join(sftp.remote_path, neph.remote_path)
-    sftp.setup_transfer_schedules(local_path=neph.staging_path,
-                                  remote_path=remote_path,
-                                  interval=neph.reporting_interval)
+    # setup background transfer of staged files
+    transfer = TransferService(sftp=sftp, config=config)
+
+    supervisor = None
+    if config.get('supervisor', {}).get('enabled', False):
+        # run each instrument in its own process, restarted if it fails; transfer staged files from this process
+        supervisor = Supervisor(config=config)
+        for name in supervisor.names:
+            section = config[WORKERS[name][1]]
+            transfer.register(local_path=os.path.join(os.path.expanduser(config['root']), config['staging'], section['staging_path']),
+                              remote_path=os.path.join(sftp.remote_path, section['remote_path']))
+        supervisor.start()
+        schedule.every(5).seconds.do(supervisor.check)
+        schedule.every(10).minutes.do(supervisor.log_status)
+    else:
+        # setup FIDAS
+        fidas = FIDAS(config=config)
+        fidas.connect_udp()
+        fidas.setup_schedules()
+        fidas.on_staged = transfer.stage
+        transfer.register(local_path=fidas.staging_path,
+                          remote_path=os.path.join(sftp.remote_path, fidas.remote_path))
+
+        # setup AE31 data acquisition and data transfer
+        ae31 = AE31(config=config)
+        ae31.setup_schedules()
+        ae31.on_staged = transfer.stage
+        transfer.register(local_path=ae31.staging_path,
+                          remote_path=os.path.join(sftp.remote_path, ae31.remote_path))
+
+        # setup Nairobi AVO data download, staging and transfer
+        data_path = os.path.join(os.path.expanduser(config['root']), config['data'], config['AVO']['data_path'])
+        staging_path = os.path.join(os.path.expanduser(config['root']), config['staging'], config['AVO']['staging_path'])
+        remote_path = os.path.join(sftp.remote_path, config['AVO']['remote_path'])
+        download_interval = config['AVO']['download_interval']
+        hours = [f"{download_interval*n:02}:00" for n in range(23) if download_interval*n <= 23]
+        for hr in hours:
+            schedule.every(1).day.at(hr).do(avo.download_multiple,
+                                           urls={'url_nairobi': config['AVO']['urls']['url_nairobi']},
+                                           file_path=data_path,
+                                           staging=staging_path,
+                                           on_staged=transfer.stage,
+                                           dataset=DatasetWriter(config, 'avo'))
+        transfer.register(local_path=staging_path, remote_path=remote_path)
+
+        # setup Thermo 49i data acquisition and data transfer
+        thermo49i = Thermo49i(config=config)
+        thermo49i.setup_schedules()
+        thermo49i.on_staged = transfer.stage
+        transfer.register(local_path=thermo49i.staging_path,
+                          remote_path=os.path.join(sftp.remote_path, thermo49i.remote_path))
+
+        # setup Aurora3000
+        neph = Aurora3000(config=config)
+        neph.setup_schedules()
+        logger.info(f"get_instrument_id: {neph.get_instrument_id()}")
+        neph.on_staged = transfer.stage
+        transfer.register(local_path=neph.staging_path,
+                          remote_path=os.path.join(sftp.remote_path, neph.remote_path))
+
+    # watch the staging area: transfer the backlog, then every file as soon as it is closed. Report queue depth and lag.
+    staging = os.path.join(os.path.expanduser(config['root']), config['staging'])
+    watcher = StagingWatcher(path=staging, callback=transfer.stage, config=config)
+    transfer.start()
+    watcher.start()
+    schedule.every(10).minutes.do(transfer.log_status)
+
+    # select runtime: 'schedule' polls all jobs on this thread, 'asyncio' runs each driver independently
+    runtime = config.get('runtime', 'schedule')
+    if runtime == 'asyncio':
+        async_runtime = AsyncRuntime(config=config)
+        schedule.every(10).minutes.do(async_runtime.log_stats)
 
     # list all jobs
     logger.info(schedule.get_jobs(), extra={'to_logfile': True})
@@ -86,11 +116,19 @@ def main():
 
     # start jobs
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        if runtime == 'asyncio':
+            async_runtime.run()
+        else:
+            while True:
+                schedule.run_pending()
+                time.sleep(1)
     except KeyboardInterrupt:
         print("Stopping data acquisition ...")
+        if supervisor:
+            supervisor.stop()
+        watcher.stop(timeout=5)
+        transfer.stop(timeout=60)
+        sftp.close()
         # fidas.save_hourly()  # Save any remaining data on exit
 
 
@@ -9,6 +9,39 @@ import polars as pl
 import schedule
 import serial
 
+from nrbdaq.utils.aggregation import open_aggregator
+from nrbdaq.utils.serialport import LineReader, serial_port
+from nrbdaq.utils.storage import DatasetWriter, Manifest
+from nrbdaq.utils.wal import open_wal
+
+# columns of AE31 data lines, as saved by AE31._save_data
+COLUMNS = ["dtm","unknown","date","time","UV370","B470","G520","Y590","R660","IR880","IR950","flow",]# "bypass",]
+COLUMNS += ["?370", "sens_zero_370","sens_beam_370","ref_zero_370","ref_beam_370","att_370", ]#"flow_370", "bypass_370",] 
+COLUMNS += ["?470", "sens_zero_470","sens_beam_470","ref_zero_470","ref_beam_470","att_470", ]#"flow_470", "bypass_470",] 
+COLUMNS += ["?520", "sens_zero_520","sens_beam_520","ref_zero_520","ref_beam_520","att_520", ]#"flow_520", "bypass_520",] 
+COLUMNS += ["?590", "sens_zero_590","sens_beam_590","ref_zero_590","ref_beam_590","att_590", ]#"flow_590", "bypass_590",] 
+COLUMNS += ["?660", "sens_zero_660","sens_beam_660","ref_zero_660","ref_beam_660","att_660", ]#"flow_660", "bypass_660",] 
+COLUMNS += ["?880", "sens_zero_880","sens_beam_880","ref_zero_880","ref_beam_880","att_880", ]#"flow_880", "bypass_880",] 
+COLUMNS += ["?950", "sens_zero_950","sens_beam_950","ref_zero_950","ref_beam_950","att_950", ]#"flow_950", "bypass_950",]
+SCHEMA = {col: pl.String if col in ("dtm", "date", "time") else pl.Float32 for col in COLUMNS}
+# NB: padded numbers ("  6633", " .4782") parse as Float32 as they are; the header line (starting with 'dtm,') is skipped;
+# empty records, with the time of the PC only, are read as rows of nulls and dropped by _parse_timestamps. Any other
+# value that is not a number is an error, rather than silently read as null.
+CSV_OPTIONS = dict(has_header=False, schema=SCHEMA, extra_columns='ignore', truncate_ragged_lines=True, comment_prefix='dtm,')
+
+
+def _parse_timestamps(frame: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """Add dtm (time of PC, UTC) and dtm_ae31 (time of instrument) and drop lines that are not data.
+
+    NB: Besides the header, this drops empty records, i.e., lines with the time of the PC only, which
+    _save_data writes if the instrument sent nothing. They hold no data, and have no dtm_ae31 to sort
+    or deduplicate them on.
+    """
+    return (frame.with_columns(pl.col("dtm").str.to_datetime(time_unit='us', time_zone='UTC', strict=False),
+                               pl.concat_str(["date", "time"], separator=" ")
+                                 .str.to_datetime("%d-%b-%y %H:%M", time_unit='us', strict=False).alias("dtm_ae31"))
+                 .filter(pl.col("dtm_ae31").is_not_null()))
+
 
 class AE31:
     def __init__(self, config: dict):
@@ -28,6 +61,9 @@ class AE31:
             # configure serial port
             self._serial_port = config['AE31']['serial_port']
             self._serial_timeout = config['AE31']['serial_timeout']
+            # NB: the port is kept open and drained by self.reader, so that lines are never lost
+            self.port = serial_port(self._serial_port, baudrate=9600, timeout=float(self._serial_timeout))
+            self.reader = LineReader(self.port, config)
             
             root = os.path.expanduser(config['root'])
 
@@ -60,16 +96,25 @@ class AE31:
             #     schedule.every(1).hour.at('00:05').do(self._save_and_stage_data)
 
             # configure archive
-            # self.archive_path = os.path.join(root, config['AE31']['archive'])
-            # os.makedirs(self.archive_path, exist_ok=True)
+            self.archive_path = os.path.join(root, config['AE31'].get('archive', 'archive/ae31'))
 
             # configure remote transfer
             self.remote_path = config['AE31']['remote_path']
 
+            # configure common dataset, and aggregation of the numeric columns
+            self.dataset = DatasetWriter(config, 'ae31')
+            self.aggregator = open_aggregator(config, 'ae31', [col for col, dtype in SCHEMA.items() if dtype == pl.Float32])
+
             # initialize data response and datetime stamp           
             self._data = str()
             self.data_file = str()
             self._dtm = None
+            # write-ahead log of self._data; replay data not saved before a crash or power cut
+            self.wal = open_wal(config, 'ae31')
+            self._data = ''.join(record.decode('utf-8') for record in self.wal.replay())
+
+            # callback notified of staged files, e.g., TransferService.stage
+            self.on_staged = None
 
         except Exception as err:
             self.logger.error(err)
@@ -83,7 +128,9 @@ class AE31:
             os.makedirs(self.staging_path, exist_ok=True)
             # os.makedirs(self.archive_path, exist_ok=True)
 
-            # configure data acquisition schedule
+            # configure data acquisition: the reader receives lines, the schedule collects them
+            if not self.reader.is_alive():
+                self.reader.start()
             schedule.every(self.sampling_interval).minutes.at(':00').do(self.accumulate_data)
             
             # configure saving and staging schedules
@@ -105,14 +152,28 @@ class AE31:
 
     def accumulate_data(self):
         """
-        Read data waiting at serial port. Opens the port, assigns lines read to self._data.
+        Append the lines received by self.reader since the last call to self._data, each prefixed
+        with its time of arrival.
         """
         try:
-            with serial.Serial(self._serial_port, 9600, 8, 'N', 1, int(self._serial_timeout)) as ser:
-                self._dtm = datetime.now().isoformat(timespec='seconds')
-                _ = f"{self._dtm},{ser.readline().decode('ascii').strip()}\n"
-                self._data = f"{self._data}{_}"
+            lines = [(dtm, line.decode('ascii').strip()) for dtm, line in self.reader.drain()]
+            lines = [(dtm, line) for dtm, line in lines if line]
+            if not lines:
+                self.logger.warning("AE31, no data received since last call")
+                return
+            data = str()
+            for dtm, line in lines:
+                self._dtm = dtm.isoformat(timespec='seconds')
+                _ = f"{self._dtm},{line}\n"
+                data = f"{data}{_}"
+                self.wal.append(_)
                 self.logger.info(f"AE31, {_[:60]} [...]"),
+            self._data = f"{self._data}{data}"
+
+            if self.aggregator:
+                df = self.data_to_df(data)
+                for dtm, values in zip(df['dtm'].dt.epoch('s'), df.select(self.aggregator.channels).to_numpy()):
+                    self.aggregator.add(values, dtm)
             return
 
         except serial.SerialException as err:
@@ -142,9 +203,17 @@ class AE31:
                 # open file and write to it
                 with open(file=self.data_file, mode=mode) as fh:
                     fh.write(f"{header}{self._data}")
+                    fh.flush()
+                    os.fsync(fh.fileno())
+
+                # add to common dataset
+                self.dataset.write(self.data_to_df(self._data))
+                if self.aggregator:
+                    self.aggregator.write(self.dataset)
 
-                # reset self._data
+                # reset self._data, data is safe in data file
                 self._data = str()
+                self.wal.truncate()
 
         except Exception as err:
             self.logger.error(err)
@@ -159,6 +228,8 @@ class AE31:
                 with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
                     zf.write(self.data_file, os.path.basename(self.data_file))
                     self.logger.info(f"file staged: {archive}")
+                if self.on_staged:
+                    self.on_staged(archive)
 
         except Exception as err:
             self.logger.error(err)
@@ -218,60 +289,96 @@ class AE31:
         Returns:
             pl.DataFrame: dataframe with header
         """
-        cols = ["dtm","unknown","date","time","UV370","B470","G520","Y590","R660","IR880","IR950","flow",]# "bypass",]
-        cols += ["?370", "sens_zero_370","sens_beam_370","ref_zero_370","ref_beam_370","att_370", ]#"flow_370", "bypass_370",] 
-        cols += ["?470", "sens_zero_470","sens_beam_470","ref_zero_470","ref_beam_470","att_470", ]#"flow_470", "bypass_470",] 
-        cols += ["?520", "sens_zero_520","sens_beam_520","ref_zero_520","ref_beam_520","att_520", ]#"flow_520", "bypass_520",] 
-        cols += ["?590", "sens_zero_590","sens_beam_590","ref_zero_590","ref_beam_590","att_590", ]#"flow_590", "bypass_590",] 
-        cols += ["?660", "sens_zero_660","sens_beam_660","ref_zero_660","ref_beam_660","att_660", ]#"flow_660", "bypass_660",] 
-        cols += ["?880", "sens_zero_880","sens_beam_880","ref_zero_880","ref_beam_880","att_880", ]#"flow_880", "bypass_880",] 
-        cols += ["?950", "sens_zero_950","sens_beam_950","ref_zero_950","ref_beam_950","att_950", ]#"flow_950", "bypass_950",] 
+        try:
+            return _parse_timestamps(pl.read_csv(file, **CSV_OPTIONS))
+        except Exception as err:
+            self.logger.error(err)
 
-        df = pl.DataFrame()
 
-        try:
-            with open(file, "r") as fh:
-                content = fh.read().replace(" ", "").encode()
+    def data_to_df(self, data: str) -> pl.DataFrame:
+        """Parse lines of AE31 data, as saved by _save_data, and return a pl.DataFrame
 
-            df = pl.read_csv(content, has_header=False)
-            df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
-            df.columns = cols
-            df = df.with_columns(pl.col("dtm").str.to_datetime(time_unit='us', time_zone='UTC'),
-                                pl.col("date").str.to_date("%d-%b-%Y").dt.combine(pl.col("time").str.to_time("%H:%M")).alias("dtm_ae31"))
+        Args:
+            data (str): lines of data, each prefixed with the timestamp of the PC
 
-            return df
+        Returns:
+            pl.DataFrame: dataframe with header
+        """
+        try:
+            return _parse_timestamps(pl.read_csv(data.encode(), **CSV_OPTIONS))
         except Exception as err:
             self.logger.error(err)
             
 
-    def compile_data(self, remove_duplicates: bool=True, archive: bool=True) -> pl.DataFrame:
-        """Compile data files and save as .parquet
+    def scan_csv(self, file: str) -> pl.LazyFrame:
+        """Lazily read an AE31 .csv file, as saved by _save_data, with a fixed schema.
+
+        Lines that are not data (the header, and empty records with the time of the PC only) are dropped.
+
+        Args:
+            file (str): full path to file
 
         Returns:
-            pl.DataFrame: compiled data set
+            pl.LazyFrame: columns of COLUMNS, dtm (time of PC, UTC) and dtm_ae31 (time of instrument)
         """
-        df = pl.DataFrame()
+        return _parse_timestamps(pl.scan_csv(file, **CSV_OPTIONS))
 
-        for root, dirs, files in os.walk(self.data_path):
-            for file in files:
-                if df.is_empty():
-                    df = self.csv_to_df(os.path.join(root, file))
-                else:
-                    try:
-                        _ = self.csv_to_df(os.path.join(root, file))
-                        df = pl.concat([df, _], how="diagonal")
-                    except Exception as err:
-                        self.logger.error(f"{file} could not be appended. Error: {err}")
-                        pass
-        if remove_duplicates:
-            df = df.unique()
-        
-        df.sort(by=['dtm_ae31'])
 
-        if archive:
-            df.write_parquet(os.path.join(self.archive_path, 'ae31_nrb.parquet'))
+    def compile_data(self, remove_duplicates: bool=True, archive: bool=True) -> pl.LazyFrame:
+        """Compile all data files, deduplicated and sorted on dtm_ae31.
 
-        return df
+        Files are scanned lazily and, if archive, streamed to self.archive_path/ae31_nrb.parquet, so
+        that memory use does not grow with the size of the archive. A manifest of the files compiled
+        is kept next to it, and a recompile only reads files that are new or have changed since.
+
+        Args:
+            remove_duplicates (bool, optional): Keep one record per dtm_ae31? Defaults to True.
+            archive (bool, optional): Save to .parquet? Defaults to True.
+
+        Returns:
+            pl.LazyFrame: compiled data set; collect() to load it
+        """
+        try:
+            files = sorted(os.path.join(root, file) for root, dirs, files in os.walk(self.data_path)
+                           for file in files if file.lower().endswith('.csv'))
+            target = os.path.join(self.archive_path, 'ae31_nrb.parquet')
+            compiled = archive and os.path.exists(target)
+            if archive:
+                manifest = Manifest(target)
+                files = manifest.changed(files)
+                if compiled and not files:
+                    self.logger.info(f"AE31, {target} is up to date")
+                    return pl.scan_parquet(target)
+            if not files:
+                self.logger.warning(f"AE31, no data files found in {self.data_path}")
+                return pl.LazyFrame(schema=SCHEMA)
+
+            scans = [self.scan_csv(file) for file in files]
+            lf = pl.concat(scans, how="vertical")
+            if compiled:
+                # NB: rows of changed files replace the rows compiled from them before, also if not remove_duplicates
+                archived = pl.scan_parquet(target).join(lf.select("dtm_ae31").unique(), on="dtm_ae31", how="anti")
+                lf = pl.concat([archived, lf], how="vertical")
+            if remove_duplicates:
+                lf = lf.unique(subset=["dtm_ae31"], keep="last")
+            lf = lf.sort(by=["dtm_ae31"])
+
+            if archive:
+                os.makedirs(self.archive_path, exist_ok=True)
+                stats = pl.concat([scan.select(pl.len().alias("rows"),
+                                               pl.col("dtm_ae31").min().alias("first"),
+                                               pl.col("dtm_ae31").max().alias("last")) for scan in scans]).collect()
+                lf.sink_parquet(f"{target}.tmp")
+                os.replace(f"{target}.tmp", target)
+                for file, (rows, first, last) in zip(files, stats.iter_rows()):
+                    manifest.update(file, rows=rows, first=first, last=last)
+                manifest.save()
+                self.logger.info(f"AE31, {len(files)} new or changed files compiled to {target}")
+                return pl.scan_parquet(target)
+            return lf
+
+        except Exception as err:
+            self.logger.error(err)
 
 
     def plot_data(self, filepath: str, save: bool=True):
@@ -1,3 +1,5 @@
+import calendar
+import io
 import logging
 import os
 import time
@@ -10,7 +12,12 @@ import polars as pl
 import schedule
 import serial
 
+from nrbdaq.utils.aggregation import BlockStatistics, open_aggregator
+from nrbdaq.utils.ringbuffer import RingBuffer
+from nrbdaq.utils.serialport import serial_port
+from nrbdaq.utils.storage import DatasetWriter
 from nrbdaq.utils.utils import load_config, setup_logging
+from nrbdaq.utils.wal import open_wal
 
 
 class Aurora3000:
@@ -30,6 +37,8 @@ class Aurora3000:
             self.port = config['Aurora3000']['serial_port']
             self.baudrate = int(config['Aurora3000']['serial_baudrate'])
             self.timeout = float(config['Aurora3000']['serial_timeout'])
+            # NB: the port is kept open; replies are read up to their terminator
+            self.serial = serial_port(self.port, baudrate=self.baudrate, timeout=self.timeout)
             
             # configure data collection
             self.sampling_interval = int(config['Aurora3000']['sampling_interval'])
@@ -42,18 +51,41 @@ class Aurora3000:
             self.data_path = os.path.join(root, config['data'], config['Aurora3000']['data_path'])
             self.staging_path = os.path.join(root, config['staging'], config['Aurora3000']['staging_path'])
             self.remote_path = config['Aurora3000']['remote_path']
+            self.dataset = DatasetWriter(config, 'aurora3000')
            
-            # configure file header
-            self.header = 'dtm,ssp1,ssp2,ssp3,sbsp1,sbsp2,sbsp3,sample_temp,enclosure_temp,RH,pressure,major_state,DIO_state\n'
-
-            # store readings and timestamp
+            # configure statistics of instant readings (every 5 s) per sampling interval, and file header
+            # NB: states are reduced to their mode; columns are means (modes), n, then std, median, min and max per channel
+            channels = ['ssp1', 'ssp2', 'ssp3', 'sbsp1', 'sbsp2', 'sbsp3', 'sample_temp', 'enclosure_temp', 'RH', 'pressure', 'major_state', 'DIO_state']
+            self.minute = BlockStatistics(capacity=2 * self.sampling_interval * 60 // 5, channels=channels,
+                                          states=['major_state', 'DIO_state'])
+            self.header = f"dtm,{','.join(self.minute.columns)}\n"
+            self._formats = ['.0f' if column in self.minute.states + ['n'] else '.3f' for column in self.minute.columns]
+            self.aggregator = open_aggregator(config, 'aurora3000', channels)
+
+            # store statistics per sampling interval in a columnar buffer
             # initialize data response and datetime stamp           
-            self._instant_readings = []
-            self._dio_states = []
+            self.buffer = RingBuffer(capacity=2 * self.reporting_interval // self.sampling_interval + 1,
+                                     width=len(self.minute.columns))
             self._last_timestamp = None
             self._data = str()
             self._dtm = None
             self.data_file = str()
+            # callback notified of staged files, e.g., TransferService.stage
+            self.on_staged = None
+
+            # write-ahead log of self._data; replay data not saved before a crash or power cut
+            self.wal = open_wal(config, 'aurora3000')
+            for record in self.wal.replay():
+                line = record.decode('utf-8')
+                # NB: skip lines that do not match the columns, e.g., written by an earlier version
+                try:
+                    dtm, *values = line.strip().split(',')
+                    if len(values) != len(self.minute.columns):
+                        raise ValueError(f"{len(values)} values, expected {len(self.minute.columns)}")
+                    self.buffer.append(np.array(values, dtype=float), timestamp=calendar.timegm(datetime.fromisoformat(dtm).timetuple()))
+                    self._data += line
+                except ValueError as err:
+                    self.logger.warning(f"WAL record skipped ({err}): {line.strip()}")
 
         except serial.SerialException as err:
             self.logger.error(f"Serial communication error: {err}")
@@ -93,17 +125,14 @@ class Aurora3000:
             self.logger.error(err)
 
 
-    def serial_comm(self, cmd: str, sep: str=',') -> str:
+    def serial_comm(self, cmd: str, sep: str=',', idle: float=None) -> str:
+        """Send cmd and return the reply, read up to its terminator '\\r\\n'.
+
+        Replies of several lines (e.g., '***D') are read until the instrument has been silent for idle seconds.
+        """
         try:
-            data = bytes()
-            with serial.Serial(self.port, self.baudrate, 8, 'N', 1, self.timeout) as ser:
-                ser.write(f"{cmd}\r".encode())
-                time.sleep(0.2)
-                while ser.in_waiting > 0:
-                    data += ser.read(1024)
-                    time.sleep(0.1)
-                data = data.decode("utf-8")
-                data = data.replace('\r\n\n', '\r\n').replace(", ", ",").replace(",", sep)
+            data = self.serial.command(f"{cmd}\r", terminator=b'\r\n', idle=idle).decode("utf-8")
+            data = data.replace('\r\n\n', '\r\n').replace(", ", ",").replace(",", sep)
             return data
         except Exception as err:
             self.logger.error(err)
@@ -111,7 +140,7 @@ class Aurora3000:
 
     def read_new_data(self, sep: str=',') -> str:
         try:
-           return self.serial_comm('***D')
+           return self.serial_comm('***D', idle=0.2)
         except Exception as err:
             self.logger.error(err)
 
@@ -160,12 +189,14 @@ class Aurora3000:
 
 
     def accumulate_instant_readings(self) -> None:
-        """Collects a single reading and appends it to the self._instant_readings list."""
+        """Collects a single reading and adds it to self.minute."""
         try:
             reading_str = self.get_current_data()  # Assuming get_readings returns a string
             timestamp, values = self.parse_current_data(reading_str)
             self._last_timestamp = timestamp
-            self._instant_readings.append(values)
+            self.minute.add(values)
+            if self.aggregator:
+                self.aggregator.add(values, calendar.timegm(timestamp.timetuple()))
             self.logger.debug(reading_str)
         except Exception as err:
             self.logger.error(err)
@@ -173,25 +204,22 @@ class Aurora3000:
 
     def accumulate_averages(self) -> None:
         """
-        Computes the average of the collected self._instant_readings and appends the result to self._data.
-        The timestamp for the average is the last timestamp of the instant readings, rounded to a full minute.
+        Reduces the instant readings in self.minute to their statistics, adds them to self.buffer and appends them to self._data.
+        The timestamp is the last timestamp of the instant readings, rounded to a full minute.
         """
         try:
-            if self._instant_readings:
-                # Stack self._instant_readings and compute mean across columns
-                readings_array = np.stack(self._instant_readings)
-                averages = np.mean(readings_array, axis=0)
-                
+            if len(self.minute):
                 # Round the last timestamp to the nearest full minute
                 dtm = self._round_to_full_minute(self._last_timestamp)
-                
-                # Clear the self._instant_readings for the next 1-minute collection
-                self._instant_readings = []
-                
-                # Return the rounded timestamp followed by the averaged values
-                current_averages = ",".join(f"{avg:.3f}" for avg in averages)
-                # self._data = f"{self._data}{dtm.strftime('%Y-%m-%d %H:%M:%S')},{current_averages}\n"
+
+                # Reduce readings to statistics, written to the next row of self.buffer; this empties self.minute
+                row = self.buffer.slot()
+                self.minute.reduce(row)
+                self.buffer.commit(calendar.timegm(dtm.timetuple()))
+
+                current_averages = ",".join(f"{value:{fmt}}" for value, fmt in zip(row, self._formats))
                 self._data = f"{self._data}{dtm.isoformat(timespec='seconds')},{current_averages}\n"
+                self.wal.append(f"{dtm.isoformat(timespec='seconds')},{current_averages}\n")
                 self.logger.info(f"Aurora3000, {current_averages[:60]}[...]")
             return
 
@@ -221,14 +249,24 @@ class Aurora3000:
                 if os.path.exists(self.data_file):
                     with open(file=data_file, mode='a') as fh:
                         fh.write(self._data)
+                        fh.flush()
+                        os.fsync(fh.fileno())
                 else:
                     with open(file=data_file, mode='w') as fh:
                         fh.write(self.header)
                         fh.write(self._data)
+                        fh.flush()
+                        os.fsync(fh.fileno())
                 self.logger.info(f"file saved: {data_file}")
+
+                # add to common dataset
+                self.dataset.write(self.buffer_to_df())
+                if self.aggregator:
+                    self.aggregator.write(self.dataset)
             
-                # reset self._data
+                # reset self._data, data is safe in data file
                 self._data = str()
+                self.wal.truncate()
 
             self.data_file = data_file
             return
@@ -237,6 +275,22 @@ class Aurora3000:
             self.logger.error(err)
 
 
+    def buffer_to_df(self) -> pl.DataFrame:
+        """Drain self.buffer and return its rows as a pl.DataFrame with the columns of self.header."""
+        times, rows = self.buffer.drain()
+        df = pl.DataFrame({'dtm': times, **dict(zip(self.minute.columns, rows.T))})
+        return df.with_columns(pl.from_epoch(pl.col('dtm').round(), time_unit='s').dt.cast_time_unit('us'),
+                               pl.col(['n'] + self.minute.states).cast(pl.Int64))
+
+
+    def data_to_df(self, data: str) -> pl.DataFrame:
+        """Parse lines of averages, as saved by _save_data, and return a pl.DataFrame with the columns of self.header."""
+        try:
+            return pl.read_csv(io.StringIO(f"{self.header}{data}"))
+        except Exception as err:
+            self.logger.error(err)
+
+
     def _stage_file(self):
         """ Create zip file from self.data_file and stage archive.
         """
@@ -248,6 +302,8 @@ class Aurora3000:
                 with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
                     zf.write(self.data_file, os.path.basename(self.data_file))
                     self.logger.info(f"file staged: {archive}")
+                if self.on_staged:
+                    self.on_staged(archive)
 
         except Exception as err:
             self.logger.error(err)
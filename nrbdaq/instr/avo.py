@@ -5,6 +5,9 @@ import json
 import polars as pl
 import requests
 import shutil
+from typing import Callable
+
+from nrbdaq.utils.storage import DatasetWriter, Manifest
 
 keys = ['instant', 'hourly', 'daily', 'monthly']
 
@@ -54,7 +57,8 @@ def flatten_data(data: dict, parent_key='', sep='_') -> dict:
 
 
 def data_to_dfs(data: dict, file_path: str=str(),
-                append: bool=True, remove_duplicates: bool=True, staging: str=str()) -> tuple[str, dict]:
+                append: bool=True, remove_duplicates: bool=True, staging: str=str(),
+                on_staged: Callable[[str], None]=None, dataset: DatasetWriter=None) -> tuple[str, dict]:
     """
     Saves a flattened dictionary as polars DataFrame. 
     A column dtm (pl.Datetime) is added. Numerical values are all cast to pl.Float32. Otherwise, the original format is preserved.
@@ -65,6 +69,8 @@ def data_to_dfs(data: dict, file_path: str=str(),
         append (bool, optional): Should existing .parquet files be appended? Defaults to True.
         remove_duplicates (bool, optional): Should duplicates be removed? Defaults to True.
         staging (str, optional): Path to staging directory. Defaults to str() (= no staging).
+        on_staged (Callable, optional): Called with the path of each staged file. Defaults to None.
+        dataset (DatasetWriter, optional): Common dataset to merge data into, as instrument 'avo_<key>'. Defaults to None.
 
     Returns:
         tuple[str, dict]: station name, dictionary of the various data sets
@@ -103,59 +109,88 @@ def data_to_dfs(data: dict, file_path: str=str(),
             value = value.sort(by=pl.col('dtm'))
             value.write_parquet(file)
 
+            if dataset:
+                dataset.write(value, instrument=f"avo_{key}", file=station)
+
             if staging:
                 os.makedirs(os.path.join(os.path.expanduser(staging)), exist_ok=True)
-                shutil.copy(src=file, dst=os.path.join(os.path.expanduser(staging), os.path.basename(file)))
+                staged = shutil.copy(src=file, dst=os.path.join(os.path.expanduser(staging), os.path.basename(file)))
+                if on_staged:
+                    on_staged(staged)
 
     return station, result
 
 
-def download_multiple(urls: dict, file_path: str, staging: str=str()):
+def download_multiple(urls: dict, file_path: str, staging: str=str(), on_staged: Callable[[str], None]=None,
+                      dataset: DatasetWriter=None):
     all = list()
     for key, url in urls.items():
         print(f"retrieving from {key}")
         data = download_data(url=url)
-        dfs = data_to_dfs(data=data, file_path=file_path, staging=staging)
+        dfs = data_to_dfs(data=data, file_path=file_path, staging=staging, on_staged=on_staged, dataset=dataset)
         if dfs:
             all.append(dfs)
     return all
 
 
-def compile_data(stations: list[str], source: str, target:str=str(), archive: bool=True) -> dict:
-    _ = dict(zip(keys, [pl.DataFrame(schema=dict([('ts', pl.String),
-                                                   ('co2', pl.Float32),
-                                                   ('pm1', pl.Float32),
-                                                   ('pr', pl.Float32),
-                                                   ('hm', pl.Float32),
-                                                   ('tp', pl.Float32),
-                                                   ('pm25_aqius', pl.Float32),
-                                                   ('pm25_aqicn', pl.Float32),
-                                                   ('pm25_conc', pl.Float32),
-                                                   ('pm10_aqius', pl.Float32),
-                                                   ('pm10_aqicn', pl.Float32),
-                                                   ('pm10_conc', pl.Float32),
-                                                   ('dtm', pl.Datetime(time_unit='us', time_zone='UTC'))]),
-                                                   )] * 4))
-
-    dfs = dict([(station, _) for station in stations])
+def read_data_file(file: str) -> pl.DataFrame:
+    """Read an AVO .parquet file with columns as in compiled files: dtm, Float32 values, no AQI columns."""
+    df = pl.read_parquet(file)
+    df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
 
-    for root, dirs, files in os.walk(source):
-        for file in files:
-            if any(station in file for station in stations):
-                df = pl.read_parquet(os.path.join(root, file))
-                df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
+    # Some files have ts converted to Datetime already, with or without a dtm column, so we need to make sure these files can be imported.
+    if df['ts'].dtype==pl.Datetime:
+        df = df.rename({'ts': 'dtm'})
+    elif ('dtm' in df.columns and all(df['dtm'].is_null())) or ('dtm' not in df.columns):
+        df = df.with_columns(pl.col("ts").str.to_datetime().alias('dtm'))
+        df = df.drop('ts')
 
-                # Some files have ts converted to Datetime already, with or without a dtm column, so we need to make sure these files can be imported.
-                if df['ts'].dtype==pl.Datetime:
-                    df = df.rename({'ts': 'dtm'})
-                elif ('dtm' in df.columns and all(df['dtm'].is_null())) or ('dtm' not in df.columns):
-                    df = df.with_columns(pl.col("ts").str.to_datetime().alias('dtm'))
-                    df = df.drop('ts')
+    # rename columns, drop AQI columns
+    df = df.rename({'pm25_conc': 'pm25', 'pm10_conc': 'pm10'})
+    return df.drop(['pm25_aqius', 'pm25_aqicn', 'pm10_aqius', 'pm10_aqicn'])
 
-                # rename columns, drop AQI columns
-                df = df.rename({'pm25_conc': 'pm25', 'pm10_conc': 'pm10'})            
-                df = df.drop(['pm25_aqius', 'pm25_aqicn', 'pm10_aqius', 'pm10_aqicn'])
 
+def compile_data(stations: list[str], source: str, target:str=str(), archive: bool=True) -> dict:
+    """Compile AVO data files by station and data type (instant, hourly, daily, monthly).
+
+    If target is given, the compiled data are saved as <target>/<station>_<data type>_avo_compiled.parquet,
+    with a manifest of the files compiled into each. A recompile then only reads the files that are new
+    or have changed since, and merges them into the compiled data.
+
+    Args:
+        stations (list[str]): station names, as used in file names
+        source (str): folder of data files
+        target (str, optional): folder of compiled files. Defaults to str() (= not saved).
+        archive (bool, optional): Defaults to True.
+
+    Returns:
+        dict: {station: {data type: pl.DataFrame}}, deduplicated and sorted on dtm
+    """
+    schema = dict([('ts', pl.String),
+                   ('co2', pl.Float32),
+                   ('pm1', pl.Float32),
+                   ('pr', pl.Float32),
+                   ('hm', pl.Float32),
+                   ('tp', pl.Float32),
+                   ('pm25', pl.Float32),
+                   ('pm10', pl.Float32),
+                   ('dtm', pl.Datetime(time_unit='us', time_zone='UTC'))])
+    dfs = dict()
+    manifests = dict()
+    for station in stations:
+        dfs[station] = dict()
+        for key in keys:
+            dfs[station][key] = pl.DataFrame(schema=schema)
+            if target:
+                compiled = os.path.join(target, f"{station}_{key}_avo_compiled.parquet")
+                manifests[(station, key)] = Manifest(compiled)
+                if os.path.exists(compiled):
+                    dfs[station][key] = pl.read_parquet(compiled)
+
+    changed = set()
+    for root, dirs, files in os.walk(source):
+        for file in sorted(files):
+            if any(station in file for station in stations):
                 basename_parts = file.split('.')[0].split('_')
                 
                 # Handle the case where an underscore is present as the last character before the extension
@@ -165,18 +200,31 @@ def compile_data(stations: list[str], source: str, target:str=str(), archive: bo
                 n = len(basename_parts)
                 station = "_".join(basename_parts[:(n-2)])
                 data_type = basename_parts[n-1].split('-')[0]
-                
-                # append and sort data by dtm, remove duplicates
+
+                path = os.path.join(root, file)
+                manifest = manifests.get((station, data_type))
+                if manifest is not None and not manifest.changed([path]):
+                    continue
+
+                # append data, remove duplicates (keeping the rows read last) and sort by dtm
                 try:
-                    dfs[station][data_type] = pl.concat([dfs[station][data_type], df], how = 'diagonal').sort(by='dtm').unique()
+                    df = read_data_file(path)
+                    dfs[station][data_type] = pl.concat([dfs[station][data_type], df], how='diagonal_relaxed') \
+                        .unique(subset='dtm', keep='last', maintain_order=True).sort(by='dtm')
+                    if manifest is not None:
+                        manifest.update(path, rows=df.height, first=df['dtm'].min(), last=df['dtm'].max())
+                        changed.add((station, data_type))
                     # print(f"Appended data from '{file}'.")
                 except Exception as err:
                     print(f"Failed to append data from '{file}'. Error: {err}")
                     pass
 
-        if target:
-            for station, data in dfs.items():
-                for key, df in data.items():
-                    data[key].write_parquet(os.path.join(target, f"{station}_{key}_avo_compiled.parquet"))
+    if target:
+        os.makedirs(target, exist_ok=True)
+        for station, data_type in sorted(changed):
+            file = os.path.join(target, f"{station}_{data_type}_avo_compiled.parquet")
+            dfs[station][data_type].write_parquet(f"{file}.tmp")
+            os.replace(f"{file}.tmp", file)
+            manifests[(station, data_type)].save()
 
     return dfs
@@ -1,12 +1,111 @@
-import socket
+import shutil
+import numpy as np
 import polars as pl
 import datetime
+import json
 import schedule
 import time
 from pathlib import Path
 from typing import Any
 # import logging
+from nrbdaq.utils.aggregation import Aggregator, P2Quantile, open_aggregator
+from nrbdaq.utils.ringbuffer import RingBuffer, nanmedian
+from nrbdaq.utils.storage import DatasetWriter, IncrementalWriter, pending_writers
+from nrbdaq.utils.udpreceiver import UDPReceiver
 from nrbdaq.utils.utils import setup_logging
+from nrbdaq.utils.wal import open_wal
+
+
+class SendValParser:
+    """
+    Parse FIDAS sendVal records, e.g., b'6082<sendVal 0=0.0;1=1.0;...;74=0.0>3E', without decoding them.
+
+    The channel numbers of the first record parsed are compiled into a schema that maps each channel
+    to a fixed column slot. Values of subsequent records are written straight into a preallocated
+    float row. As long as a record lists the same channels in the same order (the normal case), this
+    costs one split and one float conversion per value; otherwise, values are placed by channel, channels
+    missing are set to NaN, and channels not in the schema are ignored. A record with a pair that has
+    no '=' is malformed.
+    """
+    _PREFIX = b'sendVal'
+
+    def __init__(self, channels: list[str]=None):
+        """
+        Args:
+            channels (list[str], optional): channel numbers. Defaults to None (= learn from first record).
+        """
+        self.channels = list()
+        self._keys = list()
+        self._slots = dict()
+        self.row = np.empty(0)
+        if channels:
+            self.compile([str(c).encode('ascii') for c in channels])
+
+
+    def compile(self, keys: list[bytes]) -> None:
+        """Set the schema: channel keys, in the order of their column slots."""
+        self._keys = list(keys)
+        self._slots = {key: i for i, key in enumerate(self._keys)}
+        self.channels = [key.decode('ascii') for key in self._keys]
+        self.row = np.full(len(self._keys), np.nan)
+
+
+    def parse_into(self, record: bytes, row: np.ndarray=None) -> tuple[int, str]:
+        """Parse a record and write its values into row.
+
+        Args:
+            record (bytes): raw record (bytes, bytearray or memoryview)
+            row (np.ndarray, optional): float array of len(self.channels). Defaults to None (= self.row).
+
+        Raises:
+            ValueError: if record is not a sendVal record, or a pair has no '='
+
+        Returns:
+            tuple[int, str]: id and checksum of record
+        """
+        if not isinstance(record, bytes):
+            record = bytes(record)
+        start = record.index(b'<')
+        end = record.index(b'>', start)
+        payload = record[start + 1:end]
+        if payload.startswith(self._PREFIX):
+            payload = payload[len(self._PREFIX):]
+        pairs = payload.strip().split(b';')
+        if pairs[-1] == b'':
+            pairs.pop()
+        keys, values = list(), list()
+        for pair in pairs:
+            # NB: a pair without value would otherwise shift all later values to the wrong channel
+            key, sep, value = pair.partition(b'=')
+            if not sep:
+                raise ValueError(f"pair without '=': {pair!r}")
+            keys.append(key.strip())
+            values.append(value)
+
+        # NB: the schema is only learnt from a record that parsed
+        if not self._keys:
+            self.compile(keys)
+        if row is None:
+            row = self.row
+
+        try:
+            if keys == self._keys:
+                row[:] = list(map(float, values))
+            else:
+                raise ValueError
+        except ValueError:
+            # keys differ from schema, or a value is not a number: place values one by one
+            row.fill(np.nan)
+            for key, value in zip(keys, values):
+                slot = self._slots.get(key)
+                if slot is not None:
+                    try:
+                        row[slot] = float(value)
+                    except ValueError:
+                        pass
+
+        return int(record[:start]), record[end + 1:].strip().decode('ascii', errors='ignore')
+
 
 class FIDAS:
     def __init__(
@@ -15,6 +114,7 @@ class FIDAS:
         name: str='fidas',
     ):
         self.name = name
+        self.config = config
 
         # configure logging
         logfile = Path(config['root']).expanduser() / config['logging']['file']
@@ -29,16 +129,51 @@ class FIDAS:
         self.remote_path = config[name]['remote_path']
         self.fetch_interval_seconds = int(config[name]['fetch_interval_seconds'])
         self.reporting_interval = config[name]['reporting_interval']
+        # NB: minute rows are appended to the hourly file every flush_interval_minutes; the file is finalized after the hour
+        self.flush_interval_minutes = int(config[name].get('flush_interval_minutes', 10))
         self.local_ip = config[name]['socket']['host']
         self.local_port = config[name]['socket']['port']
         self.buffer_size = config[name]['socket']['buffer_size']
-
-        self.sock = None
-        self.buffer = ""
-        self.raw_records: list[dict[str, Any]] = []
+        # NB: datagrams are received by a thread as they arrive; collect_raw_record parses them every fetch_interval_seconds
+        self.rcvbuf = int(config[name]['socket'].get('rcvbuf', 1048576))
+        self.queue_size = int(config[name]['socket'].get('queue_size', 3600))
+        self.dataset = DatasetWriter(config, name)
+        # NB: raw records kept in memory; default covers 10 minutes at 1 record per second, in case compute_minute_median runs late
+        self.buffer_rows = int(config[name].get('buffer_rows', 600))
+        # NB: 'exact' computes minute medians from the raw records, 'p2' estimates them as records arrive (constant memory)
+        self.minute_median_method = config[name].get('minute_median', 'exact')
+
+        self.receiver: UDPReceiver | None = None
+        # callback notified of staged files, e.g., TransferService.stage
+        self.on_staged = None
+        self.parser = SendValParser()
+        self.parsed = 0
+        self.malformed = 0
+        # rows x channels, allocated once the channels are known from the first record
+        self.raw_records: RingBuffer | None = None
+        # streaming aggregation of raw records, set up with raw_records
+        self.aggregator: Aggregator | None = None
+        # streaming estimate of the minute median, set up with raw_records if minute_median_method is 'p2'
+        self.minute_median: P2Quantile | None = None
         self.df_minute = pl.DataFrame()
         self.current_hour = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
 
+        # write-ahead log of self.df_minute; replay rows not saved before a crash or power cut
+        self.wal = open_wal(config, name)
+        self.replay_wal()
+
+    def replay_wal(self):
+        records = [json.loads(record) for record in self.wal.replay()]
+        if records:
+            df = pl.DataFrame(records).with_columns(
+                pl.col("dtm").str.to_datetime(time_unit="us", time_zone="UTC"),
+                pl.lit("median").alias("id"),
+                pl.lit("").alias("checksum"))
+            self.df_minute = df.select(sorted(df.columns))
+            # NB: keep the hour of the replayed rows open until they are saved
+            self.current_hour = self.df_minute["dtm"].min().replace(minute=0, second=0, microsecond=0)
+            self.logger.info(f"[.replay_wal] {len(records)} rows recovered", extra={'to_logfile': True})
+
     def __enter__(self):
         try:
             self.connect_udp()
@@ -48,42 +183,29 @@ class FIDAS:
             self.logger.error(f"[FIDAS.__enter__] {err} {self.local_ip}:{self.local_port}")
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.sock:
-            self.sock.close()
+        if self.receiver:
+            self.receiver.stop(timeout=5)
             if not self.df_minute.is_empty():
                 self.save_hourly()
         self.logger.info("[FIDAS.__exit__] Goodbye!", extra={'to_logfile': True})
 
     def connect_udp(self):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.bind((self.local_ip, self.local_port))
+            self.receiver = UDPReceiver((self.local_ip, self.local_port), self.config, buffer_size=self.buffer_size,
+                                        rcvbuf=self.rcvbuf, queue_size=self.queue_size)
+            self.receiver.start()
             self.logger.info(f"[FIDAS.__enter__] Listening on {self.local_ip}:{self.local_port}")
             return
         except Exception as err:
             self.logger.error(f"[.connect_udp] {err}")
 
-    def receive_udp_record(self) -> str:
-        if self.sock is None:
-            return str()
-        try:
-            self.sock.settimeout(self.fetch_interval_seconds)
-            while True:
-                data, _ = self.sock.recvfrom(self.buffer_size)
-                self.buffer += data.decode('ascii', errors='ignore')
-                if '>' in self.buffer:
-                    raw_record = self.buffer
-                    self.buffer = str()
-                    return raw_record
-            # data, _ = self.sock.recvfrom(self.buffer_size)
-            # self.buffer += data.decode('ascii', errors='ignore')
-            # if '>' in self.buffer:
-            #     raw, self.buffer = self.buffer.split('>', 1)
-            #     print(raw)
-            #     return raw + '>'
-        except socket.timeout:
-            pass
-        return str()
+    def status(self) -> dict:
+        """Return numbers of datagrams received and dropped, and of records parsed and malformed."""
+        status = self.receiver.status() if self.receiver else dict()
+        return dict(status, parsed=self.parsed, malformed=self.malformed)
+
+    def log_status(self):
+        self.logger.info(f"[.log_status] {self.status()}", extra={'to_logfile': True})
 
     def parse_record(self, record: str) -> "dict[str, Any]":
         self.logger.debug("[.parse_record] entering function")
@@ -113,16 +235,48 @@ class FIDAS:
             return {}
 
     def collect_raw_record(self):
+        """Parse the records received since the last call into self.raw_records."""
         self.logger.debug("[.collect_raw_record] entering ...")
-        record = self.receive_udp_record()
-        self.logger.debug(f"[.collect_raw_record] {record[:100]}")
-        if record:
-            parsed = self.parse_record(record)
-            if parsed:
-                self.raw_records.append(parsed)
-                self.logger.debug(f"[.collect_raw_record] raw_record appended")
+        records = self.receiver.drain() if self.receiver else list()
+        if not records:
+            self.logger.warning(f"[.collect_raw_record] no record received")
+            return
+        for arrival, record in records:
+            self.logger.debug(f"[.collect_raw_record] {record[:100]}")
+            try:
+                self.add_raw_record(record, arrival)
+                self.parsed += 1
+            except ValueError as err:
+                self.malformed += 1
+                self.logger.error(f"[.collect_raw_record] failed to parse record: {err}")
+        self.logger.debug(f"[.collect_raw_record] {len(records)} raw_records appended")
+
+    def add_raw_record(self, record: bytes, timestamp: float):
+        """Parse a sendVal record into self.raw_records, and feed it to the minute median and the aggregator.
+
+        Args:
+            record (bytes): sendVal record
+            timestamp (float): time of arrival [s since epoch]
+
+        Raises:
+            ValueError: if the record cannot be parsed
+        """
+        if self.raw_records is None:
+            self.parser.parse_into(record)
+            self.raw_records = RingBuffer(capacity=self.buffer_rows, width=len(self.parser.channels))
+            self.aggregator = open_aggregator(self.config, self.name, self.parser.channels)
+            if self.minute_median_method == 'p2':
+                self.minute_median = P2Quantile(len(self.parser.channels), q=0.5)
+            row = self.parser.row
+            self.raw_records.append(row, timestamp=timestamp)
         else:
-            self.logger.warning(f"[.collect_raw_record] raw_record is empty")
+            row = self.raw_records.slot()
+            self.parser.parse_into(record, row)
+            self.raw_records.commit(timestamp)
+        if self.minute_median is not None:
+            self.minute_median.add(row)
+        if self.aggregator:
+            self.aggregator.add(row, timestamp)
 
     def compute_minute_median(self):
         self.logger.debug("[.compute_minute_median] entering ...")
@@ -130,30 +284,22 @@ class FIDAS:
             self.logger.debug("[.compute_minute_median] self.raw_records is empty.")
             return
 
-        # Defensive check
-        if not all(isinstance(row, dict) for row in self.raw_records):
-            self.logger.error(f"[.compute_minute_median] Invalid format in raw_records: {self.raw_records}")
-            return
-
-        df = pl.DataFrame(self.raw_records)
-        value_cols = [col for col in df.columns if col not in {"id", "checksum"} and df.schema[col] in {pl.Float64, pl.Float32}]
-
-        median_row = df.select([pl.median(col).alias(col) for col in value_cols])
+        _, rows = self.raw_records.drain()
+        if self.minute_median is not None:
+            medians = np.empty(len(self.parser.channels))
+            self.minute_median.result(medians)
+            self.minute_median.reset()
+        else:
+            medians = nanmedian(rows)
         now = datetime.datetime.now(datetime.timezone.utc)
 
-        median_row = median_row.with_columns([
-            pl.lit("median").alias("id"),
-            pl.lit("").alias("checksum"),
-            pl.lit(now).cast(pl.Datetime("us", "UTC")).alias("dtm")
-        ])
-
-        for col in df.columns:
-            if col not in median_row.columns:
-                median_row = median_row.with_columns(pl.lit(None).alias(col))
-
+        values = dict(zip(self.parser.channels, medians.tolist()))
+        row = {col: [val] for col, val in values.items()}
+        row.update(id=["median"], checksum=[""], dtm=[now])
+        median_row = pl.DataFrame(row).with_columns(pl.col("dtm").cast(pl.Datetime("us", "UTC")))
         median_row = median_row.select(sorted(median_row.columns))
         self.df_minute = pl.concat([self.df_minute, median_row], how="diagonal")
-        self.raw_records.clear()
+        self.wal.append(json.dumps({"dtm": now.isoformat(), **values}))
 
         # Fidas parameter map
         map = {'60': "Cn [P/cm³]",
@@ -163,28 +309,48 @@ class FIDAS:
                '64': "PM10 [mg/m³]",
                '65': "PMtotal [mg/m³]",
         }
-        values = {lbl: median_row[0, col] for col, lbl in map.items()}
+        values = {lbl: values.get(col) for col, lbl in map.items()}
         self.logger.info(f"[.compute_minute_median] row added: {values}")
         # self.logger.info(f"[.compute_minute_median] row added: {str(median_row.to_dicts()[0])[:80]}[...]")
         self.logger.debug(f"[.compute_minute_median] {median_row}")
 
     def save_hourly(self, stage:bool=True):
+        """Append the minute rows to the files of the hours they were recorded in, and finalize the files of past hours."""
         self.logger.debug("[.save_hourly] entering ...")
         now = datetime.datetime.now(datetime.timezone.utc)
-        if now.hour != self.current_hour.hour:
-            if not self.df_minute.is_empty():
-                out_path = self.ensure_output_path(self.current_hour)
-                if out_path.exists():
-                    existing = pl.read_parquet(out_path)
-                    self.df_minute = pl.concat([existing, self.df_minute], how="diagonal").unique()
-                self.df_minute.write_parquet(out_path)
-                if stage:
-                    self.staging_path.mkdir(parents=True, exist_ok=True)
-                    staging_path = self.staging_path / out_path.name
-                    self.df_minute.write_parquet(staging_path)
-                self.logger.debug(f"[.save_hourly] hourly file saved to {out_path} and staged to {staging_path}")
+        if not self.df_minute.is_empty():
+            # NB: flushes are not aligned to the hour, so the rows of a flush may belong to two hours
+            for (hour, ), rows in self.df_minute.group_by(pl.col("dtm").dt.truncate("1h").alias("hour"), maintain_order=True):
+                part = IncrementalWriter(self.ensure_output_path(hour), key="dtm").append(rows)
+                self.logger.debug(f"[.save_hourly] rows appended to {part}")
+            self.dataset.write(self.df_minute.drop(["id", "checksum"]))
             self.df_minute = pl.DataFrame()
-            self.current_hour = now.replace(minute=0, second=0, microsecond=0)
+            self.wal.truncate()
+        if self.aggregator:
+            self.aggregator.write(self.dataset)
+        self.current_hour = now.replace(minute=0, second=0, microsecond=0)
+        current = self.ensure_output_path(self.current_hour)
+        for writer in pending_writers(self.data_dir, key="dtm"):
+            if writer.path != current:
+                self.finalize_hourly(writer, stage=stage)
+
+    def finalize_hourly(self, writer: IncrementalWriter, stage:bool=True):
+        out_path = writer.finalize()
+        if out_path and stage:
+            self.staging_path.mkdir(parents=True, exist_ok=True)
+            staging_path = self.staging_path / out_path.name
+            shutil.copyfile(out_path, staging_path)
+            if self.on_staged:
+                self.on_staged(staging_path)
+            self.logger.debug(f"[.finalize_hourly] hourly file saved to {out_path} and staged to {staging_path}")
+
+    def finalize_pending(self):
+        """Finalize hourly files of past hours left unfinished, e.g., by a crash."""
+        current = self.ensure_output_path(self.current_hour)
+        for writer in pending_writers(self.data_dir, key="dtm"):
+            if writer.path != current:
+                self.logger.info(f"[.finalize_pending] {writer.path}")
+                self.finalize_hourly(writer)
 
     def ensure_output_path(self, dt: datetime.datetime) -> Path:
         folder = self.data_dir / f"{dt.year:04d}" / f"{dt.month:02d}" / f"{dt.day:02d}"
@@ -195,7 +361,9 @@ class FIDAS:
     def setup_schedules(self):
         schedule.every(self.fetch_interval_seconds).seconds.do(self.collect_raw_record)
         schedule.every(1).minutes.do(self.compute_minute_median)
-        schedule.every(1).hours.do(self.save_hourly)
+        schedule.every(self.flush_interval_minutes).minutes.do(self.save_hourly)
+        schedule.every(10).minutes.do(self.log_status)
+        self.finalize_pending()
         return
 
 
@@ -5,16 +5,112 @@ Define a class TEI49I facilitating communication with a Thermo TEI49i instrument
 @author: joerg.klausen@meteoswiss.ch
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import itertools
+import calendar
+import json
 import logging
+import math
+from pathlib import Path
+import re
 # import shutil
-import socket
 # import re
 # import serial
 import schedule
 import time
 import zipfile
 import colorama
+import numpy as np
+import polars as pl
+
+from nrbdaq.utils.aggregation import open_aggregator
+from nrbdaq.utils.ringbuffer import RingBuffer
+from nrbdaq.utils.storage import DatasetWriter, IncrementalWriter
+from nrbdaq.utils.tcpclient import TCPClient
+from nrbdaq.utils.wal import open_wal
+
+# fields of an lrec record (lrec format 0), in order
+LREC_COLUMNS = ['time', 'date', 'flags', 'o3', 'hio3', 'cellai', 'cellbi', 'bncht', 'lmpt', 'o3lt', 'flowa', 'flowb', 'pres']
+
+
+def parse_lrec(data: str) -> pl.DataFrame:
+    """Parse lrec records (lrec format 0, with or without labels) into typed columns.
+
+    Lines that are not records (e.g., the echo of the command) are dropped.
+
+    Args:
+        data (str): responses to lrec commands, one record per line
+
+    Returns:
+        pl.DataFrame: dtm (time of instrument), flags (UInt32), and the values of LREC_COLUMNS as Float32
+    """
+    # NB: labels, if any, precede their values; dropping them leaves the fields of format 0 without labels
+    tokens = pl.Series('line', data.splitlines()).str.extract_all(r'\S+') \
+        .list.eval(pl.element().filter(~pl.element().is_in(LREC_COLUMNS[2:])))
+    tokens = tokens.filter(tokens.list.len()==len(LREC_COLUMNS))
+    df = tokens.list.to_struct(fields=LREC_COLUMNS).struct.unnest()
+    return df.select(pl.concat_str(['date', 'time'], separator=' ').str.to_datetime('%m-%d-%y %H:%M', strict=False).alias('dtm'),
+                     pl.col('flags').str.to_integer(base=16, strict=False).cast(pl.UInt32),
+                     pl.col(LREC_COLUMNS[3:]).cast(pl.Float32, strict=False))
+
+
+class LrecParser:
+    """
+    Parse single lrec records (e.g., the response to lr00) with a precompiled regular expression.
+
+    Fields are written to a row of floats: dtm_49i (time of instrument, as seconds since the epoch
+    of the naive time), flags and the values of LREC_COLUMNS[3:], i.e., the columns of self.columns.
+    """
+
+    def __init__(self):
+        fields = [r'(\d{2}):(\d{2})', r'(\d{2})-(\d{2})-(\d{2})', r'(?:flags\s+)?([0-9A-Fa-f]{1,8})']
+        fields += [rf'(?:{name}\s+)?(\S+)' for name in LREC_COLUMNS[3:]]
+        self.pattern = re.compile(r'\s+'.join(fields))
+        self.columns = ['dtm_49i', 'flags'] + LREC_COLUMNS[3:]
+
+
+    def parse_into(self, record: str, row: np.ndarray) -> str:
+        """Write the fields of record to row.
+
+        Args:
+            record (str): lrec record, with or without labels
+            row (np.ndarray): row of len(self.columns) floats
+
+        Raises:
+            ValueError: if record is not an lrec record
+
+        Returns:
+            str: fields of the record without labels, separated by blanks
+        """
+        match = self.pattern.search(record)
+        if match is None:
+            raise ValueError(f"not an lrec record: '{record[:60]}'")
+        hh, mi, mm, dd, yy, flags, *values = match.groups()
+        row[0] = calendar.timegm((2000 + int(yy), int(mm), int(dd), int(hh), int(mi), 0))
+        row[1] = int(flags, 16)
+        row[2:] = list(map(float, values))
+        return f"{hh}:{mi} {mm}-{dd}-{yy} {flags} {' '.join(values)}"
+
+
+def records_to_df(times: np.ndarray, rows: np.ndarray, columns: list[str]) -> pl.DataFrame:
+    """Return records parsed by LrecParser as a pl.DataFrame.
+
+    Args:
+        times (np.ndarray): time of PC, as seconds since the epoch of the naive time
+        rows (np.ndarray): rows written by LrecParser.parse_into
+        columns (list[str]): LrecParser.columns
+
+    Returns:
+        pl.DataFrame: dtm (time of PC), dtm_49i, flags (UInt32) with its bits as flag_00 .. flag_31 (Boolean), values (Float32)
+    """
+    df = pl.DataFrame({'dtm': times, **dict(zip(columns, rows.T))})
+    df = df.with_columns(pl.from_epoch(pl.col('dtm').round(), time_unit='s').dt.cast_time_unit('us'),
+                         pl.from_epoch(pl.col('dtm_49i'), time_unit='s').dt.cast_time_unit('us'),
+                         pl.col('flags').cast(pl.UInt32),
+                         pl.col(columns[2:]).cast(pl.Float32))
+    return df.with_columns([((pl.col('flags') & (1 << bit)) != 0).alias(f"flag_{bit:02d}") for bit in range(32)])
+
 
 class Thermo49i:
     def __init__(self, config: dict, name: str='49i'):
@@ -38,6 +134,7 @@ class Thermo49i:
             self._get_config = config[name]['get_config']
             self._set_config = config[name]['set_config']
             self._get_data = config[name]['get_data']
+            self._lrec_batch = int(config[name].get('lrec_batch', 10))
 
             self.logger.info(f"Initialize Thermo 49i (name: {self._name}  S/N: {self._serial_number})")
 
@@ -60,6 +157,9 @@ class Thermo49i:
                                 config[name]['socket']['port'])
                 self._socktout = config[name]['socket']['timeout']
                 self._socksleep = config[name]['socket']['sleep']
+                # NB: the connection is kept open; replies are framed by '\r', sleep is the delay before a reconnect
+                self._tcp = TCPClient(self._sockaddr, timeout=self._socktout, reconnect_delay=self._socksleep)
+                self._pipeline = int(config[name]['socket'].get('pipeline', 1))
 
             root = os.path.expanduser(config['root'])
 
@@ -76,12 +176,32 @@ class Thermo49i:
             self.staging_path = os.path.join(root, config['staging'], config[name]['staging_path'])
             self.remote_path = config[name]['remote_path']
 
-            # initialize data response
+            # configure common dataset
+            self.dataset = DatasetWriter(config, name)
+
+            # initialize data response, and its records parsed into a columnar buffer
             self._data = str()
+            self.parser = LrecParser()
+            self.buffer = RingBuffer(capacity=2 * self.reporting_interval // int(self._sampling_interval) + 1,
+                                     width=len(self.parser.columns))
+            # NB: measured values are aggregated, i.e., the columns following dtm_49i and flags
+            self.aggregator = open_aggregator(config, self._name, self.parser.columns[2:])
+            # write-ahead log of self._data; replay data not saved before a crash or power cut
+            self.wal = open_wal(config, self._name)
+            for record in self.wal.replay():
+                line = record.decode('utf-8')
+                self._data += line
+                try:
+                    self._add_line(line, self.buffer)
+                except ValueError as err:
+                    self.logger.warning(err)
 
             # initialize data_file (path)
             self.data_file = str()
 
+            # callback notified of staged files, e.g., TransferService.stage
+            self.on_staged = None
+
         except Exception as err:
             self.logger.error(err)
 
@@ -112,45 +232,48 @@ class Thermo49i:
             self.logger.error(err)
 
 
+    @staticmethod
+    def _tidy(cmd: str, rcvd: bytes) -> str:
+        """Decode response, remove checksum after and including the '*', and the echo of cmd."""
+        rcvd = rcvd.decode()
+        rcvd = rcvd.split("*")[0]
+        return rcvd.replace(cmd, "").strip()
+
+
     def tcpip_comm(self, cmd: str) -> str:
         """
-        Send a command and retrieve the response. Assumes an open connection.
+        Send a command and retrieve the response over the persistent connection.
 
         :param cmd: command sent to instrument
         :return: response of instrument, decoded
         """
-        _id = bytes([self._id])
-        rcvd = b''
         try:
-            # open socket connection as a client
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM, ) as s:
-                # connect to the server
-                s.settimeout(self._socktout)
-                s.connect(self._sockaddr)
-
-                # send data
-                s.sendall(_id + (f"{cmd}\x0D").encode())
-                time.sleep(self._socksleep)
-
-                # receive response
-                while True:
-                    data = s.recv(1024)
-                    rcvd = rcvd + data
-                    if b'\x0D' in data:
-                        break
+            return self._tidy(cmd, self._tcp.request(bytes([self._id]) + f"{cmd}\x0D".encode()))
 
-            rcvd = rcvd.decode()
-            # remove checksum after and including the '*'
-            rcvd = rcvd.split("*")[0]
-            # remove echo before and including '\n'
-            # rcvd = rcvd.replace(f"{cmd}\n", "")
-            rcvd = rcvd.replace(cmd, "").strip()
+        except Exception as err:
+            self.logger.error(err)
+            return str()
 
-            return rcvd
+
+    def tcpip_comm_many(self, cmds: list[str]) -> list[str]:
+        """
+        Send commands and retrieve their responses, pipelining up to self._pipeline commands per round trip.
+
+        :param cmds: commands sent to instrument
+        :return: responses of instrument, decoded, in the order of cmds
+        """
+        responses = list()
+        try:
+            _id = bytes([self._id])
+            for i in range(0, len(cmds), self._pipeline):
+                batch = cmds[i:i + self._pipeline]
+                rcvd = self._tcp.pipeline([_id + f"{cmd}\x0D".encode() for cmd in batch])
+                responses += [self._tidy(cmd, _) for cmd, _ in zip(batch, rcvd)]
+            return responses
 
         except Exception as err:
             self.logger.error(err)
-            return str()
+            return responses + [str()] * (len(cmds) - len(responses))
 
 
     def serial_comm(self, cmd: str, tidy=True) -> str:
@@ -195,6 +318,21 @@ class Thermo49i:
             return str()
 
 
+    def send_commands(self, cmds: list[str]) -> list[str]:
+        try:
+            if self._serial_com:
+                return [self.serial_comm(cmd) for cmd in cmds]
+            return self.tcpip_comm_many(cmds)
+        except Exception as err:
+            self.logger.error(colorama.Fore.RED + f"{err}")
+            return [str()] * len(cmds)
+
+
+    def latency(self) -> dict:
+        """Return number of commands, and mean and maximum latency per command [ms] of the tcp/ip connection."""
+        return self._tcp.latency() if not self._serial_com else dict()
+
+
     def get_config(self) -> list:
         """
         Read current configuration of instrument and export to log.
@@ -204,11 +342,7 @@ class Thermo49i:
         """
         cfg = []
         try:
-            for cmd in self._get_config:
-                if self._serial_com:
-                    cfg.append(self.serial_comm(cmd))
-                else:
-                    cfg.append(self.tcpip_comm(cmd))
+            cfg = self.send_commands(self._get_config)
 
             self.logger.info(f"{self._name}, Configuration read as: {cfg}")
 
@@ -253,12 +387,14 @@ class Thermo49i:
         print("%s .set_config (name=%s)" % (time.strftime('%Y-%m-%d %H:%M:%S'), self._name))
         cfg = []
         try:
-            for cmd in self._set_config:
-                if self._serial_com:
+            if self._serial_com:
+                for cmd in self._set_config:
                     cfg.append(self.serial_comm(cmd))
-                else:
+                    time.sleep(1)
+            else:
+                # NB: each response is only sent once the instrument has processed the command
+                for cmd in self._set_config:
                     cfg.append(self.tcpip_comm(cmd))
-                time.sleep(1)
 
             self.logger.info(f"{self._name}, Configuration set to: {cfg}")
 
@@ -271,15 +407,28 @@ class Thermo49i:
 
     def accumulate_lr00(self):
         """
-        Send command, retrieve response from instrument and append to self._data.
+        Send command, retrieve response from instrument, parse it into self.buffer and append it to self._data.
+        A response that cannot be parsed is appended to self._data as it is.
         """
         try:
-            dtm = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            dtm = datetime.now()
             if self._serial_com:
                 _ = self.serial_comm('lr00')
             else:
                 _ = self.tcpip_comm('lr00')
-            self._data += f"{dtm} {_}\n"
+            try:
+                row = self.buffer.slot()
+                record = self.parser.parse_into(_, row)
+                self.buffer.commit(calendar.timegm(dtm.timetuple()))
+                if self.aggregator:
+                    self.aggregator.add(row[2:], calendar.timegm(dtm.timetuple()))
+            except ValueError as err:
+                # NB: keep the raw response in the data file; only the typed buffer and the aggregates miss it
+                self.logger.warning(f"{self._name}, {err}")
+                record = ' '.join(_.split())
+            line = f"{dtm.strftime('%Y-%m-%d %H:%M:%S')} {record}\n"
+            self._data += line
+            self.wal.append(line)
             self.logger.info(f"{self._name}, {_[:60]}[...]")
 
             return
@@ -288,6 +437,13 @@ class Thermo49i:
             self.logger.error(err)
 
 
+    def _add_line(self, line: str, buffer: RingBuffer) -> None:
+        """Parse a line as saved by _save_data (pcdate pctime record) into buffer."""
+        pcdate, pctime, record = line.split(maxsplit=2)
+        self.parser.parse_into(record, buffer.slot())
+        buffer.commit(calendar.timegm(datetime.strptime(f"{pcdate} {pctime}", '%Y-%m-%d %H:%M:%S').timetuple()))
+
+
     def get_all_lrec(self, save: bool=True) -> str:
         """download entire buffer from instrument and save to file
 
@@ -323,34 +479,9 @@ class Thermo49i:
                 self.logger.warning(f"{cmd} returned '{_}' instead of 'ok'.")
 
             # retrieve all lrec records stored in buffer
-            index = no_of_lrec
-            retrieve = 10
-
-            while index > 0:
-                if index < 10:
-                    retrieve = index
-                cmd = f"lrec {str(index)} {str(retrieve)}"
-                self.logger.info(cmd)
-                if self._serial_com:
-                    data += f"{self.serial_comm(cmd)}\n"
-                else:
-                    data += f"{self.tcpip_comm(cmd)}\n"
-
-                # remove all the extra info in the string returned
-                # 05:26 07-19-22 flags 0C100400 o3 30.781 hio3 0.000 cellai 50927 cellbi 51732 bncht 29.9 lmpt 53.1 o3lt 0.0 flowa 0.435 flowb 0.000 pres 493.7
-                # data = data.replace("flags ", "")
-                # data = data.replace("hio3 ", "")
-                # data = data.replace("cellai ", "")
-                # data = data.replace("cellbi ", "")
-                # data = data.replace("bncht ", "")
-                # data = data.replace("lmpt ", "")
-                # data = data.replace("o3lt ", "")
-                # data = data.replace("flowa ", "")
-                # data = data.replace("flowb ", "")
-                # data = data.replace("pres ", "")
-                # data = data.replace("o3 ", "")
-
-                index = index - 10
+            cmds = [f"lrec {str(index)} {str(min(index, 10))}" for index in range(no_of_lrec, 0, -10)]
+            self.logger.info(f"{self._name}, {cmds[0] if cmds else 'lrec'} .. ({len(cmds)} commands)")
+            data = "".join(f"{_}\n" for _ in self.send_commands(cmds))
 
             if save:
                 # write .dat file
@@ -368,6 +499,7 @@ class Thermo49i:
                 _ = self.serial_comm(f'set {lrec_format}')
             else:
                 _ = self.tcpip_comm(f'set {lrec_format}')
+                self.logger.info(f"{self._name}, latency: {self.latency()}")
 
             return data
 
@@ -376,6 +508,80 @@ class Thermo49i:
             return str()
 
 
+    def backfill_lrec(self) -> Path | None:
+        """Download the lrec buffer of the instrument to fill gaps, e.g., after an outage.
+
+        Records are requested in batches of self._lrec_batch (pipelined, if configured) and appended
+        to a .dat file as they arrive. A worker thread parses them into typed columns (parse_lrec)
+        while the download continues. Progress is kept in <data_path>/<name>_backfill.json: if the
+        download fails, the next call resumes it, allowing for the records logged in the meantime.
+
+        Returns:
+            Path | None: .parquet file of the records, sorted and deduplicated on dtm; None if the download failed
+        """
+        state_file = Path(self.data_path) / f"{self._name}_backfill.json"
+        try:
+            os.makedirs(self.data_path, exist_ok=True)
+            no_of_lrec = int(self.send_command("no of lrec").split()[0])
+
+            state = dict()
+            if state_file.exists():
+                with open(state_file, 'r') as fh:
+                    state = json.load(fh)
+            if state and os.path.exists(state['file']):
+                # NB: lrec indices count back from the newest record, so they shift as records are logged
+                elapsed = (datetime.now() - datetime.fromisoformat(state['time'])).total_seconds() / 60
+                index = min(state['index'] + math.ceil(elapsed / int(self._sampling_interval)) + self._lrec_batch, no_of_lrec)
+                self.logger.info(f"{self._name}, resume lrec backfill of {state['file']} at index {index}")
+            else:
+                dtm = datetime.now().strftime('%Y%m%d%H%M%S')
+                state = {'file': os.path.join(self.data_path, f"{self._name}_all_lrec-{dtm}.dat"),
+                         'lrec_format': self.send_command('lrec format')}
+                index = no_of_lrec
+
+            _ = self.send_command('set lrec format 0')
+            if not 'ok' in _:
+                self.logger.warning(f"set lrec format 0 returned '{_}' instead of 'ok'.")
+
+            writer = IncrementalWriter(Path(state['file']).with_suffix('.parquet'), key='dtm')
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self._name}-lrec") as parser, \
+                 open(state['file'], 'at', encoding='utf8') as fh:
+                parsed = list()
+                per_round = self._lrec_batch * (1 if self._serial_com else self._pipeline)
+                while index > 0:
+                    indices = range(index, max(index - per_round, 0), -self._lrec_batch)
+                    responses = self.send_commands([f"lrec {i} {min(i, self._lrec_batch)}" for i in indices])
+                    # NB: responses after a failed command are empty
+                    received = list(itertools.takewhile(bool, responses))
+                    if received:
+                        data = "".join(f"{_}\n" for _ in received)
+                        fh.write(data)
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                        parsed.append(parser.submit(lambda data=data: writer.append(parse_lrec(data))))
+                        index -= self._lrec_batch * len(received)
+                        state.update(index=index, time=datetime.now().isoformat(timespec='seconds'))
+                        with open(f"{state_file}.tmp", 'w') as sf:
+                            json.dump(state, sf)
+                        os.replace(f"{state_file}.tmp", state_file)
+                    if len(received) < len(responses):
+                        raise ConnectionError(f"{self._name}, lrec backfill interrupted at index {index}")
+                for future in parsed:
+                    future.result()
+
+            self.send_command(f"set {state['lrec_format']}")
+            target = writer.finalize()
+            if target is not None:
+                self.dataset.write(pl.read_parquet(target), file=f"{self._name}_lrec")
+            state_file.unlink()
+            self.logger.info(f"{self._name}, lrec backfill saved to {target}, latency: {self.latency()}")
+            return target
+
+        except Exception as err:
+            self.logger.error(err)
+            return None
+
+
     def get_o3(self) -> str:
         try:
             if self._serial_com:
@@ -412,14 +618,24 @@ class Thermo49i:
                 if os.path.exists(data_file):
                     with open(file=data_file, mode='a') as fh:
                         fh.write(self._data)
+                        fh.flush()
+                        os.fsync(fh.fileno())
                 else:
                     with open(file=data_file, mode='w') as fh:
                         fh.write(self.header)
                         fh.write(self._data)
+                        fh.flush()
+                        os.fsync(fh.fileno())
                 self.logger.info(f"file saved: {data_file}")
 
-                # reset self._data
+                # add to common dataset
+                self.dataset.write(records_to_df(*self.buffer.drain(), self.parser.columns))
+                if self.aggregator:
+                    self.aggregator.write(self.dataset)
+
+                # reset self._data, data is safe in data file
                 self._data = str()
+                self.wal.truncate()
 
             self.data_file = data_file
             return
@@ -428,6 +644,28 @@ class Thermo49i:
             self.logger.error(err)
 
 
+    def data_to_df(self, data: str) -> pl.DataFrame:
+        """Parse lines of lr00 data (lrec format 0), as saved by _save_data, and return a pl.DataFrame.
+
+        Args:
+            data (str): lines of data, each prefixed with date and time of the PC
+
+        Returns:
+            pl.DataFrame: dataframe as returned by records_to_df
+        """
+        try:
+            lines = [line for line in data.splitlines() if line.strip() and not line.startswith('pcdate')]
+            buffer = RingBuffer(capacity=max(len(lines), 1), width=len(self.parser.columns))
+            for line in lines:
+                try:
+                    self._add_line(line, buffer)
+                except ValueError as err:
+                    self.logger.warning(err)
+            return records_to_df(*buffer.window(), self.parser.columns)
+        except Exception as err:
+            self.logger.error(err)
+
+
     def _stage_file(self):
         """ Create zip file from self.data_file and stage archive.
         """
@@ -437,6 +675,8 @@ class Thermo49i:
                 with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
                     zf.write(self.data_file, os.path.basename(self.data_file))
                     self.logger.info(f"file staged: {archive}")
+                if self.on_staged:
+                    self.on_staged(archive)
 
         except Exception as err:
             self.logger.error(err)
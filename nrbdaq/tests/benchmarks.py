@@ -0,0 +1,173 @@
+"""
+Micro-benchmarks of the data path. Run from the repository root with
+
+    python -m nrbdaq.tests.benchmarks
+"""
+import glob
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+from nrbdaq.instr.ae31 import AE31, COLUMNS
+from nrbdaq.instr.fidas import FIDAS, SendValParser
+from nrbdaq.instr.thermo import LrecParser, Thermo49i, parse_lrec
+from nrbdaq.tests.helpers import fidas_record, lrec_record, thermo49i_simulator
+from nrbdaq.utils.aggregation import P2Quantile
+from nrbdaq.utils.utils import load_config
+from nrbdaq.utils.wal import WriteAheadLog
+
+config = load_config(config_file="nrbdaq.yml")
+
+
+def rate(func, n: int) -> float:
+    """Return calls/s of func over n calls."""
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return n / (time.perf_counter() - start)
+
+
+def benchmark_fidas_parser(n: int=20000) -> dict:
+    """Compare FIDAS.parse_record (str) with SendValParser.parse_into (bytes)."""
+    record = fidas_record()
+    fidas = FIDAS(config=config)
+    parser = SendValParser()
+    parser.parse_into(record)
+
+    results = {'channels': len(parser.channels),
+               'parse_record [records/s]': rate(lambda: fidas.parse_record(record.decode('ascii')), n),
+               'SendValParser.parse_into [records/s]': rate(lambda: parser.parse_into(record), n)}
+    results['speedup'] = results['SendValParser.parse_into [records/s]'] / results['parse_record [records/s]']
+    return results
+
+
+def benchmark_wal(n: int=100000, sync_interval: float=1.0) -> dict:
+    """Cost of WriteAheadLog.append per record, for a record the size of an AE31 line."""
+    record = "2024-08-05T00:00:00," + ",".join(["  6633"] * 50) + "\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        wal = WriteAheadLog(file=os.path.join(tmp, 'benchmark.wal'), sync_interval=sync_interval)
+        records_per_s = rate(lambda: wal.append(record), n)
+        wal.close()
+        replayed = len(WriteAheadLog(file=os.path.join(tmp, 'benchmark.wal')).replay())
+    return {'record [bytes]': len(record),
+            'sync_interval [s]': sync_interval,
+            'append [us/record]': 1e6 / records_per_s,
+            'replayed': replayed}
+
+
+def ae31_csv_to_df_text(file: str) -> pl.DataFrame:
+    """AE31 .csv file to DataFrame as before: read as text, remove blanks, re-encode, infer and cast types."""
+    with open(file, "r") as fh:
+        content = fh.read().replace(" ", "").encode()
+    df = pl.read_csv(content, has_header=False, truncate_ragged_lines=True)
+    df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
+    df.columns = COLUMNS
+    return df.with_columns(pl.col("dtm").str.to_datetime(time_unit='us', time_zone='UTC'),
+                           pl.col("date").str.to_date("%d-%b-%y").dt.combine(pl.col("time").str.to_time("%H:%M")).alias("dtm_ae31"))
+
+
+def benchmark_ae31_csv(n: int=50) -> dict:
+    """Compare reading the AE31 test files as text with AE31.csv_to_df (fixed schema, native parsing)."""
+    files = sorted(glob.glob('nrbdaq/tests/data/ae31/*.csv'))
+    ae31 = AE31(config=config)
+    rows = sum(ae31.csv_to_df(file).height for file in files)
+
+    results = {'files': len(files),
+               'rows': rows,
+               'text [rows/s]': rows * rate(lambda: [ae31_csv_to_df_text(file) for file in files], n),
+               'csv_to_df [rows/s]': rows * rate(lambda: [ae31.csv_to_df(file) for file in files], n)}
+    results['speedup'] = results['csv_to_df [rows/s]'] / results['text [rows/s]']
+    return results
+
+
+def thermo49i_comm_per_connection(address: tuple[str, int], cmd: str, sleep: float) -> str:
+    """49i command as before: connect, send, sleep, receive up to '\\r', close."""
+    rcvd = b''
+    with socket.create_connection(address, timeout=5) as s:
+        s.sendall(bytes([177]) + f"{cmd}\x0D".encode())
+        time.sleep(sleep)
+        while b'\x0D' not in rcvd:
+            rcvd += s.recv(1024)
+    return rcvd.decode().split("*")[0].replace(cmd, "").strip()
+
+
+def benchmark_thermo49i_lrec(no_of_lrec: int=1000, delay: float=0.001) -> dict:
+    """Download the lrec buffer of a simulated 49i: a connection per command vs. persistent vs. pipelined."""
+    address = thermo49i_simulator(no_of_lrec=no_of_lrec, delay=delay)
+    cfg = dict(config)
+    cfg['49i'] = dict(config['49i'], socket=dict(config['49i']['socket'], host=address[0], port=address[1]))
+    cmds = [f"lrec {index} {min(index, 10)}" for index in range(no_of_lrec, 0, -10)]
+
+    results = {'commands': len(cmds), 'delay per command [ms]': 1000 * delay}
+    start = time.perf_counter()
+    for cmd in cmds:
+        thermo49i_comm_per_connection(address, cmd, sleep=config['49i']['socket']['sleep'])
+    results['connection per command [s]'] = time.perf_counter() - start
+    for pipeline in [1, 10]:
+        cfg['49i']['socket']['pipeline'] = pipeline
+        thermo49i = Thermo49i(config=cfg)
+        start = time.perf_counter()
+        thermo49i.send_commands(cmds)
+        results[f"persistent, pipeline {pipeline} [s]"] = time.perf_counter() - start
+        results[f"persistent, pipeline {pipeline} [ms/command]"] = thermo49i.latency()['mean_ms']
+    return results
+
+
+def benchmark_thermo49i_lr00(n: int=20000) -> dict:
+    """Parse cost of an lr00 response: LrecParser.parse_into vs. the former text path (split, DataFrame, cast)."""
+    record = lrec_record(0)
+    header = 'pcdate pctime time date flags o3 hio3 cellai cellbi bncht lmpt o3lt flowa flowb pres'.split()
+    line = f"2022-07-19 05:26:05 {LrecParser().parse_into(record, np.zeros(12))}"
+
+    def text(line: str=line) -> pl.DataFrame:
+        df = pl.DataFrame([line.split()], schema=header, orient='row')
+        return df.with_columns(pl.col(header[5:]).cast(pl.Float32, strict=False))
+
+    parser = LrecParser()
+    row = np.zeros(len(parser.columns))
+    lines = "\n".join([record] * 1000)
+    return {'text [us/record]': 1e6 / rate(text, n // 10),
+            'LrecParser.parse_into [us/record]': 1e6 / rate(lambda: parser.parse_into(record, row), n),
+            'parse_lrec, 1000 records [us/record]': 1e3 / rate(lambda: parse_lrec(lines), n // 100)}
+
+
+def benchmark_p2_quantile(n: int=3600, channels: int=100) -> dict:
+    """Compare the hourly median of 1 Hz records with P2Quantile (streaming) and np.nanmedian (all records kept)."""
+    rows = np.random.default_rng(0).lognormal(size=(n, channels))
+    estimator = P2Quantile(channels, q=0.5)
+    start = time.perf_counter()
+    for row in rows:
+        estimator.add(row)
+    elapsed = time.perf_counter() - start
+    estimate = np.empty(channels)
+    estimator.result(estimate)
+    exact = np.nanmedian(rows, axis=0)
+    # NB: rank error, i.e., fraction of records between estimate and exact median
+    between = ((rows > np.minimum(estimate, exact)) & (rows < np.maximum(estimate, exact))).mean(axis=0)
+    return {'records': n,
+            'channels': channels,
+            'p2 [us/record]': 1e6 * elapsed / n,
+            'p2 state [bytes]': estimator.heights.nbytes + estimator.positions.nbytes + estimator.desired.nbytes,
+            'exact records [bytes]': rows.nbytes,
+            'max rank error': float(between.max())}
+
+
+def main():
+    for name, benchmark in [('fidas_parser', benchmark_fidas_parser),
+                            ('wal', benchmark_wal),
+                            ('ae31_csv', benchmark_ae31_csv),
+                            ('thermo49i_lrec', benchmark_thermo49i_lrec),
+                            ('thermo49i_lr00', benchmark_thermo49i_lr00),
+                            ('p2_quantile', benchmark_p2_quantile)]:
+        results = benchmark()
+        print(name)
+        for key, value in results.items():
+            print(f"  {key}: {value:,.1f}" if isinstance(value, float) else f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Fixtures shared by the tests and the benchmarks: records as sent by instruments, and instrument simulators.
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
+
+import paramiko
+import polars as pl
+
+from nrbdaq.utils.sftp import SFTPClient
+
+
+def fidas_record() -> bytes:
+    """Build a sendVal record with all channels of the FIDAS test data."""
+    df = pl.read_parquet('nrbdaq/tests/data/fidas/fidas-2025050320.parquet')
+    channels = sorted([col for col in df.columns if col.isdigit()], key=int)
+    payload = ";".join(f"{channel}={df[0, channel]}" for channel in channels)
+    return f"6082<sendVal {payload}>3E".encode('ascii')
+
+
+def lrec_record(index: int) -> str:
+    """lrec record (format 0, labelled) logged index minutes before 2022-07-19 05:26."""
+    dtm = datetime(2022, 7, 19, 5, 26) - timedelta(minutes=index)
+    return f"{dtm:%H:%M %m-%d-%y} flags 0C100400 o3 30.781 hio3 0.000 cellai 50927 cellbi 51732 bncht 29.9 lmpt 53.1 o3lt 0.0 flowa 0.435 flowb 0.000 pres 493.7"
+
+
+def thermo49i_simulator(no_of_lrec: int=1000, delay: float=0.0) -> tuple[str, int]:
+    """Serve the 49i commands used by Thermo49i on localhost, with echo and checksum, in a daemon thread.
+
+    Args:
+        no_of_lrec (int, optional): records in the buffer. Defaults to 1000.
+        delay (float, optional): seconds per command, e.g., processing time of the instrument. Defaults to 0.0.
+
+    Returns:
+        tuple[str, int]: address of the simulator
+    """
+    def reply(cmd: str) -> str:
+        words = cmd.split()
+        if words[0] == 'lrec' and words[1].isdigit():
+            index = int(words[1])
+            return "\n".join([cmd] + [lrec_record(i) for i in range(index, max(index - int(words[2]), 0), -1)])
+        if cmd == 'no of lrec':
+            return f"{cmd} {no_of_lrec} recs"
+        return f"{cmd} ok"
+
+    def handle(conn: socket.socket):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b''
+        with conn:
+            while data := conn.recv(4096):
+                buffer += data
+                while b'\r' in buffer:
+                    request, buffer = buffer.split(b'\r', 1)
+                    time.sleep(delay)
+                    conn.sendall(f"{reply(request[1:].decode())}*0000\r".encode())
+
+    def serve(server: socket.socket):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn, ), daemon=True).start()
+
+    server = socket.create_server(('127.0.0.1', 0))
+    threading.Thread(target=serve, args=(server, ), daemon=True).start()
+    return server.getsockname()
+
+
+def faulty_worker(name: str, config: dict, heartbeat) -> None:
+    """Stand-in for supervisor.run_worker: worker 'crash' exits right away, worker 'hang' stops sending heartbeats."""
+    if name == 'crash':
+        sys.exit(3)
+    heartbeat.value = time.time()
+    time.sleep(3600)
+
+
+class FakeTransport:
+    """Stand-in for paramiko.Transport; set active to False to simulate a dead link."""
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self) -> bool:
+        return self.active
+
+    def set_keepalive(self, interval: int) -> None:
+        pass
+
+
+class FakeSSHClient:
+    """Stand-in for paramiko.SSHClient, connecting to a FakeTransport."""
+
+    def __init__(self):
+        self.transport = None
+
+    def set_missing_host_key_policy(self, policy) -> None:
+        pass
+
+    def connect(self, **kwargs) -> None:
+        self.transport = FakeTransport()
+
+    def get_transport(self) -> FakeTransport:
+        return self.transport
+
+    def close(self) -> None:
+        if self.transport:
+            self.transport.active = False
+
+
+class FakeFile:
+    """Remote file of a FakeSFTP."""
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.fh.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def set_pipelined(self, pipelined: bool=True) -> None:
+        pass
+
+
+class FakeSFTP:
+    """Stand-in for paramiko.SFTPClient, serving the directory root. Calls are recorded in self.calls."""
+
+    def __init__(self, root: str, transport: FakeTransport):
+        self.root = root
+        self.transport = transport
+        self.calls = []
+        self.channel = mock.Mock(closed=False)
+        self.channel.get_transport.return_value = transport
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def get_channel(self):
+        return self.channel
+
+    def close(self) -> None:
+        self.channel.closed = True
+
+    def normalize(self, path: str) -> str:
+        return os.path.normpath(path)
+
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        self.calls.append(('stat', path))
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+
+    def listdir_attr(self, path: str='.') -> list:
+        self.calls.append(('listdir_attr', path))
+        return [paramiko.SFTPAttributes.from_stat(entry.stat(), entry.name) for entry in os.scandir(self._path(path))]
+
+    def mkdir(self, path: str, mode: int=511) -> None:
+        self.calls.append(('mkdir', path))
+        os.mkdir(self._path(path))
+
+    def open(self, path: str, mode: str='r') -> FakeFile:
+        self.calls.append(('open', path, mode))
+        return FakeFile(open(self._path(path), mode))
+
+    def put(self, localpath: str, remotepath: str, confirm: bool=True) -> paramiko.SFTPAttributes:
+        self.calls.append(('put', remotepath))
+        shutil.copyfile(localpath, self._path(remotepath))
+        return self.stat(remotepath)
+
+    def posix_rename(self, oldpath: str, newpath: str) -> None:
+        self.calls.append(('posix_rename', oldpath, newpath))
+        os.replace(self._path(oldpath), self._path(newpath))
+
+    def rename(self, oldpath: str, newpath: str) -> None:
+        self.calls.append(('rename', oldpath, newpath))
+        os.rename(self._path(oldpath), self._path(newpath))
+
+    def remove(self, path: str) -> None:
+        self.calls.append(('remove', path))
+        os.remove(self._path(path))
+
+
+@contextmanager
+def fake_sftp_client(config: dict):
+    """Yield an SFTPClient connected to a FakeSFTP server, with root and the served directory in a temporary directory.
+
+    Args:
+        config (dict): general configuration
+
+    Yields:
+        tuple[SFTPClient, str]: the client, and the directory served as remote root
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, 'remote')
+        os.makedirs(remote)
+        with mock.patch('paramiko.RSAKey.from_private_key_file'), \
+             mock.patch('paramiko.SSHClient', FakeSSHClient), \
+             mock.patch('paramiko.SFTPClient.from_transport', side_effect=lambda transport: FakeSFTP(remote, transport)):
+            client = SFTPClient(config=dict(config, root=tmp))
+            try:
+                yield client, remote
+            finally:
+                client.close()
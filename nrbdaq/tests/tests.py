@@ -1,15 +1,35 @@
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from unittest import mock
 
+import numpy as np
 import polars as pl
+import schedule
 
 import nrbdaq.instr.avo as avo
+import nrbdaq.utils.supervisor as supervisor
 from nrbdaq.instr.ae31 import AE31
-from nrbdaq.instr.fidas import FIDAS
-from nrbdaq.instr.thermo import Thermo49i
-from nrbdaq.utils.sftp import SFTPClient
+from nrbdaq.instr.aurora3000 import Aurora3000
+from nrbdaq.instr.fidas import FIDAS, SendValParser
+from nrbdaq.instr.thermo import LrecParser, Thermo49i
+from nrbdaq.tests.helpers import fake_sftp_client, faulty_worker, lrec_record, thermo49i_simulator
+from nrbdaq.utils.aggregation import Aggregator, BlockStatistics, P2Quantile, Reducer
+from nrbdaq.utils.ringbuffer import RingBuffer
+from nrbdaq.utils.runtime import AsyncRuntime
+from nrbdaq.utils.serialport import LineReader, SerialPort
+from nrbdaq.utils.sftp import SFTPClient, TransferJournal
+from nrbdaq.utils.storage import DatasetWriter, IncrementalWriter, Manifest, scan_dataset
+from nrbdaq.utils.transfer import TransferService
 from nrbdaq.utils.utils import load_config
+from nrbdaq.utils.watcher import StagingWatcher
+from nrbdaq.utils.wal import WriteAheadLog, open_wal
 
 config = load_config(config_file="nrbdaq.yml")
 
@@ -46,6 +66,526 @@ class TestSFTP(unittest.TestCase):
         sftp.remove_remote_item(remote_path=remote_path)
         os.remove(path=file_path)
 
+    def test_session_pool(self):
+        with fake_sftp_client(config) as (sftp, _):
+            with sftp.session() as first:
+                pass
+            with sftp.session() as second, sftp.session() as third:
+                self.assertIs(second, first)
+                self.assertIsNot(third, first)
+            self.assertEqual((sftp.handshakes, len(sftp._channels)), (1, 2))
+
+            # reconnect once the transport died, discarding the pooled channels
+            sftp._ssh.get_transport().active = False
+            with sftp.session() as fourth:
+                self.assertNotIn(fourth, (first, third))
+            self.assertTrue(first.get_channel().closed)
+            self.assertEqual(sftp.handshakes, 2)
+
+            # a borrowed session is never evicted, an idle one is
+            sftp._last_used -= sftp.idle_timeout + 1
+            with sftp.session():
+                sftp.evict_idle()
+                self.assertTrue(sftp._is_connected())
+            sftp._last_used -= sftp.idle_timeout + 1
+            sftp.evict_idle()
+            self.assertFalse(sftp._is_connected())
+            self.assertEqual(sftp._channels, [])
+
+    def test_remote_dir_cache(self):
+        with fake_sftp_client(config) as (sftp, remote), tempfile.TemporaryDirectory() as tmp:
+            local_file = os.path.join(tmp, 'fidas-2025050320.parquet')
+            with open(local_file, 'wb') as fh:
+                fh.write(b'x' * 100)
+            with sftp.session() as channel:
+                sftp._setup_remote_path(channel, './nrb/fidas')
+                calls = len(channel.calls)
+                sftp._setup_remote_path(channel, 'nrb/fidas/')
+                self.assertEqual(len(channel.calls), calls)
+                self.assertEqual(sftp._remote_dirs, {'nrb', 'nrb/fidas'})
+
+                # a transfer into a directory removed behind our back invalidates the cache
+                shutil.rmtree(os.path.join(remote, 'nrb', 'fidas'))
+                with self.assertRaises(IOError):
+                    sftp._transfer_file(channel, local_file, 'nrb/fidas/fidas-2025050320.parquet', remove_on_success=False)
+                self.assertEqual(sftp._remote_dirs, set())
+
+                # so does a failing mkdir
+                sftp._setup_remote_path(channel, 'nrb/ae31')
+                with mock.patch.object(channel, 'mkdir', side_effect=PermissionError), self.assertRaises(IOError):
+                    sftp._setup_remote_path(channel, 'nrb/fidas')
+                self.assertEqual(sftp._remote_dirs, set())
+
+                sftp._setup_remote_path(channel, 'nrb/fidas')
+                self.assertTrue(os.path.isdir(os.path.join(remote, 'nrb', 'fidas')))
+
+    def test_concurrency_limit(self):
+        cfg = dict(config, sftp=dict(config['sftp'], concurrency={'default': 3, 'ae31': 2}))
+        with fake_sftp_client(cfg) as (sftp, _):
+            lock = threading.Lock()
+            active, peak = dict(), dict()
+
+            def transfer_file(channel, local_file, remote_file, remove_on_success=True):
+                destination = os.path.dirname(remote_file)
+                with lock:
+                    active[destination] = active.get(destination, 0) + 1
+                    peak[destination] = max(peak.get(destination, 0), active[destination])
+                time.sleep(0.02)
+                with lock:
+                    active[destination] -= 1
+                return 1
+
+            sftp._transfer_file = transfer_file
+            batches = []
+            for destination in ['./nrb/ae31', './nrb/fidas', './nrb/fidas']:
+                jobs = [(f"{destination}/{len(batches)}-{i}.dat", f"{destination}/{i}.dat") for i in range(8)]
+                batches.append(threading.Thread(target=sftp.transfer_batch, args=(jobs, destination), kwargs=dict(max_workers=8)))
+            for batch in batches:
+                batch.start()
+            for batch in batches:
+                batch.join()
+
+        # NB: concurrent batches to the same destination share its limit
+        self.assertEqual(peak, {'nrb/ae31': 2, 'nrb/fidas': 3})
+        self.assertEqual(sftp.max_concurrency('./nrb/aurora3000'), 3)
+
+    def test_transfer_batch_accounts_for_all_jobs(self):
+        with fake_sftp_client(config) as (sftp, _):
+            started = threading.Barrier(2)
+
+            def transfer_file(channel, local_file, remote_file, remove_on_success=True):
+                if local_file in ('0.dat', '1.dat'):
+                    started.wait(timeout=5)
+                if local_file == '0.dat':
+                    sftp._ssh.get_transport().active = False
+                    sftp._connect = mock.Mock(side_effect=IOError("no route to host"))
+                    raise IOError("link down")
+                time.sleep(0.2)
+                return 1
+
+            sftp._transfer_file = transfer_file
+            jobs = [(f"{i}.dat", f"./nrb/test/{i}.dat") for i in range(6)]
+            succeeded, failed = sftp.transfer_batch(jobs, './nrb/test', max_workers=2)
+
+        # NB: the upload running when the link went down completes, the queued ones are cancelled
+        self.assertIn('1.dat', succeeded)
+        self.assertIn('0.dat', failed)
+        self.assertEqual(sorted(succeeded + failed), [local_file for local_file, _ in jobs])
+        self.assertEqual((sftp.last_report['files'], sftp.last_report['failed']), (len(succeeded), len(failed)))
+
+    def test_put_resumable(self):
+        data = os.urandom(1000)
+        with fake_sftp_client(config) as (sftp, remote), tempfile.TemporaryDirectory() as tmp:
+            local_file = os.path.join(tmp, 'ae31-20240805.zip')
+            with open(local_file, 'wb') as fh:
+                fh.write(data)
+            checksum = sftp._checksum(local_file)
+
+            # (journal checksum, bytes already in .part, expected open mode)
+            for sha256, part, mode in [(checksum, 400, 'r+b'), ('changed', 400, 'wb'), (checksum, 1000, 'r+b'), (checksum, 1200, 'wb')]:
+                with open(os.path.join(remote, 'ae31-20240805.zip.part'), 'wb') as fh:
+                    fh.write(data[:part] if part <= len(data) else os.urandom(part))
+                sftp.journal.set(local_file, remote='ae31-20240805.zip', size=len(data), sha256=sha256, offset=part)
+                with sftp.session() as channel:
+                    channel.calls.clear()
+                    attr = sftp.put_resumable(channel, local_file, 'ae31-20240805.zip')
+
+                self.assertEqual(next(call[2] for call in channel.calls if call[0] == 'open'), mode)
+                self.assertEqual(attr.st_size, len(data))
+                with open(os.path.join(remote, 'ae31-20240805.zip'), 'rb') as fh:
+                    self.assertEqual(fh.read(), data)
+                self.assertFalse(os.path.exists(os.path.join(remote, 'ae31-20240805.zip.part')))
+                self.assertEqual(sftp.journal.get(local_file), {})
+                self.assertEqual(TransferJournal(sftp.journal.file).get(local_file), {})
+
+
+class TestTransferService(unittest.TestCase):
+    def test_destination(self):
+        transfer = TransferService(sftp=None, config=config)
+        transfer.register(local_path='/tmp/staging/fidas', remote_path='./nrb/fidas')
+
+        self.assertEqual(transfer.destination('/tmp/staging/fidas/2025/fidas-2025050320.parquet'),
+                         ('./nrb/fidas', './nrb/fidas/2025/fidas-2025050320.parquet'))
+        self.assertEqual(transfer.destination('/tmp/staging/ae31/ae31-2025050320.zip'), ('', ''))
+
+    def test_stage_ignores_duplicates(self):
+        transfer = TransferService(sftp=None, config=config)
+        transfer.stage('/tmp/staging/fidas/fidas-2025050320.parquet')
+        transfer.stage('/tmp/staging/fidas/fidas-2025050320.parquet')
+
+        self.assertEqual(transfer.status()['queue_depth'], 1)
+
+    def test_retry_and_requeue(self):
+        cfg = dict(config, sftp=dict(config['sftp'], retry_interval=0))
+        with fake_sftp_client(cfg) as (sftp, remote), tempfile.TemporaryDirectory() as tmp:
+            transfer = TransferService(sftp=sftp, config=cfg)
+            transfer.register(local_path=tmp, remote_path='./nrb/fidas')
+            files = [os.path.join(tmp, f"fidas-20250503{hour}.parquet") for hour in ['20', '21', '22']]
+            for file in files:
+                with open(file, 'wb') as fh:
+                    fh.write(b'x' * 100)
+                transfer.stage(file)
+            time.sleep(0.1)
+
+            # a batch reporting only some of its files, e.g., after an error: the rest is retried
+            transfer_batch = sftp.transfer_batch
+            sftp.transfer_batch = lambda jobs, **kwargs: transfer_batch(jobs=jobs[:1], **kwargs)
+            transfer._transfer(transfer._next_batch())
+            status = transfer.status()
+            self.assertEqual((status['queue_depth'], status['retry'], status['transfered'], status['failed']), (0, 2, 1, 2))
+            self.assertGreaterEqual(status['last_lag_s'], 0.1)
+            self.assertEqual(status['lag_s'], 0)
+
+            sftp.transfer_batch = transfer_batch
+            transfer._requeue_due()
+            self.assertEqual(transfer.status()['queue_depth'], 2)
+            transfer._transfer(transfer._next_batch())
+            status = transfer.status()
+            self.assertEqual((status['queue_depth'], status['retry'], status['transfered'], status['failed']), (0, 0, 3, 2))
+            self.assertEqual(sorted(os.listdir(os.path.join(remote, 'nrb', 'fidas'))), [os.path.basename(file) for file in files])
+            self.assertEqual(os.listdir(tmp), [])
+            # NB: the service keeps no list of files transfered on the client
+            self.assertEqual(sftp.transfered, [])
+
+
+class TestStagingWatcher(unittest.TestCase):
+    def test_report_once(self):
+        for mode in ['inotify', 'polling']:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp:
+                staging, outside = os.path.join(tmp, 'staging'), os.path.join(tmp, 'outside')
+                os.makedirs(outside)
+                reported = []
+                watcher = StagingWatcher(staging, reported.append, config=dict(config, watcher={'mode': mode, 'poll_interval': 0.05}))
+                self.assertEqual(watcher.mode, mode)
+                watcher.start()
+                # NB: files present at start are reported by the initial scan, so let it complete
+                time.sleep(0.2)
+                try:
+                    # a file being written is not reported before it is closed
+                    written = os.path.join(staging, 'fidas-2025050320.parquet')
+                    with open(written, 'wb') as fh:
+                        for _ in range(30):
+                            fh.write(b'x' * 100)
+                            fh.flush()
+                            time.sleep(0.01)
+                        self.assertEqual(reported, [])
+
+                    # files are moved into place after writing
+                    moved = os.path.join(outside, 'ae31-20240805.zip')
+                    with open(moved, 'wb') as fh:
+                        fh.write(b'x' * 100)
+                    os.rename(moved, os.path.join(staging, 'ae31-20240805.zip'))
+
+                    deadline = time.time() + 5
+                    while len(reported) < 2 and time.time() < deadline:
+                        time.sleep(0.05)
+                    time.sleep(0.3)
+                finally:
+                    watcher.stop()
+
+                self.assertEqual(sorted(reported), [os.path.join(staging, 'ae31-20240805.zip'), written])
+                self.assertEqual(sorted(watcher.ready()), sorted(reported))
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    def test_grid_lateness_and_isolation(self):
+        class Driver:
+            def __init__(self, duration: float, runs: int):
+                self.duration, self.runs, self.started = duration, runs, []
+
+            def acquire(self):
+                self.started.append(time.time())
+                time.sleep(self.duration)
+                if len(self.started) == self.runs:
+                    return schedule.CancelJob
+
+            def status(self):
+                if len(self.started) >= self.runs:
+                    return schedule.CancelJob
+
+        class Slow(Driver):
+            pass
+
+        class Fast(Driver):
+            pass
+
+        slow, fast = Slow(duration=0.3, runs=3), Fast(duration=0.0, runs=8)
+        scheduler = schedule.Scheduler()
+        jobs = [scheduler.every(0.2).seconds.do(slow.acquire),
+                scheduler.every(0.2).seconds.do(slow.status),
+                scheduler.every(0.2).seconds.do(fast.acquire)]
+        runtime = AsyncRuntime(config=config)
+        runtime.run(jobs)
+        stats = runtime.stats()
+
+        # NB: runs start on multiples of the interval, and the slow driver delays its own jobs only
+        self.assertTrue(all(abs(t - round(t / 0.2) * 0.2) < 0.05 for t in fast.started))
+        self.assertEqual(stats['Fast.acquire (0.2 seconds)']['runs'], 8)
+        self.assertLess(stats['Fast.acquire (0.2 seconds)']['max_lateness_s'], 0.05)
+        self.assertGreater(max(stats[f"Slow.{job} (0.2 seconds)"]['max_lateness_s'] for job in ['acquire', 'status']), 0.08)
+        self.assertEqual(len(runtime._executors), 2)
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_restart_with_backoff(self):
+        cfg = dict(config, supervisor={'workers': ['crash', 'hang'], 'heartbeat_timeout': 1, 'backoff': 0.2, 'max_backoff': 0.4})
+        with mock.patch.dict(supervisor.WORKERS, {'crash': (None, None), 'hang': (None, None)}), \
+             mock.patch('nrbdaq.utils.supervisor.run_worker', faulty_worker):
+            sup = supervisor.Supervisor(cfg)
+            delays = {name: [] for name in sup.names}
+            sup.start()
+            try:
+                deadline = time.time() + 60
+                while min(len(d) for d in delays.values()) < 3 and time.time() < deadline:
+                    pending = {name: worker['restart_at'] for name, worker in sup._workers.items()}
+                    now = time.time()
+                    sup.check()
+                    for name, worker in sup._workers.items():
+                        if worker['restart_at'] is not None and worker['restart_at'] != pending[name]:
+                            delays[name].append(round(worker['restart_at'] - now, 1))
+                    time.sleep(0.05)
+                status = sup.status()
+            finally:
+                sup.stop(timeout=5)
+
+        # NB: the backoff doubles after each failure, up to max_backoff
+        self.assertEqual({name: d[:3] for name, d in delays.items()}, {'crash': [0.2, 0.4, 0.4], 'hang': [0.2, 0.4, 0.4]})
+        self.assertTrue(all(status[name]['restarts'] >= 2 for name in sup.names))
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wrap_and_nanmedian(self):
+        ring = RingBuffer(capacity=3, width=2)
+        for i, row in enumerate([[1, 9], [2, np.nan], [3, 7], [4, np.nan]]):
+            ring.append(np.array(row, dtype=float), timestamp=i)
+        times, rows = ring.window()
+
+        self.assertEqual(times.tolist(), [1, 2, 3])
+        self.assertEqual(ring.overwritten, 1)
+        self.assertEqual(ring.nanmedian().tolist(), [3.0, 7.0])
+        self.assertEqual(ring.nanmedian(since=3).tolist()[0], 4.0)
+
+
+class TestBlockStatistics(unittest.TestCase):
+    def test_reduce_and_mode(self):
+        block = BlockStatistics(capacity=4, channels=['a', 'state'], states=['state'])
+        for sample in [[1, 15], [2, 15], [3, 26], [10, 15], [5, 26]]:
+            block.add(sample)
+        row = np.empty(len(block.columns))
+
+        self.assertEqual(block.reduce(row), 4)
+        self.assertEqual(block.dropped, 1)
+        stats = dict(zip(block.columns, row.tolist()))
+        self.assertEqual((stats['a'], stats['state'], stats['n']), (4.0, 15.0, 4.0))
+        self.assertEqual((stats['a_median'], stats['a_min'], stats['a_max']), (2.5, 1.0, 10.0))
+        self.assertEqual(block.reduce(row), 0)
+        self.assertTrue(np.isnan(row).all())
+
+
+class TestAggregator(unittest.TestCase):
+    def test_windows_match_group_by_dynamic(self):
+        rng = np.random.default_rng(0)
+        times = 1722816000 + np.arange(0, 1800, 5.0)
+        values = rng.normal(size=(len(times), 2))
+        values[::7, 1] = np.nan
+        aggregator = Aggregator('test', ['a', 'b'], windows=[60, 600], reducers=['mean', 'median', 'p90', 'count'],
+                                quantile_method='exact')
+        for timestamp, row in zip(times, values):
+            aggregator.add(row, timestamp)
+        aggregator.flush()
+
+        expected = (pl.DataFrame({'dtm': pl.from_epoch(pl.Series(times), time_unit='s'), 'a': values[:, 0], 'b': values[:, 1]})
+                    .fill_nan(None)
+                    .group_by_dynamic('dtm', every='10m')
+                    .agg(pl.col('a', 'b').mean().name.suffix('_mean'),
+                         pl.col('a', 'b').median().name.suffix('_median'),
+                         pl.col('a', 'b').quantile(0.9, interpolation='linear').name.suffix('_p90'),
+                         pl.col('a', 'b').count().cast(pl.Float64).name.suffix('_count')))
+        result = aggregator.drain(600).select(expected.columns)
+        self.assertEqual(len(aggregator.drain(60)), 30)
+        self.assertEqual(result['dtm'].to_list(), expected['dtm'].to_list())
+        self.assertTrue(np.allclose(result.drop('dtm').to_numpy(), expected.drop('dtm').to_numpy()))
+
+    def test_incomplete_reducer(self):
+        class Last(Reducer):
+            def add(self, values, valid):
+                self.last = values
+
+            def result(self, out):
+                out[:] = self.last
+
+        with self.assertRaises(TypeError):
+            Last(2)
+
+    def test_write_leaves_earlier_files(self):
+        aggregator = Aggregator('test', ['a'], windows=[60], reducers=['mean'])
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(config, root=tmp)
+            dataset = DatasetWriter(cfg, 'test')
+            for start in (1722816000, 1722816600):
+                for timestamp in range(start, start + 600, 10):
+                    aggregator.add([timestamp], timestamp)
+                aggregator.write(dataset)
+                if start == 1722816000:
+                    first = {file: file.stat().st_mtime_ns for file in Path(tmp).rglob('*.parquet')}
+            files = {file: file.stat().st_mtime_ns for file in Path(tmp).rglob('*.parquet')}
+            result = scan_dataset(cfg, 'test_1min').collect()
+
+        # NB: the window still open when written is closed by the next sample, and written by the next call
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(files), 2)
+        self.assertEqual({file: files[file] for file in first}, first)
+        self.assertEqual(len(result), 19)
+        self.assertTrue(result['dtm'].is_sorted() and result['dtm'].is_unique().all())
+
+
+class TestP2Quantile(unittest.TestCase):
+    def test_median_bounded_error(self):
+        files = sorted(Path('nrbdaq/tests/data/fidas').glob('*.parquet'))
+        df = pl.concat([pl.read_parquet(file) for file in files], how='diagonal_relaxed').sort('dtm')
+        channels = [col for col in df.columns if col not in ('dtm', 'id', 'checksum')]
+        rows = df.select(channels).to_numpy().astype(float)
+        estimator = P2Quantile(len(channels), q=0.5)
+        for row in rows:
+            estimator.add(row)
+        estimate = np.empty(len(channels))
+        estimator.result(estimate)
+        exact = df.select(pl.col(channels).median()).to_numpy()[0].astype(float)
+
+        # NB: all-NaN channels give NaN; otherwise at most 10% of the records lie between estimate and exact median
+        self.assertTrue(np.array_equal(np.isnan(estimate), np.isnan(exact)))
+        valid = ~np.isnan(exact)
+        rows, estimate, exact = rows[:, valid], estimate[valid], exact[valid]
+        between = (rows > np.minimum(estimate, exact)) & (rows < np.maximum(estimate, exact))
+        self.assertLessEqual((between.sum(axis=0) / (~np.isnan(rows)).sum(axis=0)).max(), 0.1)
+        channels = [channel for channel, ok in zip(channels, valid) if ok]
+        pm = [channels.index(channel) for channel in ['61', '62', '63', '64', '65']]
+        self.assertTrue(np.allclose(estimate[pm], exact[pm], rtol=0.1))
+
+
+class TestIncrementalWriter(unittest.TestCase):
+    def test_append_and_finalize(self):
+        df = pl.read_parquet('nrbdaq/tests/data/fidas/fidas-2025050320.parquet').sort('dtm')
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = IncrementalWriter(Path(tmp) / 'fidas-2025050320.parquet', key='dtm')
+            writer.append(df[:30])
+            writer.append(df[25:])
+            self.assertEqual(len(writer.parts()), 2)
+
+            result = pl.read_parquet(writer.finalize())
+            self.assertEqual(writer.parts(), [])
+        self.assertTrue(result.equals(df))
+
+
+class TestDatasetWriter(unittest.TestCase):
+    def test_write_partitions(self):
+        df = pl.read_parquet('nrbdaq/tests/data/avo/kmd_hq_nairobi_avo_hourly-20240819.parquet')
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(config, root=tmp)
+            dataset = DatasetWriter(cfg, 'avo_hourly')
+            files = dataset.write(df, file='kmd_hq_nairobi')
+            dataset.write(df, file='kmd_hq_nairobi')
+            result = scan_dataset(cfg, 'avo_hourly').filter(pl.col('day')==19).collect()
+
+        self.assertEqual(len(files), df['dtm'].dt.date().n_unique())
+        self.assertEqual(len(result), df.filter(pl.col('dtm').dt.day()==19).height)
+        self.assertEqual(result.schema['dtm'], pl.Datetime('us', 'UTC'))
+        self.assertEqual(result.schema['co2'], pl.Float32)
+
+    def test_normalize_keeps_integers(self):
+        df = pl.DataFrame({'dtm': [datetime(2024, 8, 19, 12)], 'o3': [30.781], 'flags': [0x0C100401]},
+                          schema_overrides={'flags': pl.UInt32})
+        df = DatasetWriter.normalize(df)
+
+        self.assertEqual((df.schema['o3'], df.schema['flags']), (pl.Float32, pl.UInt32))
+        self.assertEqual(df['flags'][0], 0x0C100401)
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def test_replay_drops_torn_record(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = os.path.join(tmp, 'test.wal')
+            wal = WriteAheadLog(file=file)
+            wal.append("2024-08-05T00:00:00,6633\n")
+            wal.append("2024-08-05T00:01:00,6634\n")
+            wal.close()
+            with open(file, 'r+b') as fh:
+                fh.truncate(os.path.getsize(file) - 3)
+
+            wal = WriteAheadLog(file=file)
+            self.assertEqual(wal.replay(), [b"2024-08-05T00:00:00,6633\n"])
+            wal.append("2024-08-05T00:02:00,6635\n")
+            self.assertEqual(len(wal.replay()), 2)
+            wal.truncate()
+            self.assertEqual(wal.replay(), [])
+            wal.close()
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "needs a pseudo terminal")
+class TestSerialPort(unittest.TestCase):
+    def test_command_and_reconnect(self):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+
+        def nephelometer():
+            while os.read(master, 64).endswith(b'\r'):
+                os.write(master, b'2024-08-05 00:00:00, 1.0, 2.0,0F\r\n\n')
+        threading.Thread(target=nephelometer, daemon=True).start()
+
+        port = SerialPort(os.ttyname(slave), baudrate=19200, timeout=5)
+        self.assertEqual(port.command('VI099\r'), b'2024-08-05 00:00:00, 1.0, 2.0,0F\r\n')
+        os.close(port._serial.fd)
+        self.assertEqual(port.command('VI099\r'), b'2024-08-05 00:00:00, 1.0, 2.0,0F\r\n')
+        self.assertEqual(port.reconnects, 1)
+        port.close()
+
+    def test_multiline_reply(self):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+
+        def nephelometer():
+            while os.read(master, 64).endswith(b'\r'):
+                for minute in range(3):
+                    os.write(master, f"2024-08-05 00:0{minute}:00, 1.0, 2.0,0F\r\n\n".encode())
+                    time.sleep(0.05)
+        threading.Thread(target=nephelometer, daemon=True).start()
+
+        port = SerialPort(os.ttyname(slave), baudrate=19200, timeout=5)
+        self.assertEqual(port.command('***D\r').count(b'\r\n'), 1)
+        time.sleep(0.3)
+        self.assertEqual(port.command('***D\r', idle=0.2).count(b'\r\n'), 3)
+        port.close()
+
+    def test_line_reader(self):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+        reader = LineReader(SerialPort(os.ttyname(slave), timeout=5), config=config, timeout=0.2)
+        reader.start()
+        time.sleep(0.5)
+
+        os.write(master, b'"05-aug-24","00:00",  6633')
+        time.sleep(0.5)
+        os.write(master, b',  6332\r\n"05-aug-24","00:05",  6596,  6301\r\n')
+        time.sleep(0.5)
+        lines = reader.drain()
+        reader.stop(timeout=5)
+
+        self.assertEqual([line for dtm, line in lines], [b'"05-aug-24","00:00",  6633,  6332\r',
+                                                         b'"05-aug-24","00:05",  6596,  6301\r'])
+        self.assertEqual(reader.drain(), [])
+
+    def test_line_reader_absent_port(self):
+        reader = LineReader(SerialPort('/dev/nrbdaq-absent', timeout=0.05), config=config, timeout=0.05)
+        with self.assertLogs(reader.logger, level='ERROR') as logs:
+            reader.start()
+            time.sleep(0.5)
+            reader.stop(timeout=5)
+
+        self.assertEqual(len(logs.records), 1)
+
 
 class TestAVO(unittest.TestCase):
     def test_download_data(self):
@@ -59,9 +599,31 @@ class TestAVO(unittest.TestCase):
                               staging=os.path.join(os.path.expanduser(config['root']), config['AVO']['staging']))
         self.assertEqual(station, 'kmd_hq_nairobi')
 
+    def test_compile_data_incremental(self):
+        source = 'nrbdaq/tests/data/avo'
+        with tempfile.TemporaryDirectory() as tmp:
+            shutil.copy(os.path.join(source, 'kmd_hq_nairobi_avo_hourly-20240819.parquet'), tmp)
+            first = avo.compile_data(stations=['kmd_hq_nairobi'], source=tmp, target=os.path.join(tmp, 'compiled'))
+            shutil.copy(os.path.join(source, 'kmd_hq_nairobi_avo_hourly-20240820.parquet'), tmp)
+            second = avo.compile_data(stations=['kmd_hq_nairobi'], source=tmp, target=os.path.join(tmp, 'compiled'))
+            manifest = Manifest(os.path.join(tmp, 'compiled', 'kmd_hq_nairobi_hourly_avo_compiled.parquet'))
+        full = avo.compile_data(stations=['kmd_hq_nairobi'], source=source)
+
+        self.assertEqual(first['kmd_hq_nairobi']['hourly'].height, 48)
+        self.assertTrue(second['kmd_hq_nairobi']['hourly'].equals(full['kmd_hq_nairobi']['hourly']))
+        self.assertEqual(len(manifest.files), 2)
+
 class TestAE31(unittest.TestCase):
+    def setUp(self):
+        # NB: drivers keep WALs and data below root, so keep them out of the configured root
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(config, root=self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
     def test_validate_ae31_csv_file(self):
-        ae31 = AE31(config=config)
+        ae31 = AE31(config=self.config)
         valid_file = 'nrbdaq/tests/data/ae31/AE31_20240825.csv'
         df_valid = ae31.csv_to_df(file=valid_file)
 
@@ -69,14 +631,150 @@ class TestAE31(unittest.TestCase):
         df_test = ae31.csv_to_df(file=test_file)
 
         self.assertEqual(df_valid.schema, df_test.schema)
+        # NB: 6 of the 285 lines are empty records with the time of the PC only
+        self.assertEqual(df_test.height, 279)
+
+    def test_malformed_value_is_not_nulled(self):
+        ae31 = AE31(config=self.config)
+        with open('nrbdaq/tests/data/ae31/AE31_20240805.csv', 'r') as fh:
+            data = fh.read()
+
+        self.assertEqual(ae31.data_to_df(f"{ae31.header}{data}").height, 279)
+        with self.assertLogs(ae31.logger, level='ERROR'):
+            self.assertIsNone(ae31.data_to_df(data.replace('  6633', '  66x3', 1)))
+
+    def test_compile_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ae31 = AE31(config=dict(config, root=tmp))
+            os.makedirs(ae31.data_path, exist_ok=True)
+            for file in ['AE31_20240805.csv', 'AE31_20240825.csv', 'AE31_20240825.csv']:
+                with open(os.path.join('nrbdaq/tests/data/ae31', file), 'r') as fh:
+                    data = fh.read()
+                with open(os.path.join(ae31.data_path, f"{len(os.listdir(ae31.data_path))}_{file}"), 'w') as fh:
+                    fh.write(f"{ae31.header}{data}")
+            df = ae31.compile_data().collect()
+
+        self.assertTrue(df['dtm_ae31'].is_sorted())
+        self.assertFalse(df['dtm_ae31'].is_duplicated().any())
+        self.assertEqual(df['dtm_ae31'].min().year, 2024)
+        self.assertEqual(df.schema['UV370'], pl.Float32)
+
+    def test_recompile_changed_file(self):
+        ae31 = AE31(config=self.config)
+        os.makedirs(ae31.data_path, exist_ok=True)
+        with open('nrbdaq/tests/data/ae31/AE31_20240805.csv', 'r') as fh:
+            lines = fh.readlines()
+        file = os.path.join(ae31.data_path, 'AE31_20240805.csv')
+        with open(file, 'w') as fh:
+            fh.writelines(lines[:100])
+        first = ae31.compile_data(remove_duplicates=False).collect()
+        with open(file, 'a') as fh:
+            fh.writelines(lines[100:])
+        os.utime(file, (time.time() + 1, time.time() + 1))
+        second = ae31.compile_data(remove_duplicates=False).collect()
+
+        # NB: rows of the changed file are replaced, not added again
+        self.assertLess(first.height, second.height)
+        self.assertTrue(second.equals(ae31.csv_to_df(file).sort('dtm_ae31')))
 
 class TestThermo49i(unittest.TestCase):
+    def setUp(self):
+        # NB: drivers keep WALs and data below root, so keep them out of the configured root
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(config, root=self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
     def test_init(self):
-        thermo49i = Thermo49i(config=config)
+        thermo49i = Thermo49i(config=self.config)
 
         self.assertEqual(thermo49i._data, str())
 
+    def test_tcpip_persistent_connection(self):
+        host, port = thermo49i_simulator(no_of_lrec=25)
+        cfg = dict(self.config)
+        cfg['49i'] = dict(config['49i'], socket=dict(config['49i']['socket'], host=host, port=port, pipeline=4))
+        thermo49i = Thermo49i(config=cfg)
+
+        self.assertEqual(thermo49i.get_config(), ['ok'] * len(cfg['49i']['get_config']))
+        self.assertEqual(thermo49i.get_all_lrec(save=False).splitlines(), [lrec_record(i) for i in range(25, 0, -1)])
+        self.assertEqual(thermo49i.latency()['reconnects'], 0)
+
+    def test_lrec_parser(self):
+        parser = LrecParser()
+        labelled, unlabelled = np.zeros(len(parser.columns)), np.zeros(len(parser.columns))
+        record = parser.parse_into(lrec_record(0), labelled)
+        parser.parse_into(record, unlabelled)
+        df = Thermo49i(config=self.config).data_to_df(f"2022-07-19 05:26:05 {record}\n")
+
+        self.assertEqual(record, "05:26 07-19-22 0C100400 30.781 0.000 50927 51732 29.9 53.1 0.0 0.435 0.000 493.7")
+        self.assertEqual(labelled.tolist(), unlabelled.tolist())
+        self.assertEqual(df['dtm_49i'][0], datetime(2022, 7, 19, 5, 26))
+        self.assertEqual([bit for bit in range(32) if df[f"flag_{bit:02d}"][0]], [10, 20, 26, 27])
+        self.assertEqual(df.schema['o3'], pl.Float32)
+        with self.assertRaises(ValueError):
+            parser.parse_into("bad cmd", labelled)
+
+    def test_accumulate_keeps_unparsed_response(self):
+        thermo49i = Thermo49i(config=self.config)
+        thermo49i._serial_com = None
+        for reply in [f"lr00 {lrec_record(0)}", "lr00 bad cmd"]:
+            thermo49i.tcpip_comm = lambda cmd: reply
+            thermo49i.accumulate_lr00()
+        replayed = b''.join(thermo49i.wal.replay()).decode()
+        thermo49i.wal.close()
+
+        self.assertEqual(len(thermo49i.buffer.window()[0]), 1)
+        self.assertEqual([line.split(maxsplit=2)[2] for line in thermo49i._data.splitlines()],
+                         ["05:26 07-19-22 0C100400 30.781 0.000 50927 51732 29.9 53.1 0.0 0.435 0.000 493.7", "lr00 bad cmd"])
+        self.assertEqual(replayed, thermo49i._data)
+
+    def test_backfill_lrec_resumes(self):
+        host, port = thermo49i_simulator(no_of_lrec=95)
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(config, root=tmp)
+            cfg['49i'] = dict(config['49i'], socket=dict(config['49i']['socket'], host=host, port=port, pipeline=2))
+            thermo49i = Thermo49i(config=cfg)
+            send_commands = thermo49i.send_commands
+            thermo49i.send_commands = lambda cmds: [send_commands(cmds)[0], str()] if cmds[0].startswith('lrec 75') else send_commands(cmds)
+            self.assertIsNone(thermo49i.backfill_lrec())
+
+            thermo49i.send_commands = send_commands
+            df = pl.read_parquet(thermo49i.backfill_lrec())
+
+        self.assertEqual(df.height, 95)
+        self.assertTrue(df['dtm'].is_sorted())
+        self.assertEqual(df['flags'][0], 0x0C100400)
+
+class TestAurora3000(unittest.TestCase):
+    def test_replay_skips_bad_records(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(config, root=tmp)
+            wal = open_wal(cfg, 'aurora3000')
+            aurora = Aurora3000(config=cfg)
+            aurora.wal.close()
+            line = f"2025-05-03T20:01:00,{','.join(['1.000'] * len(aurora.minute.columns))}\n"
+            for record in ["2025-05-03T20:00:00,1.0,2.0,3.0\n", "no record\n", line]:
+                wal.append(record)
+            wal.close()
+            aurora = Aurora3000(config=cfg)
+            aurora.wal.close()
+
+        self.assertIsNone(aurora.on_staged)
+        self.assertEqual(aurora._data, line)
+        self.assertEqual(len(aurora.buffer.window()[0]), 1)
+
+
 class TestFidas(unittest.TestCase):
+    def setUp(self):
+        # NB: drivers keep WALs and data below root, so keep them out of the configured root
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(config, root=self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
     def test_transfer_file(self, name="fidas"):
         sftp = SFTPClient(config=config)
 
@@ -87,6 +785,67 @@ class TestFidas(unittest.TestCase):
         sftp.transfer_files(local_path=fidas_staging_path,
                             remote_path=remote_path)
 
+    def test_sendval_parser(self):
+        fidas = FIDAS(config=self.config)
+        parser = SendValParser()
+        record = '6082<sendVal 0=0.0;1=1.0;2=2.0;8=4.8;14=42.4;74=0.0>3E'
+        expected = fidas.parse_record(record)
+
+        self.assertEqual(parser.parse_into(record.encode()), (expected['id'], expected['checksum']))
+        self.assertEqual(dict(zip(parser.channels, parser.row.tolist())),
+                         {k: v for k, v in expected.items() if k not in ('id', 'checksum')})
+
+        # NB: a pair without value makes the record malformed, and no schema is learnt from it
+        malformed = b'6082<sendVal 0=0.0;1;2=2.0>3E'
+        with self.assertRaises(ValueError):
+            parser.parse_into(malformed)
+        fresh = SendValParser()
+        with self.assertRaises(ValueError):
+            fresh.parse_into(malformed)
+        self.assertEqual(fresh.channels, [])
+
+    def test_save_hourly_across_hours(self):
+        fidas = FIDAS(config=self.config)
+        hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        for minutes in ([-3, -1, 1], [3]):
+            df = pl.DataFrame({'dtm': [hour + timedelta(minutes=m) for m in minutes], '60': [float(m) for m in minutes],
+                               'id': 'median', 'checksum': ''})
+            fidas.df_minute = df.with_columns(pl.col('dtm').cast(pl.Datetime('us', 'UTC')))
+            fidas.save_hourly()
+        fidas.wal.close()
+
+        previous = fidas.ensure_output_path(hour - timedelta(hours=1))
+        writer = IncrementalWriter(fidas.ensure_output_path(hour), key='dtm')
+        self.assertEqual(pl.read_parquet(previous)['60'].to_list(), [-3.0, -1.0])
+        self.assertEqual([path.name for path in fidas.staging_path.iterdir()], [previous.name])
+        self.assertFalse(writer.path.exists())
+        self.assertEqual(pl.concat([pl.read_parquet(part) for part in writer.parts()])['60'].to_list(), [1.0, 3.0])
+
+    def test_udp_receiver(self):
+        record = b'6082<sendVal 0=0.0;1=1.0;60=294.3;61=0.0092>3E'
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(config, root=tmp, fidas=dict(config['fidas'], socket=dict(config['fidas']['socket'], host='127.0.0.1', port=0)))
+            fidas = FIDAS(config=cfg)
+            fidas.connect_udp()
+            try:
+                address = fidas.receiver.sock.getsockname()
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+                    for datagram in [record, record[:20], record[20:], b'6082 no record>']:
+                        sender.sendto(datagram, address)
+                deadline = time.time() + 5
+                while fidas.receiver.records < 3 and time.time() < deadline:
+                    time.sleep(0.01)
+                start = time.time()
+                fidas.collect_raw_record()
+            finally:
+                fidas.receiver.stop()
+
+            times, rows = fidas.raw_records.window()
+            self.assertEqual(fidas.status()['received'], 4)
+            self.assertEqual((fidas.parsed, fidas.malformed, fidas.status()['dropped']), (2, 1, 0))
+            self.assertEqual(rows[:, fidas.parser.channels.index('60')].tolist(), [294.3, 294.3])
+            self.assertTrue((times <= start).all())
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
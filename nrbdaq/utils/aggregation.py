@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Aggregation of instrument samples.
+
+BlockStatistics collects the samples of one averaging period (e.g., a minute) in a preallocated
+block, and reduces them to count, mean, std, median, min and max per channel, and to the mode of
+state channels (e.g., status words, whose mean is meaningless). The statistics are written to a
+row of a columnar buffer (e.g., RingBuffer.slot()), laid out as BlockStatistics.columns.
+
+Aggregator is the streaming stage every driver feeds its raw samples into. It reduces them to
+several windows at once (e.g., 1 min, 10 min, 1 h, aligned to the clock), with reducers such as
+mean, median, percentiles and count. Each sample updates the state of the current window of each
+resolution in place, so the multi-resolution products come out of a single pass during
+acquisition. When a sample falls into the next window, the row of the window just closed is
+added to a RingBuffer, from which write() adds it to the common dataset as instrument
+'<instrument>_<window>' (e.g., fidas_10min), one new file per day partition and call.
+
+Mean, count, min and max keep a fixed state per channel. Quantiles are estimated with the P²
+algorithm (P2Quantile: 5 markers per channel, whatever the number of samples), or, if requested,
+exact as long as a window has no more samples than their capacity; beyond, they are estimated
+from a uniform sample of that size (Quantile, reservoir sampling). Either way, memory never grows
+with the sampling rate.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import re
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+import polars as pl
+
+from nrbdaq.utils.ringbuffer import RingBuffer
+
+
+class BlockStatistics:
+    """
+    Statistics of the samples of one averaging period.
+
+    Available methods include
+    - add(): copy a sample into the block
+    - reduce(): write statistics to a row, then empty the block
+    """
+
+    STATISTICS = ('std', 'median', 'min', 'max')
+
+    def __init__(self, capacity: int, channels: list[str], states: list[str]=None):
+        """
+        Args:
+            capacity (int): maximum number of samples per period; further samples are counted as dropped
+            channels (list[str]): names of the values of a sample, in order
+            states (list[str], optional): channels reduced to their mode. Defaults to None.
+        """
+        states = set(states or list())
+        self.channels = list(channels)
+        self.numeric = [channel for channel in self.channels if channel not in states]
+        self.states = [channel for channel in self.channels if channel in states]
+        # NB: the block holds numeric channels first, so that statistics are computed on a view
+        self._order = np.array([self.channels.index(channel) for channel in self.numeric + self.states])
+        self.block = np.full((int(capacity), len(self.channels)), np.nan)
+        self.n = 0
+        self.dropped = 0
+
+        # means and modes keep the channel names, then count and further statistics
+        k = len(self.numeric)
+        self.columns = self.channels + ['n'] + [f"{channel}_{stat}" for stat in self.STATISTICS for channel in self.numeric]
+        self._mean = np.array([self.columns.index(channel) for channel in self.numeric])
+        self._mode = np.array([self.columns.index(channel) for channel in self.states], dtype=int)
+        self._stats = {stat: slice(len(self.channels) + 1 + i * k, len(self.channels) + 1 + (i + 1) * k)
+                       for i, stat in enumerate(self.STATISTICS)}
+        self._values = np.full(k, np.nan)
+
+
+    def __len__(self) -> int:
+        return self.n
+
+
+    def add(self, values) -> bool:
+        """Add a sample, in the order of channels. Returns False if the block is full."""
+        if self.n >= self.block.shape[0]:
+            self.dropped += 1
+            return False
+        np.take(np.asarray(values, dtype=float), self._order, out=self.block[self.n])
+        self.n += 1
+        return True
+
+
+    def reduce(self, row: np.ndarray) -> int:
+        """Write the statistics of the samples added so far to row, then empty the block.
+
+        Args:
+            row (np.ndarray): row of len(self.columns) floats
+
+        Returns:
+            int: number of samples reduced; if 0, row is filled with NaN
+        """
+        n = self.n
+        row.fill(np.nan)
+        if n:
+            k = len(self.numeric)
+            values = self.block[:n, :k]
+            np.mean(values, axis=0, out=self._values)
+            row[self._mean] = self._values
+            np.std(values, axis=0, out=row[self._stats['std']])
+            np.min(values, axis=0, out=row[self._stats['min']])
+            np.max(values, axis=0, out=row[self._stats['max']])
+            # NB: median partially sorts the block in place; it is emptied anyway
+            np.median(values, axis=0, out=row[self._stats['median']], overwrite_input=True)
+            for i, column in enumerate(self._mode):
+                states, counts = np.unique(self.block[:n, k + i], return_counts=True)
+                row[column] = states[np.argmax(counts)]
+            row[len(self.channels)] = n
+        self.n = 0
+        return n
+
+
+class Reducer(ABC):
+    """
+    State of one statistic of all channels over the current window.
+
+    Available methods include
+    - add(): update the state with a sample (NaN is ignored)
+    - result(): write the statistic to an array
+    - reset(): start a new window
+    """
+
+    def __init__(self, width: int):
+        self.width = int(width)
+
+
+    @abstractmethod
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        pass
+
+
+    @abstractmethod
+    def result(self, out: np.ndarray) -> None:
+        pass
+
+
+    @abstractmethod
+    def reset(self) -> None:
+        pass
+
+
+class Count(Reducer):
+    def __init__(self, width: int):
+        super().__init__(width)
+        self.n = np.zeros(self.width)
+
+
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        self.n += valid
+
+
+    def result(self, out: np.ndarray) -> None:
+        out[:] = self.n
+
+
+    def reset(self) -> None:
+        self.n.fill(0)
+
+
+class Mean(Count):
+    def __init__(self, width: int):
+        super().__init__(width)
+        self.sum = np.zeros(self.width)
+
+
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        self.n += valid
+        np.add(self.sum, values, out=self.sum, where=valid)
+
+
+    def result(self, out: np.ndarray) -> None:
+        np.divide(self.sum, self.n, out=out, where=self.n > 0)
+        out[self.n == 0] = np.nan
+
+
+    def reset(self) -> None:
+        self.n.fill(0)
+        self.sum.fill(0)
+
+
+class Min(Reducer):
+    def __init__(self, width: int):
+        super().__init__(width)
+        self.value = np.full(self.width, np.nan)
+
+
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        # NB: fmin/fmax return the other operand if one is NaN
+        np.fmin(self.value, values, out=self.value)
+
+
+    def result(self, out: np.ndarray) -> None:
+        out[:] = self.value
+
+
+    def reset(self) -> None:
+        self.value.fill(np.nan)
+
+
+class Max(Min):
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        np.fmax(self.value, values, out=self.value)
+
+
+class Quantile(Reducer):
+    """Quantile q of the samples of a window, from at most capacity samples per window (reservoir sampling)."""
+
+    def __init__(self, width: int, q: float, capacity: int=3600, seed: int=None):
+        super().__init__(width)
+        self.q = float(q)
+        self.block = np.full((int(capacity), self.width), np.nan)
+        self.n = 0
+        self._rng = np.random.default_rng(seed)
+
+
+    def add(self, values: np.ndarray, valid: np.ndarray) -> None:
+        if self.n < self.block.shape[0]:
+            self.block[self.n] = values
+        else:
+            # NB: keep each of the n + 1 samples with equal probability
+            i = self._rng.integers(0, self.n + 1)
+            if i < self.block.shape[0]:
+                self.block[i] = values
+        self.n += 1
+
+
+    def result(self, out: np.ndarray) -> None:
+        rows = self.block[:min(self.n, self.block.shape[0])]
+        out[:] = np.nan
+        valid = ~np.isnan(rows).all(axis=0) if len(rows) else np.zeros(self.width, dtype=bool)
+        if valid.any():
+            out[valid] = np.nanquantile(rows[:, valid], self.q, axis=0)
+
+
+    def reset(self) -> None:
+        self.n = 0
+
+
+REDUCERS = {'count': Count, 'mean': Mean, 'min': Min, 'max': Max}
+
+
+class P2Quantile(Reducer):
+    """
+    Quantile q of a stream, estimated with the P² algorithm (Jain and Chlamtac, 1985) for all channels at once.
+
+    Five markers per channel track the minimum, q/2, q, (1+q)/2 and the maximum. Each sample moves the
+    markers by at most one position, adjusting their heights with a piecewise-parabolic fit, so state
+    and cost per sample are constant. With fewer than 5 samples, the quantile is exact.
+    """
+
+    def __init__(self, width: int, q: float=0.5):
+        super().__init__(width)
+        self.q = float(q)
+        self._increments = np.array([0.0, self.q / 2, self.q, (1 + self.q) / 2, 1.0])[:, None]
+        self.heights = np.empty((5, self.width))
+        self.positions = np.empty((5, self.width))
+        self.desired = np.empty((5, self.width))
+        self.n = np.zeros(self.width, dtype=np.int64)
+        self.reset()
+
+
+    def reset(self) -> None:
+        self.heights.fill(np.nan)
+        self.positions[:] = np.arange(1, 6)[:, None]
+        self.desired[:] = 1 + 4 * self._increments
+        self.n.fill(0)
+
+
+    def add(self, values: np.ndarray, valid: np.ndarray=None) -> None:
+        values = np.asarray(values, dtype=float)
+        if valid is None:
+            valid = ~np.isnan(values)
+        running = valid & (self.n >= 5)
+
+        # first 5 samples of a channel: keep them, sorted once complete
+        init = np.flatnonzero(valid & (self.n < 5))
+        if init.size:
+            self.heights[self.n[init], init] = values[init]
+            self.n[init] += 1
+            full = init[self.n[init] == 5]
+            if full.size:
+                self.heights[:, full] = np.sort(self.heights[:, full], axis=0)
+        if not running.any():
+            return
+
+        ch = np.flatnonzero(running)
+        x = values[ch]
+        q = self.heights[:, ch]
+        n = self.positions[:, ch]
+        # cell k of x (q[k] <= x < q[k+1]); extremes extend the outer markers
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        k = np.minimum((x[None, :] >= q[1:4]).sum(axis=0), 3)
+        n += np.arange(5)[:, None] > k[None, :]
+        self.desired[:, ch] += self._increments
+        d = self.desired[:, ch] - n
+
+        for i in (1, 2, 3):
+            move = ((d[i] >= 1) & (n[i + 1] - n[i] > 1)) | ((d[i] <= -1) & (n[i - 1] - n[i] < -1))
+            if not move.any():
+                continue
+            s = np.sign(d[i, move])
+            qm, qi, qp = q[i - 1, move], q[i, move], q[i + 1, move]
+            nm, ni, np_ = n[i - 1, move], n[i, move], n[i + 1, move]
+            parabolic = qi + s / (np_ - nm) * ((ni - nm + s) * (qp - qi) / (np_ - ni)
+                                               + (np_ - ni - s) * (qi - qm) / (ni - nm))
+            # NB: fall back to linear interpolation if the parabola leaves the neighbouring heights
+            linear = qi + s * (np.where(s > 0, qp, qm) - qi) / (np.where(s > 0, np_, nm) - ni)
+            q[i, move] = np.where((qm < parabolic) & (parabolic < qp), parabolic, linear)
+            n[i, move] += s
+
+        self.heights[:, ch] = q
+        self.positions[:, ch] = n
+        self.n[ch] += 1
+
+
+    def result(self, out: np.ndarray) -> None:
+        out[:] = self.heights[2]
+        out[self.n == 0] = np.nan
+        for ch in np.flatnonzero((self.n > 0) & (self.n < 5)):
+            out[ch] = np.quantile(self.heights[:self.n[ch], ch], self.q)
+
+
+def reducer(name: str, width: int, capacity: int=3600, method: str='p2') -> Reducer:
+    """Return the Reducer named name, i.e., count, mean, min, max, median or p<percentile> (e.g., p90, p2.5).
+
+    Args:
+        name (str): reducer
+        width (int): number of channels
+        capacity (int, optional): samples kept per window by exact quantiles. Defaults to 3600.
+        method (str, optional): quantiles, 'p2' (P2Quantile) or 'exact' (Quantile). Defaults to 'p2'.
+    """
+    if name in REDUCERS:
+        return REDUCERS[name](width)
+    match = re.fullmatch(r'p(\d+(?:\.\d+)?)', name)
+    if name == 'median' or (match and float(match.group(1)) <= 100):
+        q = 0.5 if name == 'median' else float(match.group(1)) / 100
+        if method == 'p2':
+            return P2Quantile(width, q=q)
+        if method == 'exact':
+            return Quantile(width, q=q, capacity=capacity)
+        raise ValueError(f"unknown quantile method '{method}'")
+    raise ValueError(f"unknown reducer '{name}'")
+
+
+class Aggregator:
+    """
+    Reduce a stream of samples to windows of several resolutions in one pass.
+
+    Available methods include
+    - add(): add a sample with its timestamp
+    - flush(): close the current windows
+    - drain(): rows of closed windows of a resolution, as pl.DataFrame
+    - write(): add rows of closed windows to the common dataset
+    """
+
+    def __init__(self, instrument: str, channels: list[str], windows: list[int]=(60, 600, 3600),
+                 reducers: list[str]=('mean', 'median', 'count'), capacity: int=1440, quantile_capacity: int=3600,
+                 quantile_method: str='p2'):
+        """
+        Args:
+            instrument (str): name of the instrument, used for the dataset
+            channels (list[str]): names of the values of a sample, in order
+            windows (list[int], optional): window lengths [s], aligned to multiples of their length since the epoch. Defaults to (60, 600, 3600).
+            reducers (list[str], optional): names of reducers, see reducer(). Defaults to ('mean', 'median', 'count').
+            capacity (int, optional): closed windows kept per resolution until written. Defaults to 1440.
+            quantile_capacity (int, optional): samples per window kept for exact quantiles. Defaults to 3600.
+            quantile_method (str, optional): 'p2' or 'exact', see reducer(). Defaults to 'p2'.
+        """
+        self.instrument = instrument
+        self.channels = list(channels)
+        self.windows = sorted(int(window) for window in windows)
+        self.reducers = list(reducers)
+        self.columns = [f"{channel}_{name}" for name in self.reducers for channel in self.channels]
+        width = len(self.channels)
+        self._state = {window: [reducer(name, width, capacity=quantile_capacity, method=quantile_method) for name in self.reducers]
+                       for window in self.windows}
+        self._start = {window: None for window in self.windows}
+        self.closed = {window: RingBuffer(capacity=capacity, width=len(self.columns)) for window in self.windows}
+        self.samples = 0
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def label(window: int) -> str:
+        """Return the name of a resolution, e.g., 10min, 1h, 30s."""
+        if window % 3600 == 0:
+            return f"{window // 3600}h"
+        if window % 60 == 0:
+            return f"{window // 60}min"
+        return f"{window}s"
+
+
+    def _close(self, window: int) -> None:
+        row = self.closed[window].slot()
+        width = len(self.channels)
+        for i, state in enumerate(self._state[window]):
+            state.result(row[i * width:(i + 1) * width])
+            state.reset()
+        self.closed[window].commit(self._start[window])
+        self._start[window] = None
+
+
+    def add(self, values, timestamp: float) -> None:
+        """Add a sample.
+
+        Args:
+            values: values of a sample, in the order of channels; NaN for missing values
+            timestamp (float): time of the sample [s since epoch, UTC]
+        """
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        with self._lock:
+            for window in self.windows:
+                start = timestamp - timestamp % window
+                if self._start[window] != start:
+                    if self._start[window] is not None:
+                        self._close(window)
+                    self._start[window] = start
+                for state in self._state[window]:
+                    state.add(values, valid)
+            self.samples += 1
+
+
+    def flush(self) -> None:
+        """Close the current windows of all resolutions, e.g., before the driver exits."""
+        with self._lock:
+            for window in self.windows:
+                if self._start[window] is not None:
+                    self._close(window)
+
+
+    def drain(self, window: int) -> pl.DataFrame:
+        """Return the rows of the closed windows of a resolution (dtm = start of window), and remove them."""
+        with self._lock:
+            times, rows = self.closed[window].drain()
+        df = pl.DataFrame({'dtm': times, **dict(zip(self.columns, rows.T))})
+        return df.with_columns(pl.from_epoch(pl.col('dtm').round(), time_unit='s').dt.cast_time_unit('us'))
+
+
+    def write(self, dataset) -> None:
+        """Add the rows of all closed windows to dataset (a DatasetWriter), as instrument '<instrument>_<window>'.
+
+        Each call writes the rows drained as new files, so its cost does not grow with the files of the
+        day written so far. Rows are drained once, so the files of a resolution do not overlap.
+        """
+        for window in self.windows:
+            df = self.drain(window)
+            if not df.is_empty():
+                dataset.write(df, instrument=f"{self.instrument}_{self.label(window)}")
+
+
+def open_aggregator(config: dict, instrument: str, channels: list[str]) -> Aggregator | None:
+    """Return the Aggregator of an instrument, or None if aggregation is not enabled.
+
+    Args:
+        config (dict): general configuration
+                config['aggregation']['enabled']: (optional) Defaults to False.
+                config['aggregation']['windows']: (optional) window lengths [min]. Defaults to [1, 10, 60].
+                config['aggregation']['reducers']: (optional) Defaults to [mean, median, count].
+                config['aggregation']['quantile_method']: (optional) p2 or exact. Defaults to p2.
+                config['aggregation']['quantile_capacity']: (optional) Defaults to 3600.
+        instrument (str): name of the instrument, used for the dataset
+        channels (list[str]): names of the values of a sample, in order
+
+    Returns:
+        Aggregator | None
+    """
+    cfg = config.get('aggregation', {}) or {}
+    if not cfg.get('enabled', False):
+        return None
+    windows = [int(60 * float(minutes)) for minutes in cfg.get('windows', [1, 10, 60])]
+    # NB: keep closed windows of a day, i.e., more than the longest interval between saves
+    return Aggregator(instrument=instrument, channels=channels, windows=windows,
+                      reducers=cfg.get('reducers', ['mean', 'median', 'count']),
+                      capacity=max(2, 86400 // min(windows)),
+                      quantile_capacity=int(cfg.get('quantile_capacity', 3600)),
+                      quantile_method=cfg.get('quantile_method', 'p2'))
+
+
+if __name__ == "__main__":
+    pass
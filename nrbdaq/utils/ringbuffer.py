@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fixed-capacity, columnar ring buffer for numeric records.
+
+Records are rows of a preallocated float array (rows x channels), with their arrival time kept in a
+parallel array. Memory is allocated once; when the buffer is full, the oldest rows are overwritten.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import time
+import warnings
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Keep the most recent records of a fixed number of channels.
+
+    Available methods include
+    - slot(): the row the next record is written to
+    - commit(): add the record written to slot()
+    - append(): copy a record into the buffer
+    - window(): timestamps and rows, oldest first
+    - drain(): window(), then empty the buffer
+    - nanmedian(): median of each channel, ignoring NaN
+    """
+
+    def __init__(self, capacity: int, width: int, dtype=np.float64):
+        """
+        Args:
+            capacity (int): number of records kept
+            width (int): number of channels per record
+            dtype (optional): Defaults to np.float64.
+        """
+        self.capacity = int(capacity)
+        self.width = int(width)
+        self.data = np.full((self.capacity, self.width), np.nan, dtype=dtype)
+        self.times = np.full(self.capacity, np.nan)
+        self._head = 0
+        self._count = 0
+        self.overwritten = 0
+
+
+    def __len__(self) -> int:
+        return self._count
+
+
+    def slot(self) -> np.ndarray:
+        """Return a view of the row the next record is to be written to (NaN-filled)."""
+        row = self.data[self._head]
+        row.fill(np.nan)
+        return row
+
+
+    def commit(self, timestamp: float=None) -> None:
+        """Add the record written to slot().
+
+        Args:
+            timestamp (float, optional): time of the record. Defaults to None (= time.time()).
+        """
+        self.times[self._head] = time.time() if timestamp is None else timestamp
+        self._head = (self._head + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+        else:
+            self.overwritten += 1
+
+
+    def append(self, row: np.ndarray, timestamp: float=None) -> None:
+        self.data[self._head] = row
+        self.commit(timestamp=timestamp)
+
+
+    def _order(self) -> np.ndarray:
+        return (np.arange(self._head - self._count, self._head)) % self.capacity
+
+
+    def window(self, since: float=None) -> tuple[np.ndarray, np.ndarray]:
+        """Return timestamps and rows (copies), oldest first.
+
+        Args:
+            since (float, optional): only records with timestamp >= since. Defaults to None (= all).
+        """
+        idx = self._order()
+        if since is not None:
+            idx = idx[self.times[idx] >= since]
+        return self.times[idx], self.data[idx]
+
+
+    def drain(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return window(), then empty the buffer."""
+        times, rows = self.window()
+        self._count = 0
+        return times, rows
+
+
+    def nanmedian(self, since: float=None) -> np.ndarray:
+        """Return the median of each channel over window(since), ignoring NaN (NaN if a channel has no data)."""
+        return nanmedian(self.window(since=since)[1])
+
+
+def nanmedian(rows: np.ndarray) -> np.ndarray:
+    """Column-wise median of a 2-d array, ignoring NaN, without warnings for all-NaN columns."""
+    if rows.shape[0] == 0:
+        return np.full(rows.shape[1], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(rows, axis=0)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asyncio based runtime for the jobs set up by the instrument drivers.
+
+The drivers keep registering their jobs with schedule (setup_schedules). Instead of polling
+schedule.run_pending() once a second on a single thread, AsyncRuntime runs every job as its own
+asyncio task. Blocking serial and socket I/O is offloaded to one single-threaded executor per
+driver, so a driver waiting for its instrument never delays the jobs of another driver, while the
+jobs of one driver still never run concurrently.
+
+Interval jobs (e.g., every 5 seconds) run on a grid of monotonic-clock deadlines that starts at
+the next multiple of the interval on the wall clock (e.g., :00, :05, :10 ...) and does not drift.
+Jobs at a given time (e.g., every hour at :01) follow the wall-clock calendar computed by schedule.
+Lateness is measured when a job starts, i.e., it includes waiting for other jobs of its driver.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import asyncio
+import datetime
+import functools
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import schedule
+
+
+class AsyncRuntime:
+    """
+    Run schedule jobs as asyncio tasks, one executor per driver.
+
+    Available methods include
+    - run(): run jobs until interrupted
+    - stats(): number of runs and maximum lateness per job
+    - log_stats(): write stats() to the log
+    """
+
+    def __init__(self, config: dict):
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+        self.logger.info("Initialize AsyncRuntime")
+
+        self._executors = dict()
+        self._stats = dict()
+
+
+    @staticmethod
+    def _owner(job: schedule.Job) -> str:
+        """Return a key identifying the driver a job belongs to (bound object, or module of a function)."""
+        func = job.job_func.func if isinstance(job.job_func, functools.partial) else job.job_func
+        owner = getattr(func, '__self__', None)
+        if owner is not None:
+            return f"{type(owner).__name__}-{id(owner)}"
+        return getattr(func, '__module__', None) or repr(func)
+
+
+    def _executor(self, owner: str) -> ThreadPoolExecutor:
+        if owner not in self._executors:
+            self._executors[owner] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=owner.split('-')[0])
+        return self._executors[owner]
+
+
+    def stats(self) -> dict:
+        """Return number of runs and maximum lateness [s] of each job."""
+        return {name: dict(value) for name, value in self._stats.items()}
+
+
+    def log_stats(self) -> None:
+        self.logger.info(f"AsyncRuntime: {self.stats()}", extra={'to_logfile': True})
+
+
+    @staticmethod
+    def _next_tick(period: float) -> float:
+        """Return the monotonic-clock time of the next multiple of period [s] on the wall clock."""
+        now = time.time()
+        return time.monotonic() + (math.ceil(now / period) * period - now)
+
+
+    @staticmethod
+    def _run(job: schedule.Job, stats: dict, deadline: float):
+        """Run job on the executor of its driver, recording lateness including any wait for other jobs of the driver."""
+        stats['max_lateness_s'] = round(max(stats['max_lateness_s'], time.monotonic() - deadline), 3)
+        return job.run()
+
+
+    async def _run_job(self, job: schedule.Job) -> None:
+        loop = asyncio.get_running_loop()
+        owner = self._owner(job)
+        executor = self._executor(owner)
+        name = f"{owner.split('-')[0]}.{getattr(job.job_func, '__name__', repr(job.job_func))}"
+        stats = self._stats.setdefault(f"{name} ({job.interval} {job.unit})", {'runs': 0, 'max_lateness_s': 0.0})
+
+        interval = job.at_time is None and job.unit in ('seconds', 'minutes', 'hours')
+        if interval:
+            period = datetime.timedelta(**{job.unit: job.interval}).total_seconds()
+            deadline = self._next_tick(period)
+
+        while True:
+            if not interval:
+                deadline = time.monotonic() + (job.next_run - datetime.datetime.now()).total_seconds()
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+
+            try:
+                result = await loop.run_in_executor(executor, self._run, job, stats, deadline)
+                stats['runs'] += 1
+                if result is schedule.CancelJob or isinstance(result, schedule.CancelJob):
+                    self.logger.info(f"AsyncRuntime: {name} cancelled")
+                    return
+            except Exception as err:
+                self.logger.error(f"AsyncRuntime: {name}: {err}")
+                if not interval:
+                    # job.run() did not get to reschedule the failed job
+                    job._schedule_next_run()
+
+            if interval:
+                # next deadline on the grid, skipping ticks missed while the job was running
+                deadline += period * max(1, -(-(time.monotonic() - deadline) // period))
+
+
+    async def _main(self, jobs: list) -> None:
+        tasks = [asyncio.create_task(self._run_job(job)) for job in jobs]
+        self.logger.info(f"AsyncRuntime: {len(tasks)} jobs in {len({self._owner(job) for job in jobs})} drivers")
+        await asyncio.gather(*tasks)
+
+
+    def run(self, jobs: list=None) -> None:
+        """Run jobs (default: all jobs registered with schedule) until interrupted.
+
+        Args:
+            jobs (list, optional): schedule.Job objects. Defaults to None (= schedule.get_jobs()).
+        """
+        if jobs is None:
+            jobs = schedule.get_jobs()
+        try:
+            asyncio.run(self._main(jobs))
+        finally:
+            for executor in self._executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    pass
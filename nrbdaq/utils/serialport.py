@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Serial ports kept open for the lifetime of the process.
+
+Opening a port toggles DTR and discards bytes the driver has buffered, so instrument drivers get
+their port from serial_port() and keep using it. A port is opened on first use, and closed and
+reopened once (e.g., after the USB adapter was replugged) when an operation fails with a
+SerialException. Replies are framed by their terminator (read_until), so a command returns as
+soon as its reply has arrived, and only waits for the timeout if it does not. Replies of several
+lines (e.g., data or configuration dumps) are read until the instrument has been silent for a
+short idle time.
+
+Instruments that send data unprompted (e.g., AE31) are read by a LineReader thread, which drains
+the port continuously into a queue of lines stamped with their time of arrival. The schedule only
+consumes that queue, so it never blocks on the port, and no line is lost between jobs.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import serial
+
+try:
+    import termios
+    # NB: ioctls on a port whose device has gone away fail with termios.error rather than SerialException
+    _ERRORS = (serial.SerialException, OSError, termios.error)
+except ImportError:
+    _ERRORS = (serial.SerialException, OSError)
+
+_ports = dict()
+_ports_lock = threading.Lock()
+
+
+class SerialPort:
+    """
+    Serial port that stays open and reconnects after a SerialException.
+
+    Available methods include
+    - readline(): read up to and including a terminator
+    - command(): send a command and read its reply
+    - close()
+    """
+
+    def __init__(self, port: str, baudrate: int=9600, bytesize: int=8, parity: str='N', stopbits: int=1,
+                 timeout: float=1.0):
+        """
+        Args:
+            port (str): device, e.g., /dev/ttyUSB0
+            baudrate (int, optional): Defaults to 9600.
+            bytesize (int, optional): Defaults to 8.
+            parity (str, optional): Defaults to 'N'.
+            stopbits (int, optional): Defaults to 1.
+            timeout (float, optional): seconds to wait for a terminator. Defaults to 1.0.
+        """
+        self.port = port
+        self.settings = dict(baudrate=baudrate, bytesize=bytesize, parity=parity, stopbits=stopbits)
+        self.timeout = float(timeout)
+        self.reconnects = 0
+        self._serial = None
+        self._lock = threading.RLock()
+
+
+    @property
+    def is_open(self) -> bool:
+        return self._serial is not None and self._serial.is_open
+
+
+    def _open(self) -> serial.Serial:
+        if not self.is_open:
+            self._serial = serial.Serial(self.port, timeout=self.timeout, **self.settings)
+        return self._serial
+
+
+    def close(self) -> None:
+        with self._lock:
+            if self._serial is not None:
+                try:
+                    self._serial.close()
+                except _ERRORS:
+                    pass
+                self._serial = None
+
+
+    def _call(self, func):
+        """Run func(serial.Serial) on the open port. After a SerialException, reopen the port and try once more."""
+        with self._lock:
+            try:
+                return func(self._open())
+            except _ERRORS:
+                self.close()
+                self.reconnects += 1
+                return func(self._open())
+
+
+    def readline(self, terminator: bytes=b'\n', timeout: float=None) -> bytes:
+        """Read up to and including terminator.
+
+        Args:
+            terminator (bytes, optional): Defaults to b'\\n'.
+            timeout (float, optional): seconds. Defaults to None (= self.timeout).
+
+        Returns:
+            bytes: line read; incomplete (without terminator) or empty if the timeout expired
+        """
+        def read(ser: serial.Serial) -> bytes:
+            ser.timeout = self.timeout if timeout is None else timeout
+            return ser.read_until(terminator)
+        return self._call(read)
+
+
+    def command(self, cmd: bytes | str, terminator: bytes=b'\r\n', timeout: float=None, idle: float=None) -> bytes:
+        """Send cmd and return the reply, framed by terminator. Bytes left over from earlier replies are discarded.
+
+        Args:
+            cmd (bytes | str): command, including its own terminator if the instrument requires one
+            terminator (bytes, optional): end of reply, or of each line of a reply. Defaults to b'\\r\\n'.
+            timeout (float, optional): seconds to wait for the (first line of the) reply. Defaults to None (= self.timeout).
+            idle (float, optional): for replies of several lines, seconds of silence that end the reply.
+                Defaults to None (= the reply is a single line).
+
+        Returns:
+            bytes: reply, including terminator
+        """
+        if isinstance(cmd, str):
+            cmd = cmd.encode('ascii')
+
+        def transact(ser: serial.Serial) -> bytes:
+            ser.reset_input_buffer()
+            ser.write(cmd)
+            ser.timeout = self.timeout if timeout is None else timeout
+            reply = ser.read_until(terminator)
+            if idle:
+                ser.timeout = idle
+                while line := ser.read_until(terminator):
+                    reply += line
+            return reply
+        return self._call(transact)
+
+
+class LineReader(threading.Thread):
+    """
+    Read lines from a SerialPort in a background thread.
+
+    Available methods include
+    - drain(): lines received so far, with their time of arrival
+    - stop(): stop reading
+    """
+
+    def __init__(self, port: SerialPort, config: dict, terminator: bytes=b'\n', timeout: float=1.0):
+        """
+        Args:
+            port (SerialPort): port to read from
+            config (dict): general configuration
+            terminator (bytes, optional): end of line. Defaults to b'\\n'.
+            timeout (float, optional): seconds per read, i.e., the delay of stop(). Defaults to 1.0.
+        """
+        super().__init__(name=f"reader-{os.path.basename(port.port)}", daemon=True)
+
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+
+        self.port = port
+        self.terminator = terminator
+        self.timeout = timeout
+        self.received = 0
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+
+
+    def drain(self) -> list[tuple[datetime, bytes]]:
+        """Return the lines received since the last call, oldest first, as (time of arrival, line without terminator)."""
+        lines = list()
+        while True:
+            try:
+                lines.append(self._queue.get_nowait())
+            except queue.Empty:
+                return lines
+
+
+    def stop(self, timeout: float=None) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+
+
+    def run(self) -> None:
+        self.logger.info(f"LineReader {self.port.port} started")
+        line = bytes()
+        failing = False
+        while not self._stop_event.is_set():
+            try:
+                # NB: a read that times out returns what has arrived so far; the rest of the line follows
+                line += self.port.readline(terminator=self.terminator, timeout=self.timeout)
+                if failing:
+                    self.logger.info(f"LineReader {self.port.port}: port is back")
+                    failing = False
+                if line.endswith(self.terminator):
+                    self._queue.put((datetime.now(), line[:-len(self.terminator)]))
+                    self.received += 1
+                    line = bytes()
+            except Exception as err:
+                # NB: log once while the port is absent (e.g., unplugged), not once per attempt
+                if not failing:
+                    self.logger.error(f"LineReader {self.port.port}: {err}")
+                    failing = True
+                time.sleep(self.timeout)
+        self.logger.info(f"LineReader {self.port.port} stopped")
+
+
+def serial_port(port: str, **kwargs) -> SerialPort:
+    """Return the SerialPort of device port, shared by all its users in this process.
+
+    Args:
+        port (str): device, e.g., /dev/ttyUSB0
+        **kwargs: settings of SerialPort, used when the port is first requested
+
+    Returns:
+        SerialPort: port, opened on first use
+    """
+    with _ports_lock:
+        if port not in _ports:
+            _ports[port] = SerialPort(port, **kwargs)
+        return _ports[port]
+
+
+if __name__ == "__main__":
+    pass
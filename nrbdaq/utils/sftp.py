@@ -5,18 +5,74 @@ Manage file transfer. Currently, sftp transfer to MeteoSwiss is supported.
 
 @author: joerg.klausen@meteoswiss.ch
 """
+import hashlib
+import json
 import logging
 import os
+import posixpath
 import re
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import paramiko
 import schedule
 
 
+class TransferJournal:
+    """
+    Small on-disk journal of uploads in progress, used to resume interrupted uploads.
+
+    Entries are keyed by local file and hold the remote file, the local size and sha256 checksum
+    at the start of the upload, and the last offset sent. The journal is rewritten atomically.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = threading.Lock()
+        self._entries = dict()
+        try:
+            with open(self.file, 'r') as fh:
+                self._entries = {k: v for k, v in json.load(fh).items() if os.path.exists(k)}
+        except (FileNotFoundError, ValueError):
+            pass
+
+
+    def _write(self) -> None:
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        tmp = f"{self.file}.tmp"
+        with open(tmp, 'w') as fh:
+            json.dump(self._entries, fh)
+        os.replace(tmp, self.file)
+
+
+    def get(self, local_file: str) -> dict:
+        with self._lock:
+            return dict(self._entries.get(local_file, {}))
+
+
+    def set(self, local_file: str, **entry) -> None:
+        with self._lock:
+            self._entries.setdefault(local_file, {}).update(entry)
+            self._write()
+
+
+    def remove(self, local_file: str) -> None:
+        with self._lock:
+            if self._entries.pop(local_file, None) is not None:
+                self._write()
+
+
 class SFTPClient:
     """
     SFTP based file handling, optionally using SOCKS5 proxy.
 
+    All methods share one long-lived SSH session. SFTP channels opened on this session are kept
+    in a small pool and handed out by session(). The session is re-established transparently if
+    the transport died, and closed after it has been idle for more than idle_timeout seconds.
+
     Available methods include
     - is_alive():
     - list_local_files():
@@ -24,8 +80,14 @@ class SFTPClient:
     - list_remote_items():
     - setup_remote_folders():
     - put_file():
+    - put_resumable(): put a file, resuming an interrupted upload
     - remove_remote_item():
-    - transfer_files(): transfer files,  optionally removing files from source
+    - transfer_files(): transfer files in parallel,  optionally removing files from source
+    - transfer_batch(): transfer a list of files in parallel
+    - max_concurrency(): configured number of parallel uploads per destination
+    - session(): borrow an SFTP channel from the shared session
+    - evict_idle(): close the shared session if it has been idle for too long
+    - close(): close the shared session
     """
 
     def __init__(self, config: dict):
@@ -34,11 +96,34 @@ class SFTPClient:
 
         :param config_file: Path to the configuration file.
                     config['sftp']['host']:
+                    config['sftp']['port']: (optional) Defaults to 22.
                     config['sftp']['usr']:
                     config['sftp']['key']:
                     config['sftp']['local_path']: relative path to local source (= staging)
                     config['sftp']['remote_path']: (absolute?) root of remote destination
+                    config['sftp']['keepalive']: (optional) seconds between keepalive packets. Defaults to 30.
+                    config['sftp']['idle_timeout']: (optional) seconds after which an idle session is closed. Defaults to 300.
+                    config['sftp']['concurrency']: (optional) parallel uploads per destination, either an int or a dict
+                                                   keyed by destination relative to remote_path, with a 'default'. Defaults to 4.
+                    config['sftp']['resumable']: (optional) resume interrupted uploads. Defaults to True.
+                    config['sftp']['chunk_size']: (optional) bytes per write of resumable uploads. Defaults to 262144.
+                    config['sftp']['journal']: (optional) transfer journal, relative to root. Defaults to 'sftp_journal.json'.
         """
+        # shared session pool
+        self._ssh = None
+        self._channels = []
+        self._borrowed = 0
+        self._last_used = time.monotonic()
+        self._lock = threading.RLock()
+        self._remote_dirs = set()
+        self._limits = dict()
+        self.concurrency = 1
+        self.resumable = False
+        self.last_report = dict()
+        self.transfered = []
+        self.handshakes = 0
+        self.cycle_handshakes = 0
+
         try:
             # configure logging
             _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
@@ -49,7 +134,15 @@ class SFTPClient:
 
             # sftp connection settings
             self.host = config['sftp']['host']
+            self.port = int(config['sftp'].get('port', 22))
             self.usr = config['sftp']['usr']
+            self.keepalive = int(config['sftp'].get('keepalive', 30))
+            self.idle_timeout = int(config['sftp'].get('idle_timeout', 300))
+            self.concurrency = config['sftp'].get('concurrency', 4)
+            self.resumable = bool(config['sftp'].get('resumable', True))
+            self.chunk_size = int(config['sftp'].get('chunk_size', 262144))
+            self.journal = TransferJournal(os.path.join(os.path.expanduser(config['root']),
+                                                        config['sftp'].get('journal', 'sftp_journal.json')))
             self.key = paramiko.RSAKey.from_private_key_file(\
                 os.path.expanduser(config['sftp']['key']))
 
@@ -72,6 +165,118 @@ class SFTPClient:
             self.logger.error(err)
 
 
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+    def _connect(self) -> paramiko.Transport:
+        """Return the transport of the shared SSH session, (re)connecting if needed.
+
+        Returns:
+            paramiko.Transport: an active transport
+        """
+        with self._lock:
+            transport = self._ssh.get_transport() if self._ssh else None
+            if transport is None or not transport.is_active():
+                if self._ssh:
+                    self.logger.warning("_connect: ssh session lost, reconnecting ...")
+                self._close_session()
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.connect(hostname=self.host, port=self.port, username=self.usr, pkey=self.key)
+                transport = ssh.get_transport()
+                transport.set_keepalive(self.keepalive)
+                self._ssh = ssh
+                self.handshakes += 1
+                self.logger.debug(f"_connect: connected to {self.host} (handshakes: {self.handshakes})")
+            return transport
+
+
+    def _close_session(self) -> None:
+        """Close all pooled channels and the SSH session. Caller must hold self._lock."""
+        self._remote_dirs.clear()
+        for sftp in self._channels:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+        self._channels = []
+        if self._ssh:
+            try:
+                self._ssh.close()
+            except Exception:
+                pass
+        self._ssh = None
+
+
+    def _acquire(self) -> paramiko.SFTPClient:
+        with self._lock:
+            transport = self._connect()
+            self._borrowed += 1
+            while self._channels:
+                sftp = self._channels.pop()
+                if not sftp.get_channel().closed:
+                    return sftp
+        try:
+            return paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            with self._lock:
+                self._borrowed -= 1
+            raise
+
+
+    def _release(self, sftp: paramiko.SFTPClient) -> None:
+        with self._lock:
+            self._borrowed -= 1
+            self._last_used = time.monotonic()
+            transport = self._ssh.get_transport() if self._ssh else None
+            if transport is None or not transport.is_active():
+                # the session died while the channel was in use: start afresh next time
+                self._close_session()
+            elif sftp.get_channel().closed or sftp.get_channel().get_transport() is not transport:
+                sftp.close()
+            else:
+                self._channels.append(sftp)
+
+
+    @contextmanager
+    def session(self):
+        """Borrow an SFTP channel from the shared session and return it to the pool afterwards.
+
+        Yields:
+            paramiko.SFTPClient: an open SFTP channel
+        """
+        sftp = self._acquire()
+        try:
+            yield sftp
+        finally:
+            self._release(sftp)
+
+
+    def evict_idle(self) -> None:
+        """Close the shared session if no channel is in use and it has been idle for more than self.idle_timeout seconds."""
+        with self._lock:
+            if self._ssh and self._borrowed == 0 and (time.monotonic() - self._last_used) > self.idle_timeout:
+                self.logger.debug("evict_idle: closing idle ssh session")
+                self._close_session()
+
+
+    def _is_connected(self) -> bool:
+        with self._lock:
+            transport = self._ssh.get_transport() if self._ssh else None
+            return transport is not None and transport.is_active()
+
+
+    def close(self) -> None:
+        """Close the shared session."""
+        with self._lock:
+            self._close_session()
+
+
     def is_alive(self) -> bool:
         """Test ssh connection to sftp server.
 
@@ -79,12 +284,8 @@ class SFTPClient:
             bool: [description]
         """
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-
-                with ssh.open_sftp() as sftp:
-                    sftp.close()
+            with self.session() as sftp:
+                sftp.stat('.')
             return True
         except Exception as err:
             self.logger.error(err)
@@ -128,15 +329,12 @@ class SFTPClient:
         """
         try:
             remote_path = remote_path.replace('\\', '/').rstrip('/')
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    try:
-                        sftp.stat(remote_path)
-                        return True
-                    except FileNotFoundError:
-                        return False
+            with self.session() as sftp:
+                try:
+                    sftp.stat(remote_path)
+                    return True
+                except FileNotFoundError:
+                    return False
         except Exception as err:
             self.logger.error(err)
             return False
@@ -144,11 +342,8 @@ class SFTPClient:
 
     def list_remote_items(self, remote_path: str='.') -> list:
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    return sftp.listdir(remote_path)
+            with self.session() as sftp:
+                return sftp.listdir(remote_path)
 
         except Exception as err:
             self.logger.error(err)
@@ -178,21 +373,17 @@ class SFTPClient:
 
             self.logger.info(f"setup_remote_folders (local_path: {local_path}, remote_path: {remote_path})")
 
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # determine local directory structure, establish same structure on remote host
-                    for root, dirs, files in os.walk(local_path):
-                        root = re.sub(r'(/?\.?\\){1,2}', '/', root).replace(local_path, remote_path)
-                        self.logger.debug(f"root: {root}")
-                        try:
-                            sftp.mkdir(root, mode=16877)
-                        except OSError as err:
-                            # [todo] check if remote items exists, adapt error message accordingly ...
-                            self.logger.error(f"Could not create '{root}', error: {err}. Maybe path exists already?")
-                            pass
-                    sftp.close()
+            with self.session() as sftp:
+                # determine local directory structure, establish same structure on remote host
+                for root, dirs, files in os.walk(local_path):
+                    root = re.sub(r'(/?\.?\\){1,2}', '/', root).replace(local_path, remote_path)
+                    self.logger.debug(f"root: {root}")
+                    try:
+                        sftp.mkdir(root, mode=16877)
+                    except OSError as err:
+                        # [todo] check if remote items exists, adapt error message accordingly ...
+                        self.logger.error(f"Could not create '{root}', error: {err}. Maybe path exists already?")
+                        pass
 
         except Exception as err:
             self.logger.error(err)
@@ -209,15 +400,11 @@ class SFTPClient:
             if os.path.exists(local_path):
                 # remove the file name from remote_path in case it was appended, then add the file name
                 remote_path = os.path.join(os.path.dirname(remote_path), os.path.basename(local_path)).replace('\\', '/')
-                with paramiko.SSHClient() as ssh:
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                    with ssh.open_sftp() as sftp:
-                        attr = sftp.put(localpath=local_path,
-                                        remotepath=remote_path,
-                                        confirm=True)
-                        sftp.close()
-                    self.logger.info(f"put_file {local_path} > {remote_path}")
+                with self.session() as sftp:
+                    attr = sftp.put(localpath=local_path,
+                                    remotepath=remote_path,
+                                    confirm=True)
+                self.logger.info(f"put_file {local_path} > {remote_path}")
                 return attr
             else:
                 raise ValueError(f"local_path {local_path} does not exist.")
@@ -234,34 +421,76 @@ class SFTPClient:
         """
         try:
             remote_path = remote_path.replace('\\', '/')
-            if self.remote_item_exists(remote_path):
-                with paramiko.SSHClient() as ssh:
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                    with ssh.open_sftp() as sftp:
-                        try:
-                            if sftp.listdir(remote_path):
-                                # neither an empty directory, nor a file: do nothing
-                                self.logger.warning('Cannot remove non-empty directory. Provide full path to file to remove it, or empty the directory first.')
-                                return
-                            else:
-                                # remote path is an empty directory
-                                sftp.rmdir(remote_path)
-                        except:
-                            # remote_path is a file
-                            try:
-                                sftp.remove(remote_path)
-                            except Exception as err:
-                                self.logger.error(err)
-                        self.logger.info(f"remove_remote_item {remote_path}")
-                        sftp.close()
+            with self.session() as sftp:
+                try:
+                    sftp.stat(remote_path)
+                except FileNotFoundError:
+                    raise ValueError("remove_remote_item: remote_path does not exist.")
+                try:
+                    if sftp.listdir(remote_path):
+                        # neither an empty directory, nor a file: do nothing
+                        self.logger.warning('Cannot remove non-empty directory. Provide full path to file to remove it, or empty the directory first.')
+                        return
+                    else:
+                        # remote path is an empty directory
+                        sftp.rmdir(remote_path)
+                        self._remote_dirs.clear()
+                except:
+                    # remote_path is a file
+                    try:
+                        sftp.remove(remote_path)
+                    except Exception as err:
+                        self.logger.error(err)
+                self.logger.info(f"remove_remote_item {remote_path}")
 
-            else:
-                raise ValueError("remove_remote_item: remote_path does not exist.")
         except Exception as err:
             self.logger.error(f"remove_remote_item: {err}")
 
 
+    def _setup_remote_path(self, sftp: paramiko.SFTPClient, remote_path: str) -> str:
+        """Create a remote path on an open SFTP channel, component by component, if it doesn't exist.
+        The working directory of the channel is left unchanged, as channels are shared.
+
+        Directories known to exist are cached in self._remote_dirs for the lifetime of the session.
+        On a cache miss, the parent directory is listed once and all its sub-directories are cached,
+        so that sibling destinations don't cost another round trip. The cache is cleared if the remote
+        tree turns out to differ from it.
+
+        Args:
+            sftp (paramiko.SFTPClient): open SFTP channel
+            remote_path (str): Remote path to create. NB: The last bit of the path is always interpreted as a directory
+
+        Returns:
+            str: normalized remote path
+        """
+        remote_path = posixpath.normpath(remote_path.replace('\\', '/').replace('./', ''))
+        if remote_path == '.' or remote_path in self._remote_dirs:
+            return remote_path
+
+        parent = '/' if remote_path.startswith('/') else '.'
+        try:
+            for part in remote_path.strip('/').split('/'):
+                current = part if parent == '.' else posixpath.join(parent, part)
+                if current not in self._remote_dirs:
+                    for attr in sftp.listdir_attr(parent):
+                        if stat.S_ISDIR(attr.st_mode or 0):
+                            self._remote_dirs.add(attr.filename if parent == '.' else posixpath.join(parent, attr.filename))
+                    if current not in self._remote_dirs:
+                        try:
+                            sftp.mkdir(current)
+                            self.logger.debug(f"setup_remote_path: created {current}")
+                        except IOError:
+                            # created concurrently, or a symbolic link to a directory
+                            sftp.stat(current)
+                        self._remote_dirs.add(current)
+                parent = current
+        except IOError:
+            # the cached remote tree may be stale, e.g., a parent was removed
+            self._remote_dirs.clear()
+            raise
+        return remote_path
+
+
     def setup_remote_path(self, remote_path: str) -> str:
         """Create (and navigate to the leaf of) a remote path.
 
@@ -272,44 +501,234 @@ class SFTPClient:
             str: full path of current remote directory
         """
         try:
-            remote_path = remote_path.replace('\\', '/').replace('./', '')
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # create remote path if it doesn't exist and enter it
-                    try:
-                        sftp.chdir(remote_path)
-                    except IOError:
-                        parts = remote_path.split("/")
-                        current_path = '.'
-                        for part in parts:
-                            if part:
-                                current_path = f"{current_path}/{part}"
-                            try:
-                                sftp.chdir(current_path)
-                            except IOError:
-                                sftp.mkdir(part)
-                                sftp.chdir(part)
-                                self.logger.debug(f"setup_remote_path: created {part}")
-                    cwd = sftp.getcwd()
-                    self.logger.debug(f"setup_remote_path: switched to {cwd}")
-                    if cwd is None:
-                        cwd = str()
+            with self.session() as sftp:
+                cwd = sftp.normalize(self._setup_remote_path(sftp, remote_path))
+                self.logger.debug(f"setup_remote_path: switched to {cwd}")
+                if cwd is None:
+                    cwd = str()
             return cwd
         except Exception as err:
             self.logger.error(f"setup_remote_path: {err}")
             return str()
 
 
-    def transfer_files(self, local_path: str=str(), remote_path: str=str(), remove_on_success: bool=True) -> None:
-        """Transfer (move) all files from local_path and sub-folders to remote_path.
+    def max_concurrency(self, remote_path: str) -> int:
+        """Return the configured number of parallel uploads to a remote destination.
+
+        Args:
+            remote_path (str): remote destination, e.g. './nrb/fidas'
+
+        Returns:
+            int: maximum number of parallel uploads
+        """
+        destination = posixpath.relpath(posixpath.normpath(remote_path), posixpath.normpath(self.remote_path))
+        if isinstance(self.concurrency, dict):
+            value = self.concurrency.get(destination, self.concurrency.get('default', 1))
+        else:
+            value = self.concurrency
+        return max(1, int(value))
+
+
+    def concurrency_limit(self, remote_path: str) -> threading.BoundedSemaphore:
+        """Return the semaphore limiting parallel uploads to a remote destination.
+
+        Args:
+            remote_path (str): remote destination, e.g. './nrb/fidas'
+
+        Returns:
+            threading.BoundedSemaphore: shared by all transfers to this destination
+        """
+        destination = posixpath.normpath(remote_path)
+        with self._lock:
+            if destination not in self._limits:
+                self._limits[destination] = threading.BoundedSemaphore(self.max_concurrency(remote_path))
+            return self._limits[destination]
+
+
+    @staticmethod
+    def _checksum(local_file: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(local_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1048576), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+    def put_resumable(self, sftp: paramiko.SFTPClient, local_file: str, remote_file: str) -> paramiko.SFTPAttributes:
+        """Put a file in chunks to a temporary remote file and rename it once complete.
+
+        If the journal shows an earlier, interrupted upload of the same (unchanged) local file, the upload
+        continues at the current size of the temporary remote file, so only the missing bytes are sent.
+
+        Args:
+            sftp (paramiko.SFTPClient): open SFTP channel
+            local_file (str): full path to local file
+            remote_file (str): full path to remote file
+
+        Returns:
+            paramiko.SFTPAttributes: attributes of the remote file
+        """
+        size = os.stat(local_file).st_size
+        checksum = self._checksum(local_file)
+        tmp = f"{remote_file}.part"
+
+        offset = 0
+        entry = self.journal.get(local_file)
+        if entry.get('sha256') == checksum and entry.get('remote') == remote_file:
+            try:
+                offset = sftp.stat(tmp).st_size
+            except IOError:
+                offset = 0
+            if offset > size:
+                offset = 0
+            if offset:
+                self.logger.info(f"put_resumable: resuming {local_file} at {offset}/{size} bytes")
+        self.journal.set(local_file, remote=remote_file, size=size, sha256=checksum, offset=offset)
+
+        with open(local_file, 'rb') as fl, sftp.open(tmp, 'r+b' if offset else 'wb') as fr:
+            fr.set_pipelined(True)
+            fl.seek(offset)
+            fr.seek(offset)
+            checkpoint = time.monotonic()
+            for chunk in iter(lambda: fl.read(self.chunk_size), b''):
+                fr.write(chunk)
+                offset += len(chunk)
+                if time.monotonic() - checkpoint > 1:
+                    self.journal.set(local_file, offset=offset)
+                    checkpoint = time.monotonic()
+
+        attr = sftp.stat(tmp)
+        if attr.st_size != size:
+            raise IOError(f"size mismatch in {tmp}: {attr.st_size} != {size}")
+        try:
+            sftp.posix_rename(tmp, remote_file)
+        except IOError:
+            # server does not support posix-rename@openssh.com
+            try:
+                sftp.remove(remote_file)
+            except IOError:
+                pass
+            sftp.rename(tmp, remote_file)
+        self.journal.remove(local_file)
+        return attr
+
+
+    def _transfer_file(self, sftp: paramiko.SFTPClient, local_file: str, remote_file: str, remove_on_success: bool=True) -> int:
+        """Put a single file on an open SFTP channel, optionally removing the local file afterwards.
+
+        Returns:
+            int: number of bytes transfered
+        """
+        try:
+            if self.resumable:
+                attr = self.put_resumable(sftp, local_file, remote_file)
+            else:
+                attr = sftp.put(localpath=local_file, remotepath=remote_file, confirm=True)
+        except Exception:
+            # the cached remote tree may be stale
+            self._remote_dirs.clear()
+            raise
+        self.logger.debug(f"put {local_file} > {remote_file}")
+
+        local_size = os.stat(local_file).st_size
+        if remove_on_success:
+            remote_size = attr.st_size
+            if remote_size == local_size:
+                os.remove(local_file)
+            else:
+                self.logger.warning(f"local file size: {local_size}, remote file: {remote_size} differ. Did not remove {local_file}.")
+        return local_size
+
+
+    def _transfer_worker(self, local_file: str, remote_file: str, remove_on_success: bool, limit: threading.BoundedSemaphore) -> int:
+        with limit:
+            with self.session() as sftp:
+                return self._transfer_file(sftp, local_file, remote_file, remove_on_success)
+
+
+    def transfer_batch(self, jobs: list, remote_path: str, remove_on_success: bool=True, max_workers: int=0) -> tuple[list, list]:
+        """Put a list of files to a remote destination in parallel.
+
+        Remote folders are established first on one channel. Files are then uploaded by a bounded pool of
+        workers, each using its own SFTP channel on the shared session. The number of parallel uploads to
+        remote_path is capped by concurrency_limit(). A throughput report is kept in self.last_report.
+
+        Args:
+            jobs (list): tuples (local_file, remote_file)
+            remote_path (str): remote destination, used to look up the concurrency limit
+            remove_on_success (bool, optional): Remove successfully transfered files?. Defaults to True.
+            max_workers (int, optional): number of workers. Defaults to 0 (= concurrency limit of remote_path).
+
+        Returns:
+            tuple[list, list]: local files transfered, local files failed
+        """
+        handshakes = self.handshakes
+        started = time.monotonic()
+        succeeded, failed = [], []
+        n_bytes = 0
+        try:
+            if not jobs:
+                return succeeded, failed
+
+            # establish remote directories
+            with self.session() as sftp:
+                folders = {posixpath.dirname(remote_file) for _, remote_file in jobs}
+                folders = {folder: self._setup_remote_path(sftp, folder) for folder in folders}
+            jobs = [(local_file, posixpath.join(folders[posixpath.dirname(remote_file)], posixpath.basename(remote_file)))
+                    for local_file, remote_file in jobs]
+
+            # put files to remote location
+            limit = self.concurrency_limit(remote_path)
+            workers = max_workers or self.max_concurrency(remote_path)
+            with ThreadPoolExecutor(max_workers=min(workers, len(jobs)), thread_name_prefix='sftp') as executor:
+                futures = {executor.submit(self._transfer_worker, local_file, remote_file, remove_on_success, limit): local_file
+                           for local_file, remote_file in jobs}
+                for future in as_completed(futures):
+                    if future.exception() is not None and not self._is_connected():
+                        # link is down, don't hammer the server with reconnects
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        break
+
+            # NB: leaving the executor waits for running uploads, so every future is done or cancelled
+            for future, local_file in futures.items():
+                if future.cancelled():
+                    failed.append(local_file)
+                elif future.exception() is not None:
+                    failed.append(local_file)
+                    self.logger.error(f"transfer_batch: {local_file}: {future.exception()}")
+                else:
+                    n_bytes += future.result()
+                    succeeded.append(local_file)
+                    self.logger.info(f"{local_file}", extra={'to_logfile': True})
+
+        except Exception as err:
+            failed = [local_file for local_file, _ in jobs if local_file not in succeeded]
+            self.logger.error(f"transfer_batch: {remote_path}: {err}")
+
+        finally:
+            self.cycle_handshakes = self.handshakes - handshakes
+            seconds = max(time.monotonic() - started, 1e-6)
+            self.last_report = {'files': len(succeeded),
+                                'bytes': n_bytes,
+                                'failed': len(failed),
+                                'seconds': round(seconds, 3),
+                                'files_per_s': round(len(succeeded) / seconds, 2),
+                                'bytes_per_s': round(n_bytes / seconds),
+                                'handshakes': self.cycle_handshakes}
+            if succeeded or failed:
+                self.logger.info(f"transfer_batch: {remote_path}: {self.last_report}", extra={'to_logfile': True})
+        return succeeded, failed
+
+
+    def transfer_files(self, local_path: str=str(), remote_path: str=str(), remove_on_success: bool=True, max_workers: int=0) -> None:
+        """Transfer (move) all files from local_path and sub-folders to remote_path, using transfer_batch().
 
         Args:
             local_path (str, optional): full path to local directory location. Defaults to empty string.
             remote_path (str, optional): relative path to remote directory location. Defaults to empty string.
                                          NB: last element in remote_path must be a directory, not a file!
             remove_on_success (bool, optional): Remove successfully transfered files from local_path?. Defaults to True.
+            max_workers (int, optional): number of workers. Defaults to 0 (= concurrency limit of remote_path).
         """
         try:
             self.transfered = []
@@ -320,41 +739,21 @@ class SFTPClient:
                 remote_path = self.remote_path
 
             # sanitize paths
-            local_path = local_path.replace('\\', '/')
-            remote_path = remote_path.replace('\\', '/')
-            self.logger.info(f"{local_path} > {remote_path}", to_logfile=True)
-
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # walk local directory structure, put file to remote location
-
-                    top = local_path
-                    for root, dirs, files in os.walk(top=top):
-                        for file in files:
-                            local_file = os.path.join(root, file).replace('\\', '/').rstrip('/')
-                            self.logger.info(f"{local_file}", to_logfile=True)
-
-                            parts = root.replace('\\', '/').replace(local_path, '').strip('/')
-                            remote_file = f"{remote_path}/{parts}/{file}"
-                            self.logger.info(f"{remote_file}", to_logfile=True)
-
-                            cwd = self.setup_remote_path(f"{remote_path}/{parts}")
-
-                            attr = sftp.put(localpath=local_file, remotepath=remote_file, confirm=True)
-                            self.logger.debug(f"put {local_file} > {remote_file}")
-                            self.transfered.append(file)
-
-                            if remove_on_success:
-
-                                local_size = os.stat(local_file).st_size
-                                remote_size = attr.st_size
-                                if remote_size == local_size:
-                                    os.remove(local_file)
-                                else:
-                                    self.logger.warning(f"local file size: {local_size}, remote file: {remote_size} differ. Did not remove {local_file}.")
-                return
+            local_path = str(local_path).replace('\\', '/')
+            remote_path = str(remote_path).replace('\\', '/')
+            self.logger.info(f"{local_path} > {remote_path}", extra={'to_logfile': True})
+
+            # walk local directory structure
+            jobs = []
+            for root, dirs, files in os.walk(top=local_path):
+                parts = root.replace('\\', '/').replace(local_path, '').strip('/')
+                for file in files:
+                    local_file = os.path.join(root, file).replace('\\', '/').rstrip('/')
+                    jobs.append((local_file, posixpath.join(remote_path, parts, file)))
+
+            succeeded, _ = self.transfer_batch(jobs=jobs, remote_path=remote_path, remove_on_success=remove_on_success, max_workers=max_workers)
+            # NB: kept per call of transfer_files; long-lived callers of transfer_batch (e.g., TransferService) count themselves
+            self.transfered = [os.path.basename(local_file) for local_file in succeeded]
 
         except Exception as err:
             self.logger.error(f"transfer_files: {local_path} > {remote_path}: {err}")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage of instrument data in parquet files.
+
+IncrementalWriter builds one file (e.g., an hourly file) from many small flushes. Each flush is
+written as a separate part file next to the target, so its cost only depends on the number of
+rows flushed, not on the size of the file built so far. finalize() consolidates the parts once,
+drops duplicate keys (keeping the last row written) and keeps the rows sorted by key.
+
+DatasetWriter adds the data of all instruments to one Hive-partitioned parquet dataset,
+
+    <root>/<dataset>/instrument=<instrument>/year=<yyyy>/month=<mm>/day=<dd>/<file>.parquet
+
+with a dtm column (Datetime, UTC) and floating point columns cast to Float32. Integer columns
+(e.g., flags or states used bitwise) keep their type. Use scan_dataset() to query it lazily;
+filters on instrument, year, month and day only read the partitions needed.
+
+Manifest records the source files compiled into a file (size, mtime, rows, first and last dtm),
+so that a recompile only needs to read files that are new or have changed since.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import json
+import logging
+import os
+from pathlib import Path
+
+import polars as pl
+
+
+class IncrementalWriter:
+    """
+    Build a parquet file from flushes of new rows.
+
+    Available methods include
+    - append(): write new rows as a part file
+    - finalize(): consolidate the parts into the target file
+    """
+
+    def __init__(self, path: Path, key: str='dtm'):
+        """
+        Args:
+            path (Path): target file
+            key (str, optional): column identifying a row. Defaults to 'dtm'.
+        """
+        self.path = Path(path)
+        self.key = key
+        # NB: part files live in '<target>.parts', so that parts left behind by a crash are found later
+        self.parts_dir = self.path.with_name(f"{self.path.name}.parts")
+        self._next = len(self.parts())
+
+
+    def parts(self) -> list[Path]:
+        """Return the part files written so far, in order."""
+        if not self.parts_dir.is_dir():
+            return list()
+        return sorted(self.parts_dir.glob('*.parquet'))
+
+
+    def append(self, df: pl.DataFrame) -> Path | None:
+        """Write df as the next part file.
+
+        Args:
+            df (pl.DataFrame): new rows
+
+        Returns:
+            Path | None: part file, None if df is empty
+        """
+        if df.is_empty():
+            return None
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+        part = self.parts_dir / f"{self._next:05d}.parquet"
+        tmp = part.with_suffix('.tmp')
+        df.write_parquet(tmp)
+        _fsync(tmp)
+        os.replace(tmp, part)
+        self._next += 1
+        return part
+
+
+    def finalize(self) -> Path | None:
+        """Consolidate existing target file and part files, deduplicate on key, sort by key, and remove the parts.
+
+        Returns:
+            Path | None: target file, None if there was nothing to write
+        """
+        files = ([self.path] if self.path.exists() else list()) + self.parts()
+        if not files or files == [self.path]:
+            return self.path if files else None
+
+        df = pl.concat([pl.read_parquet(file) for file in files], how="diagonal_relaxed")
+        df = df.unique(subset=self.key, keep="last", maintain_order=True).sort(self.key, maintain_order=True)
+        df = df.select(sorted(df.columns))
+
+        tmp = self.path.with_suffix('.tmp')
+        df.write_parquet(tmp)
+        _fsync(tmp)
+        os.replace(tmp, self.path)
+
+        for part in self.parts():
+            part.unlink()
+        self.parts_dir.rmdir()
+        self._next = 0
+        return self.path
+
+
+def _fsync(file: Path) -> None:
+    with open(file, 'rb') as fh:
+        os.fsync(fh.fileno())
+
+
+class DatasetWriter:
+    """
+    Add data of an instrument to the common partitioned parquet dataset.
+
+    Available methods include
+    - normalize(): dtm as Datetime (UTC), floating point columns as Float32
+    - write(): write rows to their day partitions
+    """
+
+    def __init__(self, config: dict, instrument: str):
+        """
+        Args:
+            config (dict): general configuration
+                    config['dataset']: (optional) dataset folder, relative to root. Defaults to 'dataset'.
+            instrument (str): value of the instrument partition
+        """
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+
+        self.path = Path(config['root']).expanduser() / config.get('dataset', 'dataset')
+        self.instrument = instrument
+
+
+    @staticmethod
+    def normalize(df: pl.DataFrame, dtm: str='dtm') -> pl.DataFrame:
+        """Return df with column dtm as Datetime('us', 'UTC') and all floating point columns as Float32.
+
+        Timestamps without time zone are taken to be UTC, as elsewhere in nrbdaq. Integer columns are
+        kept as they are, as Float32 cannot represent e.g. 32-bit status flags exactly.
+
+        Args:
+            df (pl.DataFrame): data
+            dtm (str, optional): name of the timestamp column, renamed to 'dtm'. Defaults to 'dtm'.
+        """
+        df = df.rename({dtm: 'dtm'}) if dtm != 'dtm' else df
+        dtype = df.schema['dtm']
+        if dtype == pl.String:
+            col = pl.col('dtm').str.to_datetime(time_unit='us', time_zone='UTC')
+        elif isinstance(dtype, pl.Datetime) and dtype.time_zone is None:
+            col = pl.col('dtm').dt.replace_time_zone('UTC')
+        else:
+            col = pl.col('dtm').dt.convert_time_zone('UTC')
+        floats = [name for name, dtype in df.schema.items() if name != 'dtm' and dtype.is_float()]
+        return df.with_columns(col.dt.cast_time_unit('us'), pl.col(floats).cast(pl.Float32))
+
+
+    def write(self, df: pl.DataFrame, dtm: str='dtm', instrument: str=None, file: str=None) -> list[Path]:
+        """Write rows to the partitions of the day they were recorded.
+
+        Args:
+            df (pl.DataFrame): data
+            dtm (str, optional): name of the timestamp column. Defaults to 'dtm'.
+            instrument (str, optional): value of instrument partition. Defaults to None (= self.instrument).
+            file (str, optional): file name (without extension) to merge rows into, deduplicated on dtm.
+                Defaults to None (= new file named after instrument and first timestamp).
+
+        Returns:
+            list[Path]: files written
+        """
+        files = list()
+        try:
+            if df is None or df.is_empty():
+                return files
+            instrument = instrument or self.instrument
+            df = self.normalize(df, dtm=dtm).sort('dtm')
+            for (day, ), rows in df.group_by(pl.col('dtm').dt.date().alias('day'), maintain_order=True):
+                folder = self.path / f"instrument={instrument}" / f"year={day.year:04d}" / f"month={day.month:02d}" / f"day={day.day:02d}"
+                folder.mkdir(parents=True, exist_ok=True)
+                if file:
+                    target = folder / f"{file}.parquet"
+                    if target.exists():
+                        rows = pl.concat([pl.read_parquet(target), rows], how="diagonal_relaxed")
+                        rows = rows.unique(subset='dtm', keep='last', maintain_order=True).sort('dtm')
+                else:
+                    target = folder / f"{instrument}-{rows['dtm'][0]:%Y%m%d%H%M%S}.parquet"
+                tmp = target.with_suffix('.tmp')
+                rows.write_parquet(tmp)
+                os.replace(tmp, target)
+                files.append(target)
+            self.logger.debug(f"DatasetWriter: {len(df)} rows written to {files}")
+        except Exception as err:
+            self.logger.error(f"DatasetWriter ({instrument}): {err}")
+        return files
+
+
+def scan_dataset(config: dict, instrument: str=None) -> pl.LazyFrame:
+    """Return the data of one or all instruments in the common dataset as a LazyFrame with partition columns.
+
+    Args:
+        config (dict): general configuration
+        instrument (str, optional): Defaults to None (= all instruments).
+    """
+    path = Path(config['root']).expanduser() / config.get('dataset', 'dataset')
+    instruments = [instrument] if instrument else sorted(p.name.split('=', 1)[1] for p in path.glob('instrument=*'))
+    # NB: instruments have different columns, and the columns of an instrument may change over time
+    return pl.concat([pl.scan_parquet(path / f"instrument={name}" / '**' / '*.parquet',
+                                      hive_partitioning=True,
+                                      missing_columns='insert').with_columns(pl.lit(name).alias('instrument'))
+                      for name in instruments], how='diagonal_relaxed')
+
+
+class Manifest:
+    """
+    Source files compiled into a target, kept as '<target>.manifest.json' next to it.
+
+    Available methods include
+    - changed(): files that are new or have changed since they were compiled
+    - update(): record a compiled file
+    - save()
+    """
+
+    def __init__(self, target: Path):
+        """
+        Args:
+            target (Path): compiled file. If it does not exist, the manifest starts empty.
+        """
+        self.target = Path(target)
+        self.path = self.target.with_name(f"{self.target.name}.manifest.json")
+        self.files = dict()
+        self._stats = dict()
+        if self.target.exists() and self.path.exists():
+            with open(self.path, 'r') as fh:
+                self.files = json.load(fh)
+
+
+    @staticmethod
+    def _stat(file: Path) -> dict:
+        stat = os.stat(file)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+    def changed(self, files: list[Path]) -> list[Path]:
+        """Return the files (in the order given) whose size or mtime differ from the manifest, or that are not in it."""
+        result = list()
+        for file in files:
+            # NB: keep the stat taken before the file is read, in case it grows while it is compiled
+            stat = self._stats[str(file)] = self._stat(file)
+            entry = self.files.get(str(file))
+            if entry is None or {key: entry[key] for key in stat} != stat:
+                result.append(file)
+        return result
+
+
+    def update(self, file: Path, rows: int, first=None, last=None) -> None:
+        """Record file as compiled.
+
+        Args:
+            file (Path): source file
+            rows (int): number of rows read
+            first (optional): first dtm. Defaults to None.
+            last (optional): last dtm. Defaults to None.
+        """
+        stat = self._stats.pop(str(file), None) or self._stat(file)
+        self.files[str(file)] = dict(stat, rows=rows,
+                                     first=first.isoformat() if first is not None else None,
+                                     last=last.isoformat() if last is not None else None)
+
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump(self.files, fh, indent=1)
+        os.replace(tmp, self.path)
+
+
+def pending_writers(path: Path, key: str='dtm') -> list[IncrementalWriter]:
+    """Return writers for all targets below path that have part files, e.g., left behind by a crash."""
+    return [IncrementalWriter(parts_dir.with_name(parts_dir.name[:-len('.parts')]), key=key)
+            for parts_dir in sorted(Path(path).rglob('*.parts')) if parts_dir.is_dir()]
+
+
+if __name__ == "__main__":
+    pass
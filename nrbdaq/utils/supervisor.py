@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run each instrument driver in its own process, supervised by the main process.
+
+A worker process sets up one driver, then runs its schedule and reports a heartbeat after every
+pass of the scheduler. The Supervisor restarts workers that exit, or whose heartbeat is older than
+heartbeat_timeout (e.g., stuck on a serial port), with exponential backoff. A failing or hung
+instrument thus only costs that instrument's data, and the drivers can use all cores.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import logging
+import multiprocessing
+import os
+import time
+
+import schedule
+
+from nrbdaq.utils.utils import setup_logging
+
+
+def setup_fidas(config: dict):
+    from nrbdaq.instr.fidas import FIDAS
+    fidas = FIDAS(config=config)
+    fidas.connect_udp()
+    fidas.setup_schedules()
+    return fidas
+
+
+def setup_ae31(config: dict):
+    from nrbdaq.instr.ae31 import AE31
+    ae31 = AE31(config=config)
+    ae31.setup_schedules()
+    return ae31
+
+
+def setup_thermo49i(config: dict):
+    from nrbdaq.instr.thermo import Thermo49i
+    thermo49i = Thermo49i(config=config)
+    thermo49i.setup_schedules()
+    return thermo49i
+
+
+def setup_aurora3000(config: dict):
+    from nrbdaq.instr.aurora3000 import Aurora3000
+    neph = Aurora3000(config=config)
+    neph.setup_schedules()
+    return neph
+
+
+def setup_avo(config: dict):
+    import nrbdaq.instr.avo as avo
+    from nrbdaq.utils.storage import DatasetWriter
+    root = os.path.expanduser(config['root'])
+    data_path = os.path.join(root, config['data'], config['AVO']['data_path'])
+    staging_path = os.path.join(root, config['staging'], config['AVO']['staging_path'])
+    download_interval = config['AVO']['download_interval']
+    hours = [f"{download_interval*n:02}:00" for n in range(23) if download_interval*n <= 23]
+    for hr in hours:
+        schedule.every(1).day.at(hr).do(avo.download_multiple,
+                                       urls={'url_nairobi': config['AVO']['urls']['url_nairobi']},
+                                       file_path=data_path,
+                                       staging=staging_path,
+                                       dataset=DatasetWriter(config, 'avo'))
+
+
+# worker name: (setup function, configuration section)
+WORKERS = {'fidas': (setup_fidas, 'fidas'),
+           'ae31': (setup_ae31, 'AE31'),
+           '49i': (setup_thermo49i, '49i'),
+           'aurora3000': (setup_aurora3000, 'Aurora3000'),
+           'avo': (setup_avo, 'AVO'),
+           }
+
+
+def run_worker(name: str, config: dict, heartbeat) -> None:
+    """Entry point of a worker process: set up one driver, run its schedule and report heartbeats.
+
+    Args:
+        name (str): key of WORKERS
+        config (dict): general configuration
+        heartbeat (multiprocessing.Value): time.time() of the last pass of the scheduler
+    """
+    logfile = os.path.join(os.path.expanduser(config['root']), config['logging']['file'])
+    logger = setup_logging(file=logfile)
+    logger.info(f"== Start worker {name} (pid {os.getpid()}) ==", extra={'to_logfile': True})
+
+    setup, _ = WORKERS[name]
+    setup(config)
+    try:
+        while True:
+            schedule.run_pending()
+            heartbeat.value = time.time()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """
+    Start, watch and restart one worker process per instrument.
+
+    Available methods include
+    - start(): start all workers
+    - check(): restart workers that died or stopped sending heartbeats
+    - status(): pid, restarts and heartbeat age of each worker
+    - stop(): stop all workers
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initialize the Supervisor.
+
+        Args:
+            config (dict): general configuration
+                    config['supervisor']['workers']: (optional) workers to run. Defaults to all WORKERS.
+                    config['supervisor']['heartbeat_timeout']: (optional) seconds. Defaults to 600.
+                    config['supervisor']['backoff']: (optional) seconds before the first restart. Defaults to 5.
+                    config['supervisor']['max_backoff']: (optional) seconds. Defaults to 300.
+                    config['supervisor']['stable_after']: (optional) seconds of uptime that reset the backoff. Defaults to 600.
+        """
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+        self.logger.info("Initialize Supervisor")
+
+        self.config = config
+        cfg = config.get('supervisor', {})
+        self.names = [name for name in cfg.get('workers', list(WORKERS)) if name in WORKERS]
+        self.heartbeat_timeout = float(cfg.get('heartbeat_timeout', 600))
+        self.backoff = float(cfg.get('backoff', 5))
+        self.max_backoff = float(cfg.get('max_backoff', 300))
+        self.stable_after = float(cfg.get('stable_after', 600))
+
+        # NB: spawn rather than fork, as the main process runs threads (transfer, watcher)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._workers = {name: {'process': None,
+                                'heartbeat': self._ctx.Value('d', 0.0, lock=False),
+                                'started': 0.0,
+                                'failures': 0,
+                                'restarts': 0,
+                                'restart_at': None} for name in self.names}
+
+
+    def _spawn(self, name: str) -> None:
+        worker = self._workers[name]
+        worker['heartbeat'].value = 0.0
+        process = self._ctx.Process(target=run_worker,
+                                    args=(name, self.config, worker['heartbeat']),
+                                    name=f"nrbdaq-{name}")
+        process.start()
+        worker.update(process=process, started=time.time(), restart_at=None)
+        self.logger.info(f"Supervisor: started {name} (pid {process.pid})", extra={'to_logfile': True})
+
+
+    def _terminate(self, process, timeout: float=10) -> None:
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join(timeout)
+
+
+    def start(self) -> None:
+        for name in self.names:
+            self._spawn(name)
+
+
+    def check(self) -> None:
+        """Restart workers that exited or whose heartbeat is older than heartbeat_timeout, with exponential backoff."""
+        now = time.time()
+        for name, worker in self._workers.items():
+            process = worker['process']
+            if worker['restart_at'] is not None:
+                if now >= worker['restart_at']:
+                    worker['restarts'] += 1
+                    self._spawn(name)
+                continue
+
+            age = now - max(worker['heartbeat'].value, worker['started'])
+            if process.is_alive() and age <= self.heartbeat_timeout:
+                if worker['failures'] and now - worker['started'] > self.stable_after:
+                    worker['failures'] = 0
+                continue
+
+            if process.is_alive():
+                self.logger.error(f"Supervisor: {name} (pid {process.pid}) sent no heartbeat for {age:.0f} s, terminating.")
+                self._terminate(process)
+            else:
+                self.logger.error(f"Supervisor: {name} (pid {process.pid}) exited with code {process.exitcode}.")
+            delay = min(self.max_backoff, self.backoff * 2 ** worker['failures'])
+            worker['failures'] += 1
+            worker['restart_at'] = now + delay
+            self.logger.info(f"Supervisor: restarting {name} in {delay:.0f} s", extra={'to_logfile': True})
+
+
+    def status(self) -> dict:
+        now = time.time()
+        return {name: {'pid': worker['process'].pid if worker['process'] else None,
+                       'alive': bool(worker['process'] and worker['process'].is_alive()),
+                       'restarts': worker['restarts'],
+                       'heartbeat_age_s': round(now - max(worker['heartbeat'].value, worker['started']), 1)}
+                for name, worker in self._workers.items()}
+
+
+    def log_status(self) -> None:
+        self.logger.info(f"Supervisor: {self.status()}", extra={'to_logfile': True})
+
+
+    def stop(self, timeout: float=10) -> None:
+        for worker in self._workers.values():
+            if worker['process'] and worker['process'].is_alive():
+                self._terminate(worker['process'], timeout=timeout)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent TCP connection for command/response instruments (e.g., Thermo 49i).
+
+The connection is opened on first use and kept open. Replies are framed by a terminator, so a
+request returns as soon as its reply is complete. After a connection error, the client reconnects
+and repeats the request once. Several requests can be pipelined: all are sent at once, then the
+replies are read in order, so a batch pays for one round trip instead of one per request.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import socket
+import threading
+import time
+
+
+class TCPClient:
+    """
+    Send requests and read replies over a TCP connection that stays open.
+
+    Available methods include
+    - request(): send a request, return its reply
+    - pipeline(): send several requests, return their replies in order
+    - latency(): number of requests and latency per request
+    - close()
+    """
+
+    def __init__(self, address: tuple[str, int], timeout: float=5.0, terminator: bytes=b'\r',
+                 reconnect_delay: float=0.1):
+        """
+        Args:
+            address (tuple[str, int]): host, port
+            timeout (float, optional): seconds to connect, and to wait for a reply. Defaults to 5.0.
+            terminator (bytes, optional): end of a reply. Defaults to b'\\r'.
+            reconnect_delay (float, optional): seconds before reconnecting after an error. Defaults to 0.1.
+        """
+        self.address = address
+        self.timeout = timeout
+        self.terminator = terminator
+        self.reconnect_delay = reconnect_delay
+        self.reconnects = 0
+        self._socket = None
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+
+    def _connect(self) -> socket.socket:
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, timeout=self.timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._buffer.clear()
+        return self._socket
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+
+    def _close(self) -> None:
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+
+    def _read_reply(self, sock: socket.socket) -> bytes:
+        """Return the next reply, without terminator. Bytes following it are kept for the next reply."""
+        while True:
+            end = self._buffer.find(self.terminator)
+            if end >= 0:
+                reply = bytes(self._buffer[:end])
+                del self._buffer[:end + len(self.terminator)]
+                return reply
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError(f"connection to {self.address} closed by peer")
+            self._buffer += data
+
+
+    def _exchange(self, requests: list[bytes]) -> list[bytes]:
+        sock = self._connect()
+        sock.sendall(b''.join(requests))
+        return [self._read_reply(sock) for _ in requests]
+
+
+    def pipeline(self, requests: list[bytes]) -> list[bytes]:
+        """Send all requests, then read one reply per request.
+
+        Args:
+            requests (list[bytes]): requests, each including its own terminator
+
+        Returns:
+            list[bytes]: replies, in the order of requests
+        """
+        if not requests:
+            return list()
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                replies = self._exchange(requests)
+            except OSError:
+                # NB: socket.timeout and ConnectionError are OSErrors; a partial reply is discarded with the socket
+                self._close()
+                self.reconnects += 1
+                time.sleep(self.reconnect_delay)
+                replies = self._exchange(requests)
+            elapsed = time.perf_counter() - start
+            self._requests += len(requests)
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed / len(requests))
+            return replies
+
+
+    def request(self, request: bytes) -> bytes:
+        """Send request, including its own terminator, and return the reply without terminator."""
+        return self.pipeline([request])[0]
+
+
+    def latency(self) -> dict:
+        """Return number of requests, and mean and maximum latency per request [ms]."""
+        return {'requests': self._requests,
+                'mean_ms': 1000 * self._latency_total / self._requests if self._requests else None,
+                'max_ms': 1000 * self._latency_max,
+                'reconnects': self.reconnects}
+
+
+if __name__ == "__main__":
+    pass
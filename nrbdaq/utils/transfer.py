@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background transfer of staged files, decoupled from data acquisition.
+
+Instruments report staged files to a TransferService, which uploads them from its own thread
+using SFTPClient. Slow or failing transfers thus no longer delay the acquisition schedule.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import logging
+import os
+import posixpath
+import queue
+import threading
+import time
+
+from nrbdaq.utils.sftp import SFTPClient
+
+
+class TransferService(threading.Thread):
+    """
+    Upload staged files in a background thread.
+
+    Available methods include
+    - register(): map a local staging folder to a remote destination
+    - stage(): queue a staged file for transfer
+    - sweep(): queue all files found in the registered staging folders
+    - status(): queue depth and transfer lag
+    - stop(): stop the service
+    """
+
+    def __init__(self, sftp: SFTPClient, config: dict, remove_on_success: bool=True):
+        """
+        Initialize the TransferService.
+
+        Args:
+            sftp (SFTPClient): client used for uploads
+            config (dict): general configuration
+                    config['sftp']['retry_interval']: (optional) seconds before a failed file is retried. Defaults to 60.
+            remove_on_success (bool, optional): Remove successfully transfered files?. Defaults to True.
+        """
+        super().__init__(name='transfer', daemon=True)
+
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+        self.logger.info("Initialize TransferService")
+
+        self.sftp = sftp
+        self.remove_on_success = remove_on_success
+        self.retry_interval = int(config['sftp'].get('retry_interval', 60))
+
+        self._destinations = dict()
+        self._queue = queue.Queue()
+        self._pending = dict()
+        self._retry = dict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        self.transfered = 0
+        self.failed = 0
+        self.last_lag = 0.0
+
+
+    def register(self, local_path: str, remote_path: str) -> None:
+        """Map a local staging folder (and its sub-folders) to a remote destination.
+
+        Args:
+            local_path (str): full path to local staging folder
+            remote_path (str): relative path to remote directory location
+        """
+        local_path = os.path.normpath(os.path.expanduser(str(local_path)))
+        self._destinations[local_path] = str(remote_path).replace('\\', '/')
+        self.logger.debug(f"register: {local_path} > {remote_path}")
+
+
+    def destination(self, local_file: str) -> tuple[str, str]:
+        """Return the registered remote destination and the remote file for a local file.
+
+        Args:
+            local_file (str): full path to local file
+
+        Returns:
+            tuple[str, str]: remote destination, remote file. Empty strings if the file is not in a registered folder.
+        """
+        local_file = os.path.normpath(str(local_file))
+        for local_path, remote_path in self._destinations.items():
+            if local_file.startswith(f"{local_path}{os.sep}"):
+                parts = os.path.relpath(local_file, local_path).replace('\\', '/')
+                return remote_path, posixpath.join(remote_path, parts)
+        return str(), str()
+
+
+    def stage(self, local_file: str) -> None:
+        """Queue a staged file for transfer. Files already queued are ignored.
+
+        Args:
+            local_file (str): full path to local file
+        """
+        local_file = os.path.normpath(str(local_file))
+        with self._lock:
+            if local_file in self._pending:
+                return
+            self._pending[local_file] = time.time()
+            self._retry.pop(local_file, None)
+        self._queue.put(local_file)
+
+
+    def sweep(self) -> None:
+        """Queue all files found in the registered staging folders, e.g., the backlog after a restart."""
+        for local_path in self._destinations:
+            for root, dirs, files in os.walk(local_path):
+                for file in files:
+                    self.stage(os.path.join(root, file))
+
+
+    def status(self) -> dict:
+        """Return queue depth, age of the oldest pending file (lag_s), lag of the last transfer, and counters."""
+        now = time.time()
+        with self._lock:
+            oldest = min(self._pending.values(), default=now)
+            return {'queue_depth': len(self._pending),
+                    'retry': len(self._retry),
+                    'lag_s': round(now - oldest, 1),
+                    'last_lag_s': round(self.last_lag, 1),
+                    'transfered': self.transfered,
+                    'failed': self.failed}
+
+
+    def log_status(self) -> None:
+        self.logger.info(f"TransferService: {self.status()}", extra={'to_logfile': True})
+
+
+    def stop(self, timeout: float=None) -> None:
+        """Stop the service after the current batch."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+
+
+    def _requeue_due(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            due = [local_file for local_file, t in self._retry.items() if t <= now]
+            for local_file in due:
+                del self._retry[local_file]
+        for local_file in due:
+            self.stage(local_file)
+
+
+    def _next_batch(self) -> list:
+        """Wait for a staged file, then drain the queue without blocking."""
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return list()
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+
+    def _transfer(self, batch: list) -> None:
+        # group files by destination, skip files removed or unknown meanwhile
+        groups = dict()
+        for local_file in batch:
+            remote_path, remote_file = self.destination(local_file)
+            if remote_path and os.path.exists(local_file):
+                groups.setdefault(remote_path, []).append((local_file, remote_file))
+            else:
+                with self._lock:
+                    self._pending.pop(local_file, None)
+
+        for remote_path, jobs in groups.items():
+            try:
+                succeeded, _ = self.sftp.transfer_batch(jobs=jobs,
+                                                        remote_path=remote_path,
+                                                        remove_on_success=self.remove_on_success)
+            except Exception as err:
+                self.logger.error(f"_transfer: {remote_path}: {err}")
+                succeeded = list()
+            succeeded = set(succeeded)
+            now = time.time()
+            with self._lock:
+                # NB: every file not reported as transfered is retried, so none is left pending forever
+                for local_file, _ in jobs:
+                    if local_file in succeeded:
+                        self.last_lag = now - self._pending.pop(local_file, now)
+                        self.transfered += 1
+                    else:
+                        self._pending.pop(local_file, None)
+                        self._retry[local_file] = time.monotonic() + self.retry_interval
+                        self.failed += 1
+
+
+    def run(self) -> None:
+        self.logger.info("TransferService started")
+        while not self._stop_event.is_set():
+            try:
+                self._requeue_due()
+                batch = self._next_batch()
+                if batch:
+                    self._transfer(batch)
+            except Exception as err:
+                self.logger.error(f"TransferService: {err}")
+                time.sleep(1)
+        self.logger.info("TransferService stopped")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Receive records sent as UDP datagrams (e.g., FIDAS sendVal) in a background thread.
+
+Instruments that send records unprompted at their own rate are drained by a UDPReceiver thread,
+so no datagram waits in the socket buffer for the next scheduled job. The receive buffer of the
+socket (SO_RCVBUF) is enlarged to absorb bursts. Each record is stamped with the time its first
+datagram arrived and put into a bounded queue, which the driver consumes on its schedule.
+
+Datagrams are counted as received, and as dropped if the kernel discarded them because the
+socket buffer was full (SO_RXQ_OVFL, Linux), or if the queue was full.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import logging
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+# NB: not exported by the socket module; the kernel then reports the number of datagrams dropped so far with each datagram
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
+
+
+class UDPReceiver(threading.Thread):
+    """
+    Read records from a UDP socket in a background thread.
+
+    Available methods include
+    - drain(): records received so far, with their time of arrival
+    - status(): datagrams received and dropped, records queued
+    - stop(): stop reading and close the socket
+    """
+
+    def __init__(self, address: tuple[str, int], config: dict, buffer_size: int=8192, rcvbuf: int=1048576,
+                 terminator: bytes=b'>', queue_size: int=3600, timeout: float=1.0):
+        """
+        Args:
+            address (tuple[str, int]): host, port to bind to
+            config (dict): general configuration
+            buffer_size (int, optional): maximum size of a datagram. Defaults to 8192.
+            rcvbuf (int, optional): requested SO_RCVBUF [bytes]. Defaults to 1048576.
+            terminator (bytes, optional): the datagram containing it completes a record. Defaults to b'>'.
+            queue_size (int, optional): records kept until drained. Defaults to 3600.
+            timeout (float, optional): seconds per receive, i.e., the delay of stop(). Defaults to 1.0.
+        """
+        super().__init__(name=f"receiver-{address[1]}", daemon=True)
+
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+
+        self.address = address
+        self.terminator = terminator
+        self.received = 0
+        self.records = 0
+        self.dropped = 0
+        self._kernel_dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._rx = bytearray(buffer_size)
+        self._ancbufsize = socket.CMSG_SPACE(4)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        # NB: Linux doubles the value requested, and caps it at net.core.rmem_max
+        self.rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._overflow = False
+        if SO_RXQ_OVFL is not None:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._overflow = True
+            except OSError:
+                pass
+        self.sock.settimeout(timeout)
+        self.sock.bind(address)
+
+
+    def drain(self) -> list[tuple[float, bytes]]:
+        """Return the records received since the last call, oldest first, as (time of arrival [s since epoch], record)."""
+        records = list()
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                return records
+
+
+    def status(self) -> dict:
+        return {'received': self.received, 'records': self.records, 'dropped': self.dropped,
+                'queued': self._queue.qsize(), 'rcvbuf': self.rcvbuf}
+
+
+    def stop(self, timeout: float=None) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+        self.sock.close()
+
+
+    def _receive(self, view: memoryview) -> int:
+        """Receive a datagram into view, and count datagrams the kernel dropped before it."""
+        n, ancdata, _, _ = self.sock.recvmsg_into([view], self._ancbufsize)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                # NB: the kernel reports the number of datagrams dropped since the socket was opened
+                total = struct.unpack('I', data[:4])[0]
+                self.dropped += total - self._kernel_dropped
+                self._kernel_dropped = total
+        return n
+
+
+    def run(self) -> None:
+        self.logger.info(f"UDPReceiver {self.address} started, SO_RCVBUF {self.rcvbuf} bytes")
+        view = memoryview(self._rx)
+        record = bytearray()
+        arrival = None
+        while not self._stop_event.is_set():
+            try:
+                n = self._receive(view) if self._overflow else self.sock.recv_into(view)
+                now = time.time()
+                self.received += 1
+                if not record:
+                    arrival = now
+                record += view[:n]
+                # NB: search the datagram just added (b'>' in a memoryview would compare single bytes)
+                if record.find(self.terminator, len(record) - n) >= 0:
+                    try:
+                        self._queue.put_nowait((arrival, bytes(record)))
+                        self.records += 1
+                    except queue.Full:
+                        self.dropped += 1
+                    record.clear()
+            except socket.timeout:
+                pass
+            except OSError as err:
+                if self._stop_event.is_set():
+                    break
+                self.logger.error(f"UDPReceiver {self.address}: {err}")
+                time.sleep(0.1)
+        self.logger.info(f"UDPReceiver {self.address} stopped")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write-ahead log for data held in memory until it is saved.
+
+Instrument drivers keep up to a reporting interval of data in memory. Each record is also appended
+to a WriteAheadLog with a single buffered write. The log is flushed and fsync'ed at most every
+sync_interval seconds (group commit): by the append that finds the interval elapsed, or else by a
+timer. It is replayed when the driver starts, and truncated once the data has been saved to its
+data file. A power cut thus loses at most sync_interval seconds of data.
+
+Each record is framed as <length><crc32><payload>. Replay stops at the first incomplete or corrupt
+record, i.e., a record torn by the power cut.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+_HEADER = struct.Struct('<II')
+
+
+class WriteAheadLog:
+    """
+    Append-only record log with periodic fsync.
+
+    Available methods include
+    - append(): log a record
+    - sync(): flush and fsync now
+    - replay(): records logged, oldest first
+    - truncate(): discard all records
+    - close()
+    """
+
+    def __init__(self, file: str, sync_interval: float=1.0):
+        """
+        Args:
+            file (str): full path to log file
+            sync_interval (float, optional): maximum seconds between fsyncs. 0 syncs every record. Defaults to 1.0.
+        """
+        self.file = file
+        self.sync_interval = float(sync_interval)
+        os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+        self._fh = open(file, 'ab', buffering=65536)
+        self._last_sync = float('-inf')
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._timer = None
+
+
+    def append(self, record: bytes | str) -> None:
+        """Log a record. It is fsync'ed with this append if sync_interval has elapsed since the last sync.
+
+        Args:
+            record (bytes | str): record; str is encoded as utf-8
+        """
+        if isinstance(record, str):
+            record = record.encode('utf-8')
+        with self._lock:
+            self._fh.write(_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            self._dirty = True
+            wait = self._last_sync + self.sync_interval - time.monotonic()
+            if wait <= 0:
+                self._sync()
+            elif self._timer is None:
+                # nothing may follow this record for a while: sync it when the interval is up
+                self._timer = threading.Timer(wait, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+
+    def _sync(self) -> None:
+        if self._dirty and not self._fh.closed:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._dirty = False
+        self._last_sync = time.monotonic()
+
+
+    def sync(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._sync()
+
+
+    def replay(self) -> list[bytes]:
+        """Return the records logged, oldest first. A torn record at the end, and anything after it, is dropped."""
+        with self._lock:
+            self._fh.flush()
+            with open(self.file, 'rb') as fh:
+                data = fh.read()
+        records = list()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            record = data[start:start + length]
+            if len(record) < length or zlib.crc32(record) != crc:
+                break
+            records.append(record)
+            offset = start + length
+        if offset < len(data):
+            # drop the torn tail, so that records appended from now on can be replayed
+            with self._lock:
+                self._fh.truncate(offset)
+                self._fh.seek(offset)
+        return records
+
+
+    def truncate(self) -> None:
+        """Discard all records, e.g., after the data has been saved to its data file."""
+        with self._lock:
+            self._fh.flush()
+            self._fh.truncate(0)
+            self._fh.seek(0)
+            os.fsync(self._fh.fileno())
+            self._dirty = False
+
+
+    def close(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._sync()
+            self._fh.close()
+
+
+def open_wal(config: dict, name: str) -> WriteAheadLog:
+    """Return the WriteAheadLog of an instrument.
+
+    Args:
+        config (dict): general configuration
+                config['wal']['path']: (optional) folder of log files, relative to root. Defaults to 'wal'.
+                config['wal']['sync_interval']: (optional) seconds. Defaults to 1.
+        name (str): instrument name, used as file name
+
+    Returns:
+        WriteAheadLog: log at <root>/<path>/<name>.wal
+    """
+    cfg = config.get('wal', {})
+    path = os.path.join(os.path.expanduser(config['root']), cfg.get('path', 'wal'))
+    return WriteAheadLog(file=os.path.join(path, f"{name}.wal"), sync_interval=cfg.get('sync_interval', 1))
+
+
+if __name__ == "__main__":
+    pass
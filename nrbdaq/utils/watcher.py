@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Watch the staging area and report files as soon as they are ready to be sent.
+
+On Linux, inotify is used (through ctypes, no extra dependency) to learn when a file has been
+closed after writing or moved into the staging area. Elsewhere, or if inotify is not available,
+the staging area is polled and files are reported once their size and mtime are stable.
+
+@author: joerg.klausen@meteoswiss.ch
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+from typing import Callable
+
+# inotify event masks, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+
+class StagingWatcher(threading.Thread):
+    """
+    Maintain an in-memory index of files ready to send below a staging folder.
+
+    Available methods include
+    - ready(): files currently in the index
+    - stop(): stop watching
+    """
+
+    def __init__(self, path: str, callback: Callable[[str], None], config: dict):
+        """
+        Initialize the StagingWatcher.
+
+        Args:
+            path (str): full path to staging folder
+            callback (Callable): called with the full path of each file that is ready, e.g., TransferService.stage
+            config (dict): general configuration
+                    config['watcher']['mode']: (optional) 'inotify' or 'polling'. Defaults to 'inotify'.
+                    config['watcher']['poll_interval']: (optional) seconds between scans when polling. Defaults to 10.
+        """
+        super().__init__(name='watcher', daemon=True)
+
+        # configure logging
+        _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+        self.logger = logging.getLogger(f"{_logger}.{__name__}")
+
+        self.path = os.path.normpath(os.path.expanduser(str(path)))
+        self.callback = callback
+        self.mode = config.get('watcher', {}).get('mode', 'inotify')
+        self.poll_interval = float(config.get('watcher', {}).get('poll_interval', 10))
+
+        self._index = dict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._fd = None
+        self._wds = dict()
+
+        os.makedirs(self.path, exist_ok=True)
+        if self.mode == 'inotify':
+            try:
+                self._init_inotify()
+            except OSError as err:
+                self.logger.warning(f"StagingWatcher: inotify not available ({err}), falling back to polling.")
+                self.mode = 'polling'
+        self.logger.info(f"Initialize StagingWatcher ({self.mode}): {self.path}")
+
+
+    def ready(self) -> list:
+        """Return the files currently known to be ready to send."""
+        with self._lock:
+            return list(self._index)
+
+
+    def stop(self, timeout: float=None) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+
+
+    def _report(self, file: str, signature: tuple) -> None:
+        with self._lock:
+            if self._index.get(file) == signature:
+                return
+            self._index[file] = signature
+        try:
+            self.callback(file)
+        except Exception as err:
+            self.logger.error(f"StagingWatcher: {file}: {err}")
+
+
+    def _forget(self, file: str) -> None:
+        with self._lock:
+            self._index.pop(file, None)
+            for known in [f for f in self._index if f.startswith(f"{file}{os.sep}")]:
+                del self._index[known]
+
+
+    def _scan(self) -> dict:
+        """Return signatures (size, mtime) of all files below self.path."""
+        found = dict()
+        stack = [self.path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat()
+                            found[entry.path] = (st.st_size, st.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        return found
+
+
+    @staticmethod
+    def _signature(file: str) -> tuple:
+        st = os.stat(file)
+        return (st.st_size, st.st_mtime_ns)
+
+
+    # -- inotify ------------------------------------------------------------------------------
+    def _init_inotify(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._fd = fd
+        self._add_watch(self.path)
+
+
+    def _add_watch(self, path: str) -> None:
+        """Watch path and all its sub-directories."""
+        for root, dirs, files in os.walk(path):
+            wd = self._inotify_add_watch(self._fd, os.fsencode(root), _MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue
+                raise OSError(err, os.strerror(err))
+            self._wds[wd] = root
+
+
+    def _handle_events(self, buffer: bytes) -> bool:
+        """Process inotify events. Returns False if the event queue overflowed, requiring a rescan."""
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + _EVENT.size: offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+            root = self._wds.get(wd)
+            if root is None or not name:
+                continue
+            path = os.path.join(root, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # new sub-directory: watch it, and pick up files written before the watch was in place
+                    self._add_watch(path)
+                    for file, signature in self._scan_dir(path).items():
+                        self._report(file, signature)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                try:
+                    self._report(path, self._signature(path))
+                except FileNotFoundError:
+                    pass
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._forget(path)
+        return True
+
+
+    def _scan_dir(self, path: str) -> dict:
+        found = dict()
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    found[os.path.join(root, file)] = self._signature(os.path.join(root, file))
+                except FileNotFoundError:
+                    pass
+        return found
+
+
+    def _run_inotify(self) -> None:
+        for file, signature in self._scan().items():
+            self._report(file, signature)
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 1.0)
+            if not readable:
+                continue
+            if not self._handle_events(os.read(self._fd, 65536)):
+                self.logger.warning("StagingWatcher: inotify queue overflow, rescanning.")
+                found = self._scan()
+                with self._lock:
+                    self._index = {f: s for f, s in self._index.items() if f in found}
+                for file, signature in found.items():
+                    self._report(file, signature)
+
+
+    # -- polling ------------------------------------------------------------------------------
+    def _run_polling(self) -> None:
+        # report files whose signature did not change between two consecutive scans
+        previous = dict()
+        while True:
+            found = self._scan()
+            for file, signature in found.items():
+                if previous.get(file) == signature:
+                    self._report(file, signature)
+            with self._lock:
+                self._index = {f: s for f, s in self._index.items() if f in found}
+            previous = found
+            if self._stop_event.wait(self.poll_interval):
+                break
+
+
+    def run(self) -> None:
+        try:
+            if self.mode == 'inotify':
+                try:
+                    self._run_inotify()
+                except OSError as err:
+                    self.logger.warning(f"StagingWatcher: inotify failed ({err}), falling back to polling.")
+                    self.mode = 'polling'
+            if self.mode == 'polling':
+                self._run_polling()
+        except Exception as err:
+            self.logger.error(f"StagingWatcher: {err}")
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+if __name__ == "__main__":
+    pass